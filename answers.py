@@ -0,0 +1,59 @@
+"""In-memory index of problem answers. """
+import logging
+import typing
+
+import database
+
+
+class Answer(typing.NamedTuple):
+    answer: int
+    season: int
+    public: bool
+
+
+class AnswerIndex:
+    """Holds the answer of every problem and the current problem of every running season, so that checking
+    a submission needs no database reads. Anything that changes a problem's answer, season or visibility,
+    or which problem is current, must call reload_problem or reload_seasons. """
+
+    def __init__(self, db: database.Database):
+        self.db = db
+        self.logger = logging.getLogger('answers')
+        self.problems = {}  # problem id -> Answer
+        self.running = {}  # season id -> (latest potd id, season name), in order of season id
+
+    async def load(self):
+        problems = await self.db.fetch('SELECT id, answer, season, public from problems')
+        self.problems = {x[0]: Answer(x[1], x[2], bool(x[3])) for x in problems}
+        await self.reload_seasons()
+        self.logger.info(f'Loaded answers for {len(self.problems)} problems')
+
+    async def reload_problem(self, problem_id: int):
+        result = await self.db.fetchone('SELECT answer, season, public from problems WHERE id = ?', (problem_id,))
+        if result is None:
+            self.problems.pop(problem_id, None)
+        else:
+            self.problems[problem_id] = Answer(result[0], result[1], bool(result[2]))
+
+    async def reload_seasons(self):
+        seasons = await self.db.fetch('SELECT id, latest_potd, name from seasons WHERE running = ? and latest_potd '
+                                      'is not null order by id', (True,))
+        self.running = {x[0]: (x[1], x[2]) for x in seasons}
+
+    def get(self, problem_id: int) -> typing.Optional[Answer]:
+        return self.problems.get(problem_id)
+
+    def current(self):
+        """Returns (answer, potd id, season id) of the problem currently being solved, or None. """
+        for season_id in self.running:
+            potd_id = self.running[season_id][0]
+            if potd_id in self.problems:
+                return self.problems[potd_id].answer, potd_id, season_id
+        return None
+
+    def running_season_name(self, problem_id: int):
+        """The name of the running season that problem_id is the current problem of, if any. """
+        for potd_id, name in self.running.values():
+            if potd_id == problem_id:
+                return name
+        return None
@@ -0,0 +1,59 @@
+"""Sending the same thing to every configured server at once. """
+import asyncio
+import logging
+import time
+import typing
+
+logger = logging.getLogger('broadcast')
+
+
+class Report:
+    """Timing of one broadcast: total wall time, how long each target took and which ones failed. """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall_time = 0.0
+        self.latencies = {}  # target id -> seconds taken
+        self.failures = {}  # target id -> error message
+
+    def summary(self, slowest: int = 3):
+        text = f'{self.name}: {len(self.latencies)} targets in {self.wall_time:.2f}s, {len(self.failures)} failed'
+        if self.latencies:
+            worst = sorted(self.latencies.items(), key=lambda x: x[1], reverse=True)[:slowest]
+            text += ', slowest ' + ', '.join(f'{target} ({latency:.2f}s)' for target, latency in worst)
+        return text
+
+
+async def broadcast(name: str, targets: typing.Iterable[tuple], send: typing.Callable[..., typing.Awaitable],
+                    concurrency: int = 10):
+    """Call send(*target) for every target, at most `concurrency` at a time. The first element of each
+    target identifies it in the report. A target failing doesn't stop or slow down the others. """
+    report = Report(name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(target: tuple):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                await send(*target)
+            except Exception as e:
+                report.failures[target[0]] = str(e)
+                logger.warning(f'[{name.upper()}] {target[0]}: {e}')
+            finally:
+                report.latencies[target[0]] = time.monotonic() - start
+
+    start = time.monotonic()
+    await asyncio.gather(*[run(target) for target in targets])
+    report.wall_time = time.monotonic() - start
+    logger.info(f'[{name.upper()}] {report.summary()}')
+    return report
+
+
+def combine(reports: typing.List[Report]):
+    """One report for broadcasts that ran side by side, e.g. in every process of a cluster. """
+    report = Report(reports[0].name)
+    for part in reports:
+        report.wall_time = max(report.wall_time, part.wall_time)
+        report.latencies.update(part.latencies)
+        report.failures.update(part.failures)
+    return report
@@ -0,0 +1,320 @@
+"""Running the bot as a cluster of processes on one machine: shard processes that each connect to Discord with
+some of the shards, and a coordinator that owns the database writer, the daily schedule and the scores of
+running seasons. Run `python cluster.py`, or `python cluster.py --fake-gateway` to try it out without
+connecting to Discord. """
+import argparse
+import asyncio
+import functools
+import logging
+import multiprocessing
+import time
+import typing
+
+from discord.ext import commands
+
+import database
+import ipc
+import migrations
+import openpotd
+import scheduler
+import scoring
+
+config = openpotd.config
+logger = logging.getLogger('cluster')
+
+
+def shard_ranges(shard_count: int, processes: int):
+    """Split the shards into consecutive ranges, one per process. Process 0 gets shard 0, which is the one
+    Discord sends every DM to. """
+    return [list(range(i * shard_count // processes, (i + 1) * shard_count // processes)) for i in range(processes)]
+
+
+class ShardedBot(openpotd.OpenPOTD, commands.AutoShardedBot):
+    """The bot of a shard process, which connects to Discord with the shards of its ShardLink. """
+
+
+class RemoteDatabase(database.Database):
+    """The database of a shard process. It reads the database file itself, but sends writes to the coordinator,
+    which has the only writer, so reads still only see committed data. Functions passed to transaction are
+    pickled, so they must be module level functions or functools.partial of them. """
+
+    def __init__(self, link: 'ShardLink', path: str, readers: int = 4, timeout: float = 10):
+        super().__init__(path, readers, timeout)
+        self.link = link
+
+    def start(self):
+        pass
+
+    async def close(self):
+        self.readers.shutdown(wait=False)
+
+    # Writes are timed out by the coordinator's database, which can still drop them if they haven't started
+    async def execute(self, sql: str, params: typing.Iterable = ()) -> database.Written:
+        return await self.link.peer.call('execute', sql, tuple(params))
+
+    async def executemany(self, sql: str, seq_of_params: typing.Iterable) -> database.Written:
+        return await self.link.peer.call('executemany', sql, [tuple(x) for x in seq_of_params])
+
+    async def transaction(self, fn):
+        return await self.link.peer.call('transaction', fn)
+
+    async def commit(self, wait: bool = None):
+        if wait:
+            await self.link.peer.call('commit', wait)
+
+
+class RemoteScores:
+    """The scoring.ScoreKeeper of the coordinator. """
+
+    def __init__(self, link: 'ShardLink'):
+        self.link = link
+
+    async def add(self, season: int, user: int, problem: int = None, num_attempts: int = None):
+        return await self.link.peer.call('add_scores', season, user, problem, num_attempts)
+
+    async def drop(self, season: int):
+        await self.link.peer.call('drop_scores', season)
+
+    async def warm(self):
+        await self.link.peer.call('warm_scores')
+
+
+class ShardLink:
+    """What a shard process of the bot knows about the cluster, and its connection to the coordinator. Process 0
+    is the leader: it gets the DMs, runs the scheduled jobs and the jobs that aren't about a server. """
+
+    def __init__(self, index: int, shard_ids: list, shard_count: int, path: str):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.path = path
+        self.leader = index == 0
+        self.peer = None
+        self.bot = None
+        self.mirrored = {}  # name -> object whose changes are made in the other processes as well
+        self.pending = set()  # relays not sent yet
+        self.scores = RemoteScores(self)
+
+    def database(self, path: str, readers: int = 4, timeout: float = 10):
+        return RemoteDatabase(self, path, readers, timeout)
+
+    async def connect(self, bot: openpotd.OpenPOTD):
+        self.bot = bot
+        self.peer = await ipc.connect(self.path, {'run': self._run, 'run_job': self._run_job, 'mirror': self._mirror})
+        self.peer.name = 'coordinator'
+        await self.peer.call('hello', self.index)
+        # Without the coordinator there is no database; the launcher starts the process again
+        self.peer.closed.add_done_callback(lambda _: self._later(bot.close()))
+
+    async def ready(self):
+        """Once the cogs are loaded (and only once): keep the caches in step with the other processes, and have the coordinator
+        run the schedule of the leader. """
+        bot = self.bot
+        self.mirror('answers', bot.answers, load='load', reload_problem='reload_problem',
+                    reload_seasons='reload_seasons')
+        self.mirror('problems', bot.problems, invalidate='invalidate', clear='clear', forget_dates='forget_dates')
+        self.mirror('guild_configs', bot.guild_configs, set='apply', init='created')
+        self.mirror('jobs', bot.jobs, wake='wake')
+        interface = bot.get_cog('Interface')
+        if interface is not None:
+            self.mirror('leaderboard', interface.leaderboard, invalidate='invalidate')
+
+        if self.leader:
+            await self.peer.call('schedule', [(job.name, job.at.strftime('%H:%M:%S'), job.tz and job.tz.key,
+                                               job.catch_up) for job in bot.scheduler.jobs.values()])
+
+    def mirror(self, name: str, obj, **methods):
+        """Whenever obj.method(...) is called here, call obj.remote(...) with the same arguments in the other
+        processes once everything written so far is committed, for each method=remote. """
+        if name in self.mirrored:
+            return
+        self.mirrored[name] = obj
+        for method, remote in methods.items():
+            setattr(obj, method, self._relayed(name, getattr(obj, method), remote))
+
+    def _relayed(self, name: str, original, remote: str):
+        if asyncio.iscoroutinefunction(original):
+            async def relayed(*args, **kwargs):
+                result = await original(*args, **kwargs)
+                self._later(self._relay(name, remote, args, kwargs))
+                return result
+        else:
+            def relayed(*args, **kwargs):
+                result = original(*args, **kwargs)
+                self._later(self._relay(name, remote, args, kwargs))
+                return result
+        return relayed
+
+    def _later(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _relay(self, name: str, remote: str, args: tuple, kwargs: dict):
+        # The other processes only see committed data
+        await self.bot.db.commit(wait=True)
+        try:
+            await self.peer.notify('mirror', name, remote, args, kwargs)
+        except ConnectionError:
+            pass
+
+    async def _mirror(self, peer: ipc.Peer, name: str, remote: str, args: tuple, kwargs: dict):
+        obj = self.mirrored[name]
+        # The method of the class rather than of the object, so it isn't relayed back
+        result = getattr(type(obj), remote)(obj, *args, **kwargs)
+        if asyncio.iscoroutine(result):
+            await result
+
+    async def _run(self, peer: ipc.Peer, cog: str, method: str, *args):
+        await self.bot.gateway_ready.wait()
+        return await getattr(self.bot.get_cog(cog), method)(*args)
+
+    async def _run_job(self, peer: ipc.Peer, name: str, when):
+        await self.bot.gateway_ready.wait()
+        await self.bot.scheduler.jobs[name].job(when)
+
+
+class Coordinator:
+    """The process every shard process talks to. Writes of all processes go through its database, so they are
+    still committed in groups by a single writer. """
+
+    def __init__(self):
+        self.db = database.Database('data/data.db', config.get('database_readers', 4),
+                                    config.get('database_timeout', 10), config.get('commit_window', 0.05),
+                                    config.get('commit_max_events', 100),
+                                    config.get('commit_durability', 'relaxed') == 'strict')
+        self.scheduler = scheduler.Scheduler(self.db)
+        self.scores = scoring.ScoreKeeper(self.db, config['base_points'], config.get('scoring_rule', 'weighted_new'))
+        self.shards = {}  # process index -> peer
+        self.logger = logging.getLogger('coordinator')
+
+    async def run(self, path: str):
+        self.db.start()
+        await migrations.migrate(self.db)
+        handlers = {
+            'hello': self.hello,
+            'execute': lambda peer, *args: self.db.execute(*args),
+            'executemany': lambda peer, *args: self.db.executemany(*args),
+            'transaction': lambda peer, fn: self.db.transaction(fn),
+            'commit': lambda peer, wait: self.db.commit(wait),
+            'add_scores': lambda peer, *args: self.scores.add(*args),
+            'drop_scores': lambda peer, season: self.scores.drop(season),
+            'warm_scores': lambda peer: self.scores.warm(),
+            'fan_out': self.fan_out,
+            'mirror': self.mirror,
+            'schedule': self.schedule,
+        }
+        server = await ipc.serve(path, handlers)
+        self.logger.info(f'Listening on {path}')
+        try:
+            await server.serve_forever()
+        finally:
+            self.scheduler.stop()
+            await self.db.close()
+
+    async def hello(self, peer: ipc.Peer, index: int):
+        peer.name = f'process {index}'
+        self.shards[index] = peer
+
+        def gone(_):
+            # Unless it has reconnected since
+            if self.shards.get(index) is peer:
+                del self.shards[index]
+                self.logger.warning(f'Process {index} disconnected')
+
+        peer.closed.add_done_callback(gone)
+        self.logger.info(f'Process {index} connected')
+
+    async def fan_out(self, peer: ipc.Peer, cog: str, method: str, *args):
+        """Call a method of a cog in every process and return the results of those that didn't fail. """
+        indices = sorted(self.shards)
+        results = await asyncio.gather(*[self.shards[i].call('run', cog, method, *args) for i in indices],
+                                       return_exceptions=True)
+        for index, result in zip(indices, results):
+            if isinstance(result, Exception):
+                self.logger.warning(f'{cog}.{method} failed in process {index}: {result}')
+        return [result for result in results if not isinstance(result, Exception)]
+
+    async def mirror(self, peer: ipc.Peer, name: str, remote: str, args: tuple, kwargs: dict):
+        for other in list(self.shards.values()):
+            if other is not peer:
+                try:
+                    await other.notify('mirror', name, remote, args, kwargs)
+                except ConnectionError:
+                    pass
+
+    async def schedule(self, peer: ipc.Peer, jobs: list):
+        """Take over the scheduled jobs of the leader, which runs them when they are due. """
+        for name, at, tz, catch_up in jobs:
+            self.scheduler.every_day(name, at, functools.partial(self.run_job, name), tz, catch_up)
+        await self.scheduler.start()
+
+    async def run_job(self, name: str, when):
+        leader = self.shards.get(0)
+        if leader is None:
+            raise ConnectionError(f'Process 0 is not connected to run {name}')
+        await leader.call('run_job', name, when)
+
+
+async def run_without_gateway(bot: openpotd.OpenPOTD):
+    """Start a shard process without connecting to Discord: it has no guilds, but takes part in everything
+    else the cluster does. """
+    async with bot:
+        await bot.setup_hook()
+        await bot.on_ready()
+        await bot.cluster.peer.closed
+
+
+def run_coordinator(path: str):
+    logging.basicConfig(level=logging.INFO, format='[%(name)s %(levelname)s] %(message)s')
+    asyncio.run(Coordinator().run(path))
+
+
+def run_shard(index: int, shard_ids: list, shard_count: int, path: str, fake_gateway: bool):
+    bot = ShardedBot(ShardLink(index, shard_ids, shard_count, path))
+    if fake_gateway:
+        asyncio.run(run_without_gateway(bot))
+    else:
+        bot.run(openpotd.read_token())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--fake-gateway', action='store_true', help='don\'t connect to Discord')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(name)s %(levelname)s] %(message)s')
+    path = config.get('cluster_socket', 'data/cluster.sock')
+    processes = config.get('cluster_processes', 2)
+    shard_count = max(config.get('cluster_shards') or processes, processes)
+
+    targets = {'coordinator': (run_coordinator, (path,))}
+    for index, shard_ids in enumerate(shard_ranges(shard_count, processes)):
+        targets[f'process {index}'] = (run_shard, (index, shard_ids, shard_count, path, args.fake_gateway))
+    logger.info(f'Starting {processes} processes with {shard_count} shards')
+
+    # Keep every process running; a shard process stops whenever it loses the coordinator
+    context = multiprocessing.get_context('spawn')
+    running = {}
+    try:
+        while True:
+            for name, (target, target_args) in targets.items():
+                process = running.get(name)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.warning(f'{name} exited with code {process.exitcode}, restarting')
+                running[name] = context.Process(target=target, args=target_args, name=name)
+                running[name].start()
+            time.sleep(5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in running.values():
+            process.terminate()
+        for process in running.values():
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
-import io
+import asyncio
+import functools
 import logging
 import math
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import datetime as dt
 import random
@@ -8,20 +11,84 @@ import random
 import discord
 from discord.ext import commands
 
+import leaderboard
 import openpotd
+import scoring
 import shared
+import statsembeds
 
 
-# Change this if you want a different algorithm
-def weighted_score(attempts: int):
-    return 0.9 ** (attempts - 1)
+def record_submission(conn: sqlite3.Connection, user_id: int, nickname: str, potd_id: int, season_id: int,
+                      answer: int, correct: bool, submit_time: datetime):
+    """Records an official submission. Runs on the database writer thread so that it sees every submission
+    before it, committed or not.
 
+    Returns (attempts before this one, whether the user was just ranked, whether they had already solved
+    the problem, attempts including this one). """
+    cursor = conn.cursor()
 
-weighted_score_dict = [1, 0.9, 0.65, 0.45, 0.25, 0.1]
+    # Make sure the user is registered
+    cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
+                   (user_id, nickname, True))
 
+    cursor.execute('SELECT count() from attempts where user_id = ? and potd_id = ?', (user_id, potd_id))
+    previous_attempts = cursor.fetchone()[0]
 
-def weighted_score_new(attempts: int):
-    return weighted_score_dict[min(attempts, len(weighted_score_dict)) - 1]
+    # Put a ranking entry in for them
+    cursor.execute('INSERT or IGNORE into rankings (season_id, user_id) VALUES (?, ?)', (season_id, user_id))
+    newly_ranked = cursor.rowcount == 1
+
+    # Check that they have not already solved this problem
+    cursor.execute('SELECT exists (select 1 from solves where problem_id = ? and solves.user = ?)', (potd_id, user_id))
+    if cursor.fetchone()[0]:
+        return previous_attempts, newly_ranked, True, previous_attempts
+
+    # We got to record the submission anyway even if it is right or wrong
+    cursor.execute('INSERT into attempts (user_id, potd_id, official, submission, submit_time) VALUES (?, ?, ?, ?, ?)',
+                   (user_id, potd_id, True, answer, submit_time))
+    num_attempts = previous_attempts + 1
+
+    if correct:
+        cursor.execute('INSERT into solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                       (user_id, potd_id, num_attempts, True))
+
+    return previous_attempts, newly_ranked, False, num_attempts
+
+
+def record_unofficial_attempt(conn: sqlite3.Connection, user_id: int, nickname: str, potd_id: int, answer: int,
+                              correct: bool):
+    """Records an unofficial attempt on the database writer thread.
+
+    Returns (whether they had solved it before, official attempts, unofficial attempts). """
+    cursor = conn.cursor()
+
+    # See whether they've solved it before
+    cursor.execute('SELECT exists (select * from solves where solves.user = ? and solves.problem_id = ?)',
+                   (user_id, potd_id))
+    solved_before = cursor.fetchone()[0]
+
+    # Make sure the user is registered
+    cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
+                   (user_id, nickname, True))
+
+    # Record an attempt even if they've solved before
+    cursor.execute('INSERT INTO attempts (user_id, potd_id, official, submission, submit_time) VALUES (?,?,?,?,?)',
+                   (user_id, potd_id, False, answer, datetime.now()))
+
+    # Get the number of both official and unofficial attempts
+    cursor.execute('SELECT COUNT(1) from attempts WHERE user_id = ? and potd_id = ? and official = ?',
+                   (user_id, potd_id, True))
+    official_attempts = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(1) from attempts WHERE user_id = ? and potd_id = ? and official = ?',
+                   (user_id, potd_id, False))
+    unofficial_attempts = cursor.fetchone()[0]
+
+    if correct and not solved_before:
+        # Record that they solved it.
+        cursor.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                       (user_id, potd_id, official_attempts + unofficial_attempts, False))
+
+    return solved_before, official_attempts, unofficial_attempts
 
 
 class Interface(commands.Cog):
@@ -29,146 +96,93 @@ class Interface(commands.Cog):
         self.bot = bot
         self.logger = logging.getLogger('interface')
         self.cooldowns = {}
+        self.stats_embeds = statsembeds.StatsEmbedUpdater(bot, bot.config.get('stats_embed_interval', 10),
+                                                          bot.config.get('stats_embed_problems', 16))
+        bot.jobs.register('stats_embed', self.stats_embeds.run)
+        self.rescore_pool = ProcessPoolExecutor(bot.config.get('rescore_processes', 2))
+        self.leaderboard = leaderboard.Leaderboard(bot.db)
+
+        # Submissions received while the new problem is being posted
+        self.held = asyncio.Queue(bot.config.get('held_submissions', 1000))
+        self.held_authors = set()  # one submission is held per person
+        self.draining = False
+        self.held_total = 0
+        self.held_max = 0
+        self.held_dropped = 0  # submissions turned away, to be sent again
+
+    def cog_unload(self):
+        self.rescore_pool.shutdown(wait=False, cancel_futures=True)
 
     @commands.command()
     @commands.check(lambda ctx: False)  # This command is disabled since it only applies for multi-server config
     async def register(self, ctx, *, season):
-        cursor = self.bot.db.cursor()
-        cursor.execute('''SELECT id from seasons where name = ? and server_id = ?''', (season, ctx.guild.id))
-        ids = cursor.fetchall()
+        ids = await self.bot.db.fetch('''SELECT id from seasons where name = ? and server_id = ?''',
+                                      (season, ctx.guild.id))
         if len(ids) == 0:
             await ctx.send('No such season!')
             return
         else:
             season_id = ids[0][0]
-        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
-                       (ctx.author.id, ctx.author.display_name, True))
+        await self.bot.db.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
+                                  (ctx.author.id, ctx.author.display_name, True))
 
-        cursor.execute('''SELECT EXISTS (SELECT 1 from registrations WHERE registrations.user_id = ? 
-                            AND registrations.season_id = ?)''', (ctx.author.id, season_id))
-        existence = cursor.fetchall()[0][0]
+        existence = (await self.bot.db.fetchone('''SELECT EXISTS (SELECT 1 from registrations WHERE 
+                            registrations.user_id = ? AND registrations.season_id = ?)''', (ctx.author.id, season_id)))[0]
         if existence:
             await ctx.send("You've already signed up for this season!")
             return
         else:
-            cursor.execute('''INSERT into registrations (user_id, season_id) VALUES (?, ?)''',
-                           (ctx.author.id, season_id))
+            await self.bot.db.execute('''INSERT into registrations (user_id, season_id) VALUES (?, ?)''',
+                                      (ctx.author.id, season_id))
             await ctx.send(f"Registered you for {season}. ")
-        self.bot.db.commit()
 
-    def update_rankings(self, season: int, potd_id: int = -1):
-        cursor = self.bot.db.cursor()
+    async def get_scoring_rule(self, season: int) -> str:
+        return await scoring.season_rule(self.bot.db, season, self.bot.config.get('scoring_rule', 'weighted_new'))
 
-        # NOTE: THE OPENPOTD TEAM IS USING A NEW SCORING SYSTEM FOR SEASON 11. IF THIS DOES NOT APPLY TO YOU,
-        # REMOVE THIS.
-        if season == 11:
-            # Get all solves this season
-            cursor.execute('select solves.user, solves.problem_id, solves.num_attempts from problems left join solves '
-                           'where problems.season = ? and problems.id = solves.problem_id and official = ?',
-                           (season, True))
-            solves = cursor.fetchall()
+    async def update_rankings(self, season: int, potd_id: int = -1):
+        db = self.bot.db
+        rule = await self.get_scoring_rule(season)
+        base_points = self.bot.config['base_points']
 
-            # Get all ranked people
-            cursor.execute('select user_id from rankings where season_id = ?', (season,))
-            ranked_users = cursor.fetchall()
+        # Log stuff
+        self.logger.info(f'Updating rankings of season {season} [{rule}]')
 
-            # Calculate scores of each person
-            total_score = {user[0]: 0 for user in ranked_users}
-            for solve in solves:
-                total_score[solve[0]] += 8 - solve[2]
+        if self.bot.config.get('scoring_backend', 'sql') == 'numpy':
+            # Make sure everything written so far is scored
+            await db.commit(wait=True)
 
-        else:
             # Get all solves this season
-            cursor.execute('select solves.user, solves.problem_id, solves.num_attempts from problems left join solves '
-                           'where problems.season = ? and problems.id = solves.problem_id and official = ?',
-                           (season, True))
-            solves = cursor.fetchall()
-
-            # Get weighted attempts for each problem
-            weighted_attempts = {}
-            if season > 11:
-                for solve in solves:
-                    if solve[1] in weighted_attempts:
-                        weighted_attempts[solve[1]] += weighted_score_new(solve[2])
-                    else:
-                        weighted_attempts[solve[1]] = weighted_score_new(solve[2])
-            else:
-                for solve in solves:
-                    if solve[1] in weighted_attempts:
-                        weighted_attempts[solve[1]] += weighted_score(solve[2])
-                    else:
-                        weighted_attempts[solve[1]] = weighted_score(solve[2])
-
-            # Calculate how many points each problem should be worth on the 1st attempt
-            if season > 11:
-                problem_points = {i: self.bot.config['base_points'] / (weighted_attempts[i] + 3) for i in
-                                  weighted_attempts}
-            else:
-                problem_points = {i: self.bot.config['base_points'] / weighted_attempts[i] for i in weighted_attempts}
+            solves = await db.fetch('select solves.user, solves.problem_id, solves.num_attempts from problems left '
+                                    'join solves where problems.season = ? and problems.id = solves.problem_id and '
+                                    'official = ? order by solves.problem_id, solves.id', (season, True))
 
             # Get all ranked people
-            cursor.execute('select user_id from rankings where season_id = ?', (season,))
-            ranked_users = cursor.fetchall()
-
-            # Calculate scores of each person
-            total_score = {user[0]: 0 for user in ranked_users}
-            if season > 11: 
-                for solve in solves:
-                    total_score[solve[0]] += problem_points[solve[1]] * weighted_score_new(solve[2])
-            else: 
-                for solve in solves:
-                    total_score[solve[0]] += problem_points[solve[1]] * weighted_score(solve[2])
-
-            if potd_id == -1:
-                # Then we shall update all the potds
-                cursor.executemany('UPDATE problems SET weighted_solves = ?, base_points = ? WHERE problems.id = ?',
-                                   [(weighted_attempts[i], problem_points[i], i) for i in weighted_attempts])
-            else:
-                # Only update the specified potd
-                if potd_id in weighted_attempts:
-                    cursor.execute('UPDATE problems SET weighted_solves = ?, base_points = ? WHERE problems.id = ?',
-                                   (weighted_attempts[potd_id], problem_points[potd_id], potd_id))
-                else:
-                    self.logger.error(f'No potd with id {potd_id} present. Cannot refresh stats [update_rankings]')
+            ranked_users = await db.fetch('select user_id from rankings where season_id = ? order by user_id',
+                                          (season,))
 
-        # Log stuff
-        self.logger.info('Updating rankings')
-
-        # Prepare data to be put into the db
-        total_score_list = [(i, total_score[i]) for i in total_score]
-        total_score_list.sort(key=lambda x: -x[1])
-        cursor.executemany('update rankings SET rank = ?, score = ? WHERE user_id = ? and season_id = ?',
-                           [(i + 1, total_score_list[i][1], total_score_list[i][0], season) for i in
-                            range(len(total_score_list))])
-
-        # Commit
-        self.bot.db.commit()
-
-    async def update_embed(self, potd_id: int):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT config.server_id, potd_channel, otd_prefix, message_id from config left join '
-                       'stats_messages ON config.server_id = stats_messages.server_id WHERE stats_messages.id '
-                       'is NOT NULL and stats_messages.potd_id = ?;', (potd_id,))
-        servers = cursor.fetchall()
-
-        problem = shared.POTD(potd_id, self.bot.db)
-
-        for server_data in servers:
-            potd_channel: discord.TextChannel = self.bot.get_channel(server_data[1])
-            if potd_channel is not None:
-                try:
-                    stats_message = await potd_channel.fetch_message(server_data[3])
-                    embed = problem.build_embed(self.bot.db, False, server_data[2])
-                    await stats_message.edit(embed=embed)
-                except discord.errors.NotFound as e:
-                    self.logger.warning(f'[UPDATE_EMBED] Server {server_data[0]} no message id {server_data[3]}')
+            # Score the season in a worker process so that big seasons don't hold up the bot
+            rankings, problems = await asyncio.get_running_loop().run_in_executor(
+                self.rescore_pool, scoring.score_season, season, rule, base_points, solves,
+                [x[0] for x in ranked_users])
+
+            if potd_id != -1:
+                # Only update the specified potd
+                problems = [x for x in problems if x[2] == potd_id]
 
-    def refresh(self, season: int, potd_id: int):
-        # Update the rankings in the db
-        self.update_rankings(season, potd_id)
+            await db.executemany('UPDATE problems SET weighted_solves = ?, base_points = ? WHERE problems.id = ?',
+                                 problems)
+            await db.executemany('update rankings SET rank = ?, score = ? WHERE user_id = ? and season_id = ?',
+                                 rankings)
+        else:
+            # Score the season inside SQLite. Every problem is rescored, since the rankings add up the points
+            # of all of them.
+            await db.transaction(functools.partial(scoring.rescore_season, season=season, rule=rule,
+                                                   base_points=base_points))
 
-        # Update the embed showing stats
-        self.bot.loop.create_task(self.update_embed(potd_id))
+        # The in-memory scores and the leaderboard are now stale
+        await self.bot.scores.drop(season)
+        self.leaderboard.invalidate(season)
+        self.bot.problems.clear()
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -177,12 +191,6 @@ class Interface(commands.Cog):
                 or message.author.id in self.bot.blacklist:  # you can't submit answers in a server
             return
 
-        # Make sure it's time for submission
-        if self.bot.posting_problem:
-            await message.channel.send('The new problem is being posted. Please wait until the bot '
-                                       'status changes to submit your answer. ')
-            return
-
         # Validating int-ness
         s = message.content
         if not (s[1:].isdecimal() if s[0] in ('-', '+') else s.isdecimal()):
@@ -197,78 +205,117 @@ class Interface(commands.Cog):
                                        'Please try again. ')
             return
 
-        cursor = self.bot.db.cursor()
+        received = datetime.utcnow()
+
+        # While the new problem is being posted, hold on to submissions and check them in order once it is out
+        if self.bot.posting_problem or self.draining:
+            # Nobody waits for room, or they would hold up everyone else's messages
+            if message.author.id in self.held_authors:
+                self.held_dropped += 1
+                await message.channel.send('You already have an answer waiting to be checked. Send this one again '
+                                           'once the new problem is out. ')
+                return
+            if self.held.full():
+                self.held_dropped += 1
+                await message.channel.send('The new problem is being posted. Please send your answer again in a '
+                                           'minute. ')
+                return
+            self.held_authors.add(message.author.id)
+            self.held.put_nowait((message, answer, received))
+            self.held_total += 1
+            self.held_max = max(self.held_max, self.held.qsize())
+            await message.channel.send('The new problem is being posted. Your answer will be checked as soon as '
+                                       'it is out. ')
+            return
+
+        await self.check_submission(message, answer, received)
+
+    @commands.Cog.listener()
+    async def on_posting_finished(self):
+        if self.draining:
+            return
+        self.draining = True
+        try:
+            while not self.held.empty():
+                message, answer, received = self.held.get_nowait()
+                self.held_authors.discard(message.author.id)
+                try:
+                    await self.check_submission(message, answer, received)
+                except Exception as e:
+                    self.logger.warning(f'Checking held submission of {message.author.id}: {e}')
+        finally:
+            self.draining = False
 
+    async def check_submission(self, message: discord.Message, answer: int, received: datetime):
         # Check cooldowns
         if self.bot.config['cooldown']:
             if message.author.id in self.cooldowns and self.cooldowns[message.author.id] > datetime.utcnow():
                 await message.channel.send(f"You're on cooldown! Send another answer in "
                                            f"{(self.cooldowns[message.author.id] - datetime.utcnow()).total_seconds():.2f} seconds. ")
                 return
-
-        # Get the current answer from the database
-        cursor.execute('SELECT answer, problems.id, seasons.id from seasons left join problems '
-                       'where seasons.running = ? and problems.id = seasons.latest_potd', (True,))
-        correct_answer_list = cursor.fetchall()
-
-        # Make sure the user is registered
-        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
-                       (message.author.id, message.author.display_name, True))
-        self.bot.db.commit()
-
-        if len(correct_answer_list) == 0:
+            # Hold the shortest cooldown until we know how many attempts they've made, so that answers sent
+            # meanwhile don't get past the check
+            self.cooldowns[message.author.id] = datetime.utcnow() + dt.timedelta(seconds=10)
+
+        # Get the current answer
+        current = self.bot.answers.current()
+
+        if current is None:
+            self.cooldowns.pop(message.author.id, None)
+            # Make sure the user is registered
+            await self.bot.db.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
+                                      (message.author.id, message.author.display_name, True))
+            await self.bot.db.commit()
             await message.channel.send(
                 f'There is no current {self.bot.config["otd_prefix"]}OTD to check answers against. ')
             return
         else:
-            correct_answer, potd_id, season_id = correct_answer_list[0][0], correct_answer_list[0][1], \
-                                                 correct_answer_list[0][2]
+            correct_answer, potd_id, season_id = current
+            correct = answer == correct_answer
+
+            previous_attempts, newly_ranked, solved_before, num_attempts = await self.bot.db.transaction(
+                functools.partial(record_submission, user_id=message.author.id,
+                                  nickname=message.author.display_name, potd_id=potd_id, season_id=season_id,
+                                  answer=answer, correct=correct, submit_time=received))
 
             if self.bot.config['cooldown']:
-                cursor.execute('SELECT count() from attempts where user_id = ? and potd_id = ?',
-                               (message.author.id, potd_id))
-                num_attempts = cursor.fetchall()[0][0]
-                cool_down = 10 if num_attempts < 5 else 1800 if num_attempts == 5 else 1000000
+                cool_down = 10 if previous_attempts < 5 else 1800 if previous_attempts == 5 else 1000000
                 self.cooldowns[message.author.id] = datetime.utcnow() + dt.timedelta(seconds=cool_down)
 
-            # Put a ranking entry in for them
-            cursor.execute('INSERT or IGNORE into rankings (season_id, user_id) VALUES (?, ?)',
-                           (season_id, message.author.id,))
-            self.bot.db.commit()
+            # Put them in the rankings, and recalculate the scoreboard if they solved it
+            if newly_ranked or (correct and not solved_before):
+                if correct and not solved_before:
+                    problems, ranks_changed = await self.bot.scores.add(season_id, message.author.id, potd_id,
+                                                                        num_attempts)
+                else:
+                    problems, ranks_changed = await self.bot.scores.add(season_id, message.author.id)
+                for problem_id in problems:
+                    self.bot.problems.invalidate(problem_id)
+                if ranks_changed:
+                    self.leaderboard.invalidate(season_id)
+
+            if correct and not solved_before:
+                # Update the embed showing stats and give them the "solved" role in the background. The jobs
+                # are committed together with the solve.
+                await self.stats_embeds.mark_dirty(potd_id)
+                for server in self.bot.guild_configs.all():
+                    if self.bot.owns(server.server_id):
+                        if server.solved_role is None or server.guild.get_member(message.author.id) is None:
+                            continue
+                    elif server.solved_role_id is None:
+                        continue
+                    # For servers of other processes the process running the job checks they are a member
+                    await self.bot.jobs.enqueue('solved_role', shard=self.bot.shard_of(server.server_id),
+                                                server_id=server.server_id, user_id=message.author.id, give=True)
+
+            await self.bot.db.commit()
 
             # Check that they have not already solved this problem
-            cursor.execute('SELECT exists (select 1 from solves where problem_id = ? and solves.user = ?)',
-                           (potd_id, message.author.id))
-            if cursor.fetchall()[0][0]:
+            if solved_before:
                 await message.channel.send(f'You have already solved this {self.bot.config["otd_prefix"].lower()}otd! ')
                 return
 
-            # We got to record the submission anyway even if it is right or wrong
-            try:
-                cursor.execute('INSERT into attempts (user_id, potd_id, official, submission, submit_time) '
-                               'VALUES (?, ?, ?, ?, ?)',
-                               (message.author.id, potd_id, True, int(message.content), datetime.utcnow()))
-                self.bot.db.commit()
-            except OverflowError:
-                cursor.execute('INSERT into attempts (user_id, potd_id, official, submission, submit_time '
-                               'VALUES (?, ?, ?, ?, ?)',
-                               (message.author.id, potd_id, True, -1000, datetime.utcnow()))
-                self.bot.db.commit()
-
-            # Calculate the number of attempts
-            cursor.execute('SELECT count(1) from attempts where attempts.potd_id = ? and attempts.user_id = ?',
-                           (potd_id, message.author.id))
-            num_attempts = cursor.fetchall()[0][0]
-
-            if answer == correct_answer:  # Then the answer is correct. Let's give them points.
-                # Insert data
-                cursor.execute('INSERT into solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
-                               (message.author.id, potd_id, num_attempts, True))
-                self.bot.db.commit()
-
-                # Recalculate scoreboard
-                self.refresh(season_id, potd_id)
-
+            if correct:  # Then the answer is correct. Let's give them points.
                 # Alert user that they got the question correct
                 if random.random() < 0.05:
                     await message.channel.send(
@@ -276,28 +323,6 @@ class Interface(commands.Cog):
                 else:
                     await message.channel.send(f'Thank you! You solved the problem after {num_attempts} attempts. ')
 
-                # Give them the "solved" role
-                cursor.execute('SELECT server_id, solved_role_id from config where solved_role_id is not null')
-                servers = cursor.fetchall()
-
-                for server in servers:
-                    guild: discord.Guild = self.bot.get_guild(server[0])
-                    if guild is None:
-                        continue
-
-                    member: discord.Member = guild.get_member(message.author.id)
-                    if member is None:
-                        continue
-
-                    solved_role: discord.Role = guild.get_role(server[1])
-                    if solved_role is None:
-                        continue
-
-                    try:
-                        await member.add_roles(solved_role, reason=f'Solved POTD')
-                    except Exception as e:
-                        self.logger.warning(e)
-
                 # Logged that they solved it
                 self.logger.info(
                     f'User {message.author.id} just solved {self.bot.config["otd_prefix"].lower()}otd {potd_id}. ')
@@ -306,19 +331,14 @@ class Interface(commands.Cog):
                 # They got it wrong
                 await message.channel.send(f'You did not solve this problem! Number of attempts: `{num_attempts}`. ')
 
-                # Recalculate stuff anyway
-                self.refresh(season_id, potd_id)
-
                 # Log that they didn't solve it
                 self.logger.info(
                     f'User {message.author.id} submitted incorrect answer {answer} for {self.bot.config["otd_prefix"].lower()}otd {potd_id}. ')
 
     @commands.command()
     async def score(self, ctx, season: int = None):
-        cursor = self.bot.db.cursor()
         if season is None:
-            cursor.execute('SELECT id, name from seasons where running = ?', (True,))
-            running_seasons = cursor.fetchall()
+            running_seasons = await self.bot.db.fetch('SELECT id, name from seasons where running = ?', (True,))
             if len(running_seasons) == 0:
                 await ctx.send('No current running season. Please specify a season. ')
                 return
@@ -326,8 +346,7 @@ class Interface(commands.Cog):
                 season = running_seasons[0][0]
                 szn_name = running_seasons[0][1]
         else:
-            cursor.execute('SELECT id, name from seasons where id = ?', (season,))
-            selected_seasons = cursor.fetchall()
+            selected_seasons = await self.bot.db.fetch('SELECT id, name from seasons where id = ?', (season,))
             if len(selected_seasons) == 0:
                 await ctx.send(f'No season with id {season}. Please specify a valid season. ')
                 return
@@ -335,8 +354,8 @@ class Interface(commands.Cog):
                 season = selected_seasons[0][0]
                 szn_name = selected_seasons[0][1]
 
-        cursor.execute('SELECT rank, score from rankings where season_id = ? and user_id = ?', (season, ctx.author.id))
-        rank = cursor.fetchall()
+        rank = await self.bot.db.fetch('SELECT rank, score from rankings where season_id = ? and user_id = ?',
+                                       (season, ctx.author.id))
         if len(rank) == 0:
             await ctx.send('You are not ranked in this season!')
         else:
@@ -350,80 +369,76 @@ class Interface(commands.Cog):
             embed.add_field(name='Score', value=f'{rank[0][1]:.2f}')
             await ctx.send(embed=embed)
 
-    @commands.command()
-    async def rank(self, ctx, season: int = None):
-        cursor = self.bot.db.cursor()
+    async def get_season(self, ctx, season: int = None):
+        """Returns (id, name) of the given season, or of the running season if none is given. """
         if season is None:
-            cursor.execute('SELECT id, name from seasons where running = ?', (True,))
-            running_seasons = cursor.fetchall()
+            running_seasons = await self.bot.db.fetch('SELECT id, name from seasons where running = ?', (True,))
             if len(running_seasons) == 0:
                 await ctx.send('No current running season. Please specify a season. ')
-                return
-            else:
-                season = running_seasons[0][0]
-                szn_name = running_seasons[0][1]
+                return None
+            return running_seasons[0]
         else:
-            cursor.execute('SELECT id, name from seasons where id = ?', (season,))
-            selected_seasons = cursor.fetchall()
+            selected_seasons = await self.bot.db.fetch('SELECT id, name from seasons where id = ?', (season,))
             if len(selected_seasons) == 0:
                 await ctx.send(f'No season with id {season}. Please specify a valid season. ')
-                return
-            else:
-                season = selected_seasons[0][0]
-                szn_name = selected_seasons[0][1]
+                return None
+            return selected_seasons[0]
 
-        cursor.execute('SELECT rank, score, user_id from rankings where season_id = ? order by rank', (season,))
-        rankings = cursor.fetchall()
+    @commands.command()
+    async def rank(self, ctx, season: int = None):
+        selected = await self.get_season(ctx, season)
+        if selected is None:
+            return
+        season, szn_name = selected
 
-        if len(rankings) <= 20:
-            # If there are less than 20 rankings, we don't need a whole menu (in fact dpymenus will throw us an error)
-            embed = discord.Embed(title=f'{szn_name} rankings')
-            scores = '\n'.join([f'`{rank}`. {score:.2f} [<@!{user_id}>]' for (rank, score, user_id) in rankings])
-            embed.description = scores
-            await ctx.send(embed=embed)
+        pages = leaderboard.Pages(self.leaderboard, season, szn_name, await self.leaderboard.size(season))
+        if len(pages) == 1:
+            # If there is only one page, we don't need a whole menu
+            await ctx.send(embed=await pages.get(0))
         else:
-            pages = []
-            for i in range(len(rankings) // 20 + 1):
-                page = discord.Embed(title=f'{szn_name} rankings - Page {i + 1}')
-                scores = '\n'.join(
-                    [f'`{rank}`. {score:.2f} [<@!{user_id}>]' for (rank, score, user_id) in rankings[20 * i:20 * i + 20]])
-                page.description = scores
-                pages.append(page)
             await self.bot.get_cog('MenuManager').new_menu(ctx, pages)
 
+    @commands.command(brief='Shows the rankings around you')
+    async def around(self, ctx, season: int = None):
+        selected = await self.get_season(ctx, season)
+        if selected is None:
+            return
+        season, szn_name = selected
+
+        embed = await self.leaderboard.around(season, szn_name, ctx.author.id)
+        if embed is None:
+            await ctx.send('You are not ranked in this season!')
+        else:
+            await ctx.send(embed=embed)
+
     @commands.command()
     async def fetch(self, ctx, *, problem: shared.POTD):
         if not await problem.ensure_public(ctx):
             return
 
         potd_id = problem.id
-        cursor = self.bot.db.cursor()
 
         # Calculate the otd prefix
         if ctx.guild is None:
             otd_prefix = self.bot.config["otd_prefix"]
         else:
-            cursor.execute('SELECT otd_prefix from config WHERE server_id = ?', (ctx.guild.id,))
-            result = cursor.fetchall()
-            if len(result) == 0:
+            guild_config = self.bot.guild_configs.get(ctx.guild.id)
+            if guild_config is None:
                 otd_prefix = self.bot.config["otd_prefix"]
             else:
-                otd_prefix = result[0][0]
+                otd_prefix = guild_config.otd_prefix
 
-        cursor.execute('SELECT date from problems where id = ?', (potd_id,))
-        potd_date = cursor.fetchall()[0][0]
+        potd_date = (await self.bot.db.fetchone('SELECT date from problems where id = ?', (potd_id,)))[0]
 
         # Display the potd to the user
-        cursor.execute('''SELECT image FROM images WHERE potd_id = ?''', (potd_id,))
-        images = cursor.fetchall()
+        images = await problem.get_images()
         if len(images) == 0:
             await ctx.send(f'{otd_prefix}OTD {potd_id} of {potd_date} has no picture attached. ')
         else:
-            await ctx.send(f'{otd_prefix}OTD {potd_id} of {potd_date}',
-                           file=discord.File(io.BytesIO(images[0][0]),
-                                             filename=f'POTD-{potd_id}-0.png'))
+            await self.bot.images.send(ctx, images[0], f'POTD-{potd_id}-0.png',
+                                       f'{otd_prefix}OTD {potd_id} of {potd_date}')
             for i in range(1, len(images)):
-                await ctx.send(file=discord.File(io.BytesIO(images[i][0]), filename=f'POTD-{potd_id}-{i}.png'))
+                await self.bot.images.send(ctx, images[i], f'POTD-{potd_id}-{i}.png')
 
         # Log this stuff
         self.logger.info(
@@ -434,48 +449,28 @@ class Interface(commands.Cog):
         if not await problem.ensure_public(ctx):
             return
 
-        cursor = self.bot.db.cursor()
         potd_id = problem.id
 
         # Check that it's not part of a currently running season.
-        cursor.execute('SELECT name from seasons where latest_potd = ? and running = ?', (potd_id, True))
-        seasons = cursor.fetchall()
-        if len(seasons) > 0:
-            await ctx.send(f'This {self.bot.config["otd_prefix"].lower()}otd is part of {seasons[0][0]}. '
+        season_name = self.bot.answers.running_season_name(potd_id)
+        if season_name is not None:
+            await ctx.send(f'This {self.bot.config["otd_prefix"].lower()}otd is part of {season_name}. '
                            f'Please just DM your answer for this {self.bot.config["otd_prefix"]}OTD to me. ')
             return
 
         # Get the correct answer
-        cursor.execute('SELECT answer from problems where id = ?', (potd_id,))
-        correct_answer = cursor.fetchall()[0][0]
+        correct_answer = self.bot.answers.get(potd_id).answer
         answer_is_correct = correct_answer == answer
 
-        # See whether they've solved it before
-        cursor.execute('SELECT exists (select * from solves where solves.user = ? and solves.problem_id = ?)',
-                       (ctx.author.id, potd_id))
-        solved_before = cursor.fetchall()[0][0]
-
-        # Make sure the user is registered
-        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
-                       (ctx.author.id, ctx.author.display_name, True))
-
-        # Record an attempt even if they've solved before
-        cursor.execute('INSERT INTO attempts (user_id, potd_id, official, submission, submit_time) VALUES (?,?,?,?,?)',
-                       (ctx.author.id, potd_id, False, answer, datetime.now()))
-
-        # Get the number of both official and unofficial attempts
-        cursor.execute('SELECT COUNT(1) from attempts WHERE user_id = ? and potd_id = ? and official = ?',
-                       (ctx.author.id, potd_id, True))
-        official_attempts = cursor.fetchall()[0][0]
-        cursor.execute('SELECT COUNT(1) from attempts WHERE user_id = ? and potd_id = ? and official = ?',
-                       (ctx.author.id, potd_id, False))
-        unofficial_attempts = cursor.fetchall()[0][0]
+        solved_before, official_attempts, unofficial_attempts = await self.bot.db.transaction(
+            functools.partial(record_unofficial_attempt, user_id=ctx.author.id, nickname=ctx.author.display_name,
+                              potd_id=potd_id, answer=answer, correct=answer_is_correct))
+        # Still should refresh the embed
+        await self.stats_embeds.mark_dirty(potd_id)
+        await self.bot.db.commit()
 
         if answer_is_correct:
             if not solved_before:
-                # Record that they solved it.
-                cursor.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
-                               (ctx.author.id, potd_id, official_attempts + unofficial_attempts, False))
                 await ctx.send(
                     f'Nice job! You solved {self.bot.config["otd_prefix"]}OTD `{potd_id}` after `{official_attempts + unofficial_attempts}` '
                     f'attempts (`{official_attempts}` official and `{unofficial_attempts}` unofficial). ')
@@ -498,11 +493,6 @@ class Interface(commands.Cog):
         if ctx.guild is not None:
             await ctx.message.delete()
 
-        # Still should refresh the embed
-        await self.update_embed(potd_id)
-
-        self.bot.db.commit()
-
     @commands.command(brief='Some information about the bot. ')
     async def info(self, ctx):
         embed = discord.Embed(description='OpenPOTD is a bot that posts short answer questions once a day for you '
@@ -1,16 +1,26 @@
+import asyncio
+import functools
 import io
+import os
 import re
 import sqlite3
-from datetime import date
+import time
+import typing
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import logging
 
 import discord
-import schedule
 from discord.ext import commands
 from discord.ext.commands import BucketType, flags
 
+import broadcast
+import images
+import migrations
 import openpotd
+import roles
+import scoring
 import shared
 
 authorised_set = set()
@@ -20,36 +30,130 @@ def authorised(ctx):
     return ctx.author.id in authorised_set
 
 
+def run_sql(conn: sqlite3.Connection, sql: str):
+    return conn.execute(sql).fetchall()
+
+
+class Preparation(typing.NamedTuple):
+    """A post got ready ahead of time, and how long that took. """
+    day: date
+    problem: shared.POTD
+    post: shared.PreparedPost
+    seconds: float
+
+
 class Management(commands.Cog):
 
     def __init__(self, bot: openpotd.OpenPOTD):
         self.bot = bot
         self.logger = logging.getLogger('management')
-        schedule.every().day.at(self.bot.config['posting_time']).do(self.schedule_potd)
+        self.bot.scheduler.every_day('post', self.bot.config['posting_time'], self.scheduled_post,
+                                     self.bot.config.get('posting_timezone'),
+                                     self.bot.config.get('posting_catch_up', 6 * 60 * 60))
         global authorised_set
         authorised_set = self.bot.config['authorised']
-
-    def schedule_potd(self):
-        self.bot.loop.create_task(self.advance_potd())
-
-    async def advance_potd(self):
+        self.broadcast_concurrency = self.bot.config.get('broadcast_concurrency', 10)
+        self.broadcasts = {}  # name -> report of the last broadcast
+
+        # Get the post ready a few minutes early
+        self.prepare_minutes = self.bot.config.get('prepare_minutes', 10)
+        self.preparation = None
+        self.preparation_saved = None  # seconds the last post saved by being prepared
+        if self.prepare_minutes:
+            posting_time = self.bot.config['posting_time']
+            posting_time = datetime.strptime(posting_time, '%H:%M:%S' if posting_time.count(':') == 2 else '%H:%M')
+            self.bot.scheduler.every_day('prepare', (posting_time - timedelta(minutes=self.prepare_minutes))
+                                         .strftime('%H:%M:%S'), self.prepare_post,
+                                         self.bot.config.get('posting_timezone'), self.prepare_minutes * 60)
+
+    async def scheduled_post(self, when: datetime):
+        # A missed post is caught up on at startup, before the channels are known
+        await self.bot.gateway_ready.wait()
+        await self.advance_potd(when.date(), False)
+
+    async def get_problem_of(self, day: date):
+        """The id of the problem of a running season on `day`, or None. """
+        result = await self.bot.db.fetch('SELECT problems.id from (seasons inner join problems on seasons.running = ? '
+                                         'and seasons.id = problems.season and problems.date = ? ) where problems.id '
+                                         'IS NOT NULL', (True, str(day)))
+        return result[0][0] if len(result) > 0 else None
+
+    def own_servers(self):
+        """(server id, config) of the servers with a problem channel that this process posts to. """
+        return [(config.server_id, config) for config in self.bot.guild_configs.all()
+                if config.potd_channel is not None and self.bot.owns(config.server_id)]
+
+    async def prepare_post(self, when: datetime):
+        """Load, check and render the next post ahead of time, and tell the admins about anything wrong. """
+        await self.bot.gateway_ready.wait()
+        start = time.monotonic()
+        day = (when + timedelta(minutes=self.prepare_minutes)).date()
+        issues = []
+
+        potd_id = await self.get_problem_of(day)
+        if potd_id is None:
+            issues.append(f'There is no problem for {day}. ')
+        else:
+            answer = self.bot.answers.get(potd_id)
+            if answer is None or answer.answer is None:
+                issues.append(f'{self.bot.config["otd_prefix"]}OTD {potd_id} has no answer. ')
+            for part in await self.bot.fan_out('Management', 'prepare_servers', day, potd_id):
+                issues.extend(part)
+
+        self.logger.info(f'Prepared the post of {day} in {time.monotonic() - start:.3f}s with {len(issues)} issues')
+        if issues:
+            report = f'Problems with the post of {day}:\n' + '\n'.join(dict.fromkeys(issues))
+            for user_id in authorised_set:
+                await self.bot.jobs.enqueue('dm', user_id=user_id, content=report[:2000])
+            await self.bot.db.commit()
+
+    async def prepare_servers(self, day: date, potd_id: int):
+        """Render the post of `day` for the servers of this process and check they can take it. Returns
+        the issues found. """
+        start = time.monotonic()
+        issues = []
+        problem = await self.bot.problems.get(potd_id)
+        prepared = await problem.prepare_post(self.bot)
+        for image in prepared.images:
+            if image.hash is not None and not os.path.exists(self.bot.images.path(image.hash)):
+                issues.append(f'Image {image.hash} of {self.bot.config["otd_prefix"]}OTD {potd_id} is missing. ')
+
+        for _, config in self.own_servers():
+            if config.channel is None:
+                issues.append(f'Server {config.server_id}: can\'t find channel {config.potd_channel}. ')
+                continue
+            permissions = config.channel.permissions_for(config.guild.me)
+            missing = [name for name in ('view_channel', 'send_messages', 'embed_links', 'attach_files')
+                       if not getattr(permissions, name)]
+            if missing:
+                issues.append(f'Server {config.server_id}: missing {", ".join(missing)} in channel '
+                              f'{config.potd_channel}. ')
+            if config.solved_role is not None and (not config.guild.me.guild_permissions.manage_roles
+                                                   or config.solved_role >= config.guild.me.top_role):
+                issues.append(f'Server {config.server_id}: can\'t manage the solved role. ')
+
+        self.preparation = Preparation(day, problem, prepared, time.monotonic() - start)
+        return issues
+
+    async def advance_potd(self, day: date = None, repost: bool = True):
+        """Post the problem of `day` (today by default). Unless repost is set, nothing happens if it is already
+        out. """
         # Let the bot and users know we are posting the problem
         await self.bot.started_posting()
+        try:
+            await self._advance_potd(day or date.today(), repost)
+        finally:
+            # Let the bot and users know we are done posting the problem
+            await self.bot.finished_posting()
 
-        self.logger.info(f'Advancing POTD at {datetime.now()}')
-        cursor = self.bot.db.cursor()
-
-        cursor.execute('SELECT server_id, potd_channel, ping_role_id, solved_role_id, otd_prefix from config '
-                       'WHERE potd_channel IS NOT NULL')
-        servers = cursor.fetchall()
+    async def _advance_potd(self, day: date, repost: bool):
+        self.logger.info(f'Advancing POTD of {day} at {datetime.now()}')
+        db = self.bot.db
 
-        cursor.execute('SELECT problems.id, difficulty from (seasons inner join problems on seasons.running = ? '
-                       'and seasons.id = problems.season and problems.date = ? ) where problems.id IS NOT NULL',
-                       (True, str(date.today())))
-        result = cursor.fetchall()
+        potd_id = await self.get_problem_of(day)
 
-        cursor.execute('SELECT EXISTS (SELECT * from seasons where seasons.running = ?)', (True,))
-        running_seasons_exists = cursor.fetchall()[0][0]
+        running_seasons_exists = (await db.fetchone('SELECT EXISTS (SELECT * from seasons where seasons.running = ?)',
+                                                    (True,)))[0]
 
         # If there's no running season at all then it isn't really "running late" more like just
         # not even having a season
@@ -59,59 +163,92 @@ class Management(commands.Cog):
             return
 
         # If there's a running season but no problem then say
-        if len(result) == 0 or result[0][0] is None:
-            for server in servers:
-                potd_channel = self.bot.get_channel(server[1])
-                if potd_channel is not None:
-                    self.bot.loop.create_task(potd_channel.send(f'Sorry! We are running late on the {server[4].lower()}'
-                                                                f'otd today. '))
-                    self.logger.info(f'Informed server {server[0]} that there is no problem today.')
+        if potd_id is None:
+            self.add_reports(await self.bot.fan_out('Management', 'apologise'))
             return
 
         # Grab the potd
-        potd_id = result[0][0]
-        problem = shared.POTD(result[0][0], self.bot.db)
-
-        for server in servers:
-            # Post the problem
-            try:
-                await problem.post(self.bot, server[1], server[2])
-            except Exception:
-                self.logger.warning(f'Server {server[0]} channel doesn\'t exist.')
-
-            # Remove the solved role from everyone
-            role_id = server[3]
-            if role_id is not None:
-                try:
-                    self.bot.logger.warning('Config variable solved_role_id is not set!')
-                    guild = self.bot.get_guild(server[0])
-                    if guild.get_role(role_id) is not None:
-                        role = guild.get_role(role_id)
-                        for member in role.members:
-                            if member.id not in authorised_set:
-                                await member.remove_roles(role)
-                except Exception as e:
-                    self.logger.warning(f'Server {server[0]}, {e}')
+        problem = await self.bot.problems.get(potd_id)
+
+        latest_potd = (await db.fetchone('SELECT latest_potd from seasons WHERE id = ?', (problem.season,)))[0]
+        if latest_potd == potd_id and not repost:
+            self.logger.warning(f'{self.bot.config["otd_prefix"]}OTD {potd_id} was already posted. ')
+            return
+
+        # Every process posts to its own servers
+        self.add_reports(await self.bot.fan_out('Management', 'post_problem', day, potd_id))
 
         # Advance the season
-        cursor.execute('SELECT season FROM problems WHERE id = ?', (potd_id,))
-        season_id = cursor.fetchall()[0][0]
-        cursor.execute('UPDATE seasons SET latest_potd = ? WHERE id = ?', (potd_id, season_id))
+        season_id = problem.season
+        await db.execute('UPDATE seasons SET latest_potd = ? WHERE id = ?', (potd_id, season_id))
 
         # Make the new potd publicly available
-        cursor.execute('UPDATE problems SET public = ? WHERE id = ?', (True, potd_id))
-
-        # Clear cooldowns from the previous question
-        self.bot.get_cog('Interface').cooldowns.clear()
+        await db.execute('UPDATE problems SET public = ? WHERE id = ?', (True, potd_id))
 
         # Commit db
-        self.bot.db.commit()
+        await db.commit(wait=True)
+
+        # Start checking answers against the new potd
+        self.bot.problems.invalidate(potd_id)
+        self.bot.problems.forget_dates()
+        await self.bot.answers.reload_problem(potd_id)
+        await self.bot.answers.reload_seasons()
+        await self.bot.fan_out('Management', 'posted')
 
         # Log this
         self.logger.info(f'Posted {self.bot.config["otd_prefix"]}OTD {potd_id}. ')
 
-        # Let the bot and users know we are done posting the problem
-        await self.bot.finished_posting()
+    def add_reports(self, parts: list):
+        """Keep the reports of a broadcast that ran in every process, as {name: report} from each. """
+        for name in parts[0] if parts else []:
+            self.broadcasts[name] = broadcast.combine([part[name] for part in parts])
+
+    async def apologise(self):
+        """Say the problem is late in the servers of this process. """
+        async def send(server_id, config):
+            if config.channel is None:
+                raise Exception('No such channel!')
+            await config.channel.send(f'Sorry! We are running late on the {config.otd_prefix.lower()}otd today. ')
+
+        return {'late': await broadcast.broadcast('late', self.own_servers(), send, self.broadcast_concurrency)}
+
+    async def post_problem(self, day: date, potd_id: int):
+        """Post the problem of `day` to the servers of this process and snapshot their solved roles. """
+        problem = await self.bot.problems.get(potd_id)
+        servers = self.own_servers()
+
+        # Only send what was prepared, unless the problem changed since
+        preparation, self.preparation = self.preparation, None
+        if preparation is not None and preparation.day == day and preparation.problem is problem:
+            prepared = preparation.post
+            self.preparation_saved = preparation.seconds
+            self.logger.info(f'Using the post prepared ahead of time, saving {preparation.seconds:.3f}s')
+        else:
+            prepared = await problem.prepare_post(self.bot)
+
+        async def post(server_id, config):
+            await problem.post(self.bot, config.potd_channel, config.ping_role_id, prepared)
+
+        reports = {'post': await broadcast.broadcast('post', servers, post, self.broadcast_concurrency)}
+
+        # Note who has the solved role now. They lose it in the background once the problem is out, so the
+        # post doesn't have to wait for thousands of role removals.
+        async def snapshot(server_id, config):
+            if config.solved_role_id is None:
+                self.logger.warning(f'Config variable solved_role_id is not set! [Server {server_id}]')
+            elif config.solved_role is not None:
+                await self.bot.role_resets.snapshot(config.guild, config.solved_role, authorised_set)
+
+        reports['solved roles'] = await broadcast.broadcast('solved roles', servers, snapshot,
+                                                            self.broadcast_concurrency)
+        return reports
+
+    async def posted(self):
+        """Start on the new problem in this process once it is out. """
+        # Clear cooldowns from the previous question
+        self.bot.get_cog('Interface').cooldowns.clear()
+
+        await self.bot.role_resets.resume()
 
     @commands.command()
     @commands.check(authorised)
@@ -121,23 +258,25 @@ class Management(commands.Cog):
     @commands.command()
     @commands.check(authorised)
     async def newseason(self, ctx, *, name):
-        cursor = self.bot.db.cursor()
-        cursor.execute('''INSERT INTO seasons (running, name) VALUES (?, ?)''', (False, name))
-        self.bot.db.commit()
-        cursor.execute('''SELECT LAST_INSERT_ROWID()''')
-        rowid = cursor.fetchone()[0]
+        written = await self.bot.db.execute('''INSERT INTO seasons (running, name, scoring_rule) VALUES (?, ?, ?)''',
+                                            (False, name, self.bot.config.get('scoring_rule', 'weighted_new')))
+        rowid = written.lastrowid
+        await self.bot.db.commit(wait=True)
         await ctx.send(f'Added a new season called `{name}` with id `{rowid}`. ')
         self.logger.info(f'{ctx.author.id} added a new season called {name} with id {rowid}. ')
 
     @commands.command()
     @commands.check(authorised)
     async def add(self, ctx, season: int, prob_date, answer, *, statement):
-        cursor = self.bot.db.cursor()
         prob_date_parsed = date.fromisoformat(prob_date)
-        cursor.execute('''INSERT INTO problems ("date", season, statement, answer, public) VALUES (?, ?, ?, ?, ?)''',
-                       (prob_date_parsed, season, statement, answer, False))
-        self.bot.db.commit()
-        await ctx.send(f'Added problem. ID: `{cursor.lastrowid}`.')
+        written = await self.bot.db.execute('''INSERT INTO problems ("date", season, statement, answer, public)
+                                            VALUES (?, ?, ?, ?, ?)''', (prob_date_parsed, season, statement, answer, False))
+        await self.bot.db.commit(wait=True)
+        await self.bot.answers.reload_problem(written.lastrowid)
+        # The new problem can change the season_order of others
+        self.bot.problems.clear()
+        self.bot.problems.forget_dates()
+        await ctx.send(f'Added problem. ID: `{written.lastrowid}`.')
         self.logger.info(f'{ctx.author.id} added a new problem. ')
 
     @commands.command()
@@ -148,29 +287,31 @@ class Management(commands.Cog):
             await ctx.send("No attached file. ")
             return
         else:
-            save_path = io.BytesIO()
-            await ctx.message.attachments[0].save(save_path)
-            cursor = self.bot.db.cursor()
-            cursor.execute('''INSERT INTO images (potd_id, image) VALUES (?, ?)''',
-                           (potd, sqlite3.Binary(save_path.getbuffer())))
-            self.bot.db.commit()
-            save_path.close()
+            data = await ctx.message.attachments[0].read()
+            digest, original = await self.bot.images.ingest(data)
+            await self.bot.db.execute('''INSERT INTO images (potd_id, hash, original_hash) VALUES (?, ?, ?)''',
+                                      (potd, digest, original))
+            await self.bot.db.commit(wait=True)
+            self.bot.problems.invalidate(potd)
+
+            size = os.path.getsize(self.bot.images.path(digest))
+            await ctx.send(f'Linked image to {self.bot.config["otd_prefix"].lower()}otd {potd}. '
+                           f'Saved {len(data) - size} bytes ({len(data)} -> {size}). ')
 
     @commands.command()
     @commands.check(authorised)
     async def showpotd(self, ctx, *, problem: shared.POTD):
         """Note: this is the admin version of the command so all problems are visible. """
 
-        images = problem.images
+        images = await problem.get_images()
         if len(images) == 0:
             await ctx.send(f'{self.bot.config["otd_prefix"]}OTD {problem.id} of {problem.date} has no picture '
                            f'attached. ')
         else:
-            await ctx.send(f'{self.bot.config["otd_prefix"]}OTD {problem.id} of {problem.date}',
-                           file=discord.File(io.BytesIO(images[0]),
-                                             filename=f'POTD-{problem.id}-0.png'))
+            await self.bot.images.send(ctx, images[0], f'POTD-{problem.id}-0.png',
+                                       f'{self.bot.config["otd_prefix"]}OTD {problem.id} of {problem.date}')
             for i in range(1, len(images)):
-                await ctx.send(file=discord.File(io.BytesIO(images[i]), filename=f'POTD-{problem.id}-{i}.png'))
+                await self.bot.images.send(ctx, images[i], f'POTD-{problem.id}-{i}.png')
 
     class UpdateFlags(commands.FlagConverter, delimiter=' ', prefix='--'):
         date: str = None
@@ -183,15 +324,21 @@ class Management(commands.Cog):
     @commands.check(authorised)
     async def update(self, ctx, problem: shared.POTD, *, flags:UpdateFlags):
         potd = problem.id
-        cursor = self.bot.db.cursor()
         if not flags.date is None and not bool(re.match(r'\d\d\d\d-\d\d-\d\d', flags.date)):
             await ctx.send('Invalid date (specify yyyy-mm-dd)')
             return
 
         for param in vars(flags):
             if vars(flags)[param] is not None:
-                cursor.execute(f'UPDATE problems SET {param} = ? WHERE id = ?', (vars(flags)[param], potd))
-        self.bot.db.commit()
+                await self.bot.db.execute(f'UPDATE problems SET {param} = ? WHERE id = ?', (vars(flags)[param], potd))
+        await self.bot.db.commit(wait=True)
+        await self.bot.answers.reload_problem(potd)
+        if flags.date is not None or flags.season is not None:
+            # This can change the season_order of others
+            self.bot.problems.clear()
+            self.bot.problems.forget_dates()
+        else:
+            self.bot.problems.invalidate(potd)
         await ctx.send(f'Updated {self.bot.config["otd_prefix"].lower()}otd. ')
 
     @commands.command(name='pinfo')
@@ -206,9 +353,7 @@ class Management(commands.Cog):
     @commands.command()
     @commands.check(authorised)
     async def start_season(self, ctx, season: int):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT running from seasons where seasons.id = ?', (season,))
-        result = cursor.fetchall()
+        result = await self.bot.db.fetch('SELECT running from seasons where seasons.id = ?', (season,))
 
         if len(result) == 0:
             await ctx.send(f'No season with id {season}.')
@@ -216,8 +361,9 @@ class Management(commands.Cog):
 
         running = result[0][0]
         if not running:
-            cursor.execute('UPDATE seasons SET running = ? where seasons.id = ?', (True, season))
-            self.bot.db.commit()
+            await self.bot.db.execute('UPDATE seasons SET running = ? where seasons.id = ?', (True, season))
+            await self.bot.db.commit(wait=True)
+            await self.bot.answers.reload_seasons()
             self.logger.info(f'Started season with id {season}. ')
         else:
             await ctx.send(f'Season {season} already running!')
@@ -225,9 +371,7 @@ class Management(commands.Cog):
     @commands.command()
     @commands.check(authorised)
     async def end_season(self, ctx, season: int):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT running from seasons where seasons.id = ?', (season,))
-        result = cursor.fetchall()
+        result = await self.bot.db.fetch('SELECT running from seasons where seasons.id = ?', (season,))
 
         if len(result) == 0:
             await ctx.send(f'No season with id {season}.')
@@ -235,8 +379,9 @@ class Management(commands.Cog):
 
         running = result[0][0]
         if running:
-            cursor.execute('UPDATE seasons SET running = ? where seasons.id = ?', (False, season))
-            self.bot.db.commit()
+            await self.bot.db.execute('UPDATE seasons SET running = ? where seasons.id = ?', (False, season))
+            await self.bot.db.commit(wait=True)
+            await self.bot.answers.reload_seasons()
             self.logger.info(f'Ended season with id {season}. ')
         else:
             await ctx.send(f'Season {season} already stopped!')
@@ -244,19 +389,23 @@ class Management(commands.Cog):
     @commands.command()
     @commands.is_owner()
     async def execute_sql(self, ctx, *, sql):
-        cursor = self.bot.db.cursor()
         try:
-            cursor.execute(sql)
+            result = await self.bot.db.transaction(functools.partial(run_sql, sql=sql))
         except Exception as e:
             await ctx.send(e)
-        await ctx.send(str(cursor.fetchall()))
+            return
+        await ctx.send(str(result))
+        await self.bot.db.commit(wait=True)
+
+        # Anything could have changed
+        await self.bot.answers.load()
+        self.bot.problems.clear()
+        self.bot.problems.forget_dates()
 
     @commands.command()
     @commands.is_owner()
     async def init_nicks(self, ctx):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT discord_id from users where nickname is NULL')
-        users_to_check = [x[0] for x in cursor.fetchall()]
+        users_to_check = [x[0] for x in await self.bot.db.fetch('SELECT discord_id from users where nickname is NULL')]
 
         to_update = []
         for user_id in users_to_check:
@@ -266,136 +415,261 @@ class Management(commands.Cog):
             else:
                 to_update.append(('Unknown', user_id))
 
-        cursor.executemany('UPDATE users SET nickname = ? where discord_id = ?', to_update)
-        self.bot.db.commit()
+        await self.bot.db.executemany('UPDATE users SET nickname = ? where discord_id = ?', to_update)
+        await self.bot.db.commit(wait=True)
         await ctx.send('Done!')
 
     @commands.command()
     @commands.check(authorised)
     async def announce(self, ctx, *, message: commands.clean_content):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT potd_channel from config where potd_channel is not null')
-        potd_channels = [x[0] for x in cursor.fetchall()]
+        potd_channels = [(config.server_id, config.potd_channel) for config in self.bot.guild_configs.all()
+                         if config.potd_channel is not None]
         self.logger.info(f"[ANNOUNCE] Announcement created by {ctx.message.author.id}")
 
-        for channel_id in potd_channels:
-            channel: discord.TextChannel = self.bot.get_channel(channel_id)
-            if channel is not None:
-                try:
-                    await channel.send(message)
-                except Exception as e:
-                    self.logger.warning(f"[ANNOUNCE] Can't send messages in {channel_id}")
+        for server_id, channel_id in potd_channels:
+            await self.bot.jobs.enqueue('message', shard=self.bot.shard_of(server_id), channel_id=channel_id,
+                                        content=message)
+        await self.bot.db.commit()
+        await ctx.send(f'Queued the announcement for {len(potd_channels)} channels. ')
 
     @commands.command()
     @commands.check(authorised)
     async def set_cutoffs(self, ctx, season: int, bronze: int, silver: int, gold: int):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT EXISTS (select 1 from seasons where id = ?)', (season,))
-        season_exists = cursor.fetchall()[0][0]
+        season_exists = (await self.bot.db.fetchone('SELECT EXISTS (select 1 from seasons where id = ?)', (season,)))[0]
         if season_exists:
-            cursor.execute('UPDATE seasons SET bronze_cutoff = ?, silver_cutoff = ?, gold_cutoff = ? WHERE id = ?',
-                           (bronze, silver, gold, season))
-            self.bot.db.commit()
+            await self.bot.db.execute('UPDATE seasons SET bronze_cutoff = ?, silver_cutoff = ?, gold_cutoff = ? '
+                                      'WHERE id = ?', (bronze, silver, gold, season))
+            await self.bot.db.commit(wait=True)
             await ctx.send('Done!')
         else:
             await ctx.send('No season with that ID!')
 
+    async def medal_role_changes(self, medallers: list):
+        """The role changes that give the servers of this process the medal roles in `medallers` (user ids of
+        bronze, silver and gold), and how many servers were looked at. """
+        servers = [config for config in self.bot.guild_configs.all() if self.bot.owns(config.server_id)]
+        changes = []
+        for config in servers:
+            server_id = config.server_id
+            guild: discord.Guild = config.guild
+
+            if guild is None:
+                self.logger.warning(f'[{server_id}] Trying to assign roles: No such guild {server_id}')
+                continue
+
+            self_member: discord.Member = guild.me
+            if not discord.Permissions.manage_roles.flag & self_member.guild_permissions.value:
+                self.logger.warning(f'[{server_id}] Trying to assign roles: No permissions in guild {server_id}')
+                continue
+
+            # Role holders are only known for servers whose members are cached
+            if not guild.chunked:
+                await guild.chunk()
+
+            desired = {}  # role id -> user ids
+            for x in range(3):
+                role_id = config.medal_role_ids[x]
+                if role_id is None:
+                    continue
+                if config.medal_roles[x] is None:
+                    self.logger.warning(f'[{server_id}] Trying to assign roles: Guild {server_id} has no role '
+                                        f'{role_id}')
+                    continue
+                desired[role_id] = medallers[x]
+            changes.extend(roles.diff_roles(guild, desired))
+        return changes, len(servers)
+
     @commands.command()
     @commands.check(authorised)
-    async def assign_roles(self, ctx, season: int):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT bronze_cutoff, silver_cutoff, gold_cutoff from seasons WHERE id = ?', (season,))
-        result = cursor.fetchall()
+    async def assign_roles(self, ctx, season: int, dry_run: bool = False):
+        """Give everyone the medal role they earned in the season, only touching people whose medal changed.
+        With dry_run the changes are listed instead of made. """
+        db = self.bot.db
+        result = await db.fetch('SELECT bronze_cutoff, silver_cutoff, gold_cutoff from seasons WHERE id = ?', (season,))
 
         if len(result) == 0:
             await ctx.send('No such season!')
             return
 
-        cutoffs = result[0]
-        cursor.execute('SELECT server_id, bronze_role_id, silver_role_id, gold_role_id from config')
-        servers = cursor.fetchall()
+        bronze, silver, gold = result[0]
+
+        # 0 is bronze, 1 silver and 2 gold
+        medallers = [set(), set(), set()]
+        for user_id, medal in await db.fetch(
+                'SELECT user_id, CASE WHEN score > ? THEN 2 WHEN score > ? and score < ? THEN 1 '
+                'WHEN score > ? and score < ? THEN 0 END from rankings inner join users on '
+                'rankings.user_id = users.discord_id where season_id = ? and score > ? and '
+                'users.receiving_medal_roles = ?', (gold, silver, gold, bronze, silver, season, bronze, True)):
+            if medal is not None:
+                medallers[medal].add(user_id)
+
+        # Each process looks at the members of its own servers; the changes are all made from here
+        changes, servers = [], 0
+        for part_changes, part_servers in await self.bot.fan_out('Management', 'medal_role_changes', medallers):
+            changes.extend(part_changes)
+            servers += part_servers
+
+        added = sum(change.add for change in changes)
+        summary = f'{added} roles to add and {len(changes) - added} to remove in {servers} servers. '
+        if dry_run:
+            plan = '\n'.join(f'{"+" if change.add else "-"} server {change.server_id} user {change.user_id} '
+                              f'role {change.role_id}' for change in changes)
+            await ctx.send(summary, file=discord.File(io.BytesIO(plan.encode()), filename='medal_roles.txt'))
+            return
 
-        cursor.execute('SELECT user_id from rankings inner join users on rankings.user_id = users.discord_id '
-                       'where season_id = ? and score > ? and score < ? and users.receiving_medal_roles = ?',
-                       (season, cutoffs[0], cutoffs[1], True))
-        bronzes = [x[0] for x in cursor.fetchall()]
+        failed = await roles.apply_changes(self.bot.http, changes, self.bot.config.get('role_reset_rate', 5),
+                                           self.bot.config.get('role_reset_concurrency', 10))
+        self.logger.info(f'Assigned medal roles for season {season}: {summary}{len(failed)} failed. ')
+        await ctx.send(f'Done! {summary}{len(failed)} failed. ')
 
-        cursor.execute('SELECT user_id from rankings inner join users on rankings.user_id = users.discord_id '
-                       'where season_id = ? and score > ? and score < ? and users.receiving_medal_roles = ?',
-                       (season, cutoffs[1], cutoffs[2], True))
-        silvers = [x[0] for x in cursor.fetchall()]
+    @commands.command()
+    @commands.check(authorised)
+    async def metrics(self, ctx):
+        """Counters showing how busy the bot is. """
+        stats_embeds = self.bot.get_cog('Interface').stats_embeds
+        embed = discord.Embed(title='Metrics')
+        embed.add_field(name='Stats embed edits', value=stats_embeds.edits)
+        embed.add_field(name='Stats embed updates coalesced', value=stats_embeds.coalesced)
+        embed.add_field(name='Stats embed edits skipped (unchanged)', value=stats_embeds.unchanged)
+        db = self.bot.db
+        embed.add_field(name='Database write queue', value=f'{db.queue_depth} (max {db.max_queue_depth})')
+        embed.add_field(name='Database reads waiting', value=db.reads_waiting)
+        embed.add_field(name='Database timeouts', value=db.timeouts)
+        embed.add_field(name='Database commits', value=f'{db.commits} ({db.events_committed} writes)')
+        embed.add_field(name='Problem cache', value=f'{self.bot.problems.hits} hits, {self.bot.problems.misses} misses')
+        embed.add_field(name='Image uploads', value=f'{self.bot.images.uploads} ({self.bot.images.reuses} reused)')
+        role_resets = self.bot.role_resets
+        embed.add_field(name='Solved roles removed', value=f'{role_resets.processed} '
+                        f'({role_resets.processed / max(role_resets.seconds, 0.001):.1f}/s, '
+                        f'{len(role_resets.tasks)} resets running)')
+        interface = self.bot.get_cog('Interface')
+        embed.add_field(name='Held submissions', value=f'{interface.held.qsize()} waiting, {interface.held_total} '
+                                                       f'held (max {interface.held_max} at once, '
+                                                       f'{interface.held_dropped} turned away)')
+        memory = openpotd.resident_memory()
+        embed.add_field(name='Gateway profile', value=f'{self.bot.gateway_profile}, ready after '
+                                                      f'{self.bot.startup_time or 0:.1f}s, '
+                                                      f'{"?" if memory is None else f"{memory:.0f}"} MiB resident')
+        if self.preparation_saved is not None:
+            embed.add_field(name='Last post preparation saved', value=f'{self.preparation_saved:.3f}s')
+        jobs = self.bot.jobs
+        embed.add_field(name='Job queue', value=f'{await jobs.depth()} waiting, {jobs.completed} done, '
+                                                f'{jobs.failed} failed, {jobs.deduplicated} deduplicated')
+        embed.add_field(name='Job latency', value=f'{jobs.total_latency / max(jobs.completed, 1):.2f}s average, '
+                                                  f'{jobs.max_latency:.2f}s max')
+        for report in self.broadcasts.values():
+            embed.add_field(name=f'Last {report.name} broadcast', value=report.summary(), inline=False)
+        await ctx.send(embed=embed)
 
-        cursor.execute('SELECT user_id from rankings inner join users on rankings.user_id = users.discord_id '
-                       'where season_id = ? and score > ? and users.receiving_medal_roles = ?',
-                       (season, cutoffs[2], True))
-        golds = [x[0] for x in cursor.fetchall()]
-        medallers = [bronzes, silvers, golds]
+    @commands.command()
+    @commands.check(authorised)
+    async def query_plans(self, ctx):
+        """Shows how SQLite runs each hot query. A plain SCAN means a full table scan. """
+        plans = await migrations.query_plans(self.bot.db)
+        embed = discord.Embed(title='Query plans')
+        for name, plan in plans:
+            scans = any(line.startswith('SCAN') and 'INDEX' not in line and 'CONSTANT ROW' not in line for line in plan)
+            embed.add_field(name=f'{name} (full scan)' if scans else name, value='\n'.join(plan), inline=False)
+        await ctx.send(embed=embed)
 
-        for server in servers:
-            server_id = server[0]
-            guild: discord.Guild = self.bot.get_guild(server_id)
+    @commands.command()
+    @commands.check(authorised)
+    async def clear_imgs(self, ctx, *, problem: shared.POTD):
+        digests = {digest for row in await self.bot.db.fetch('SELECT hash, original_hash from images WHERE potd_id = ?',
+                                                            (problem.id,)) for digest in row if digest is not None}
+        await self.bot.db.execute('DELETE FROM images WHERE potd_id = ?', (problem.id,))
+        await self.bot.db.commit(wait=True)
+        self.bot.problems.invalidate(problem.id)
+
+        # Remove the files no other problem uses
+        for digest in digests:
+            if not (await self.bot.db.fetchone('SELECT EXISTS (SELECT 1 from images WHERE hash = ? or original_hash = ?)',
+                                               (digest, digest)))[0]:
+                await self.bot.images.remove(digest)
 
-            if guild is None:
-                self.logger.warning(f'[{server_id}] Trying to assign roles: No such guild {server_id}')
-                continue
+        await ctx.send('Cleared images!')
 
-            self_member: discord.Member = guild.get_member(self.bot.user.id)
-            if not discord.Permissions.manage_roles.flag & self_member.guild_permissions.value:
-                self.logger.warning(f'[{server_id}] Trying to assign roles: No permissions in guild {server_id}')
-                continue
+    @commands.command()
+    @commands.check(authorised)
+    async def scoring_rule(self, ctx, season: int, rule):
+        if rule not in scoring.SCORING_RULES:
+            await ctx.send(f'No such scoring rule! Available rules: {", ".join(scoring.SCORING_RULES)}')
+            return
 
-            # Clear all the bronze, silver and gold roles
-            for x in (server[1], server[2], server[3]):  # Bronze, Silver, Gold role IDs
-                if x is not None:
-                    medal_role: discord.Role = guild.get_role(x)
-                    if medal_role is None:
-                        self.logger.warning(f'[{server_id}] Trying to assign roles: Guild {server_id} has no role {x}')
-                        continue
-                    for user in medal_role.members:
-                        user: discord.Member
-                        try:
-                            await user.remove_roles(medal_role)
-                        except Exception as e:
-                            self.logger.warning(f'[{server_id}] Trying to assign roles: '
-                                                f'Guild {server_id} missing permissions. ')
-
-            self.logger.info(f'[{server_id}] Removed all medal roles from guild {server_id}')
-
-            # Give roles
-            for x in range(3):
-                if server[x + 1] is not None:
-                    medal_role: discord.Role = guild.get_role(server[x + 1])
-                    if medal_role is None:
-                        self.logger.warning(f'[{server_id}] No role {medal_role} ({x})')
-                        continue
-                    for user_id in medallers[x]:
-                        if guild.get_member(user_id) is not None:
-                            member: discord.Member = guild.get_member(user_id)
-                            try:
-                                await member.add_roles(medal_role)
-                            except Exception as e:
-                                self.logger.warning(f'[{server_id}] Trying to assign roles: '
-                                                    f'Guild {server_id} missing permissions. [{user_id}]')
-                            self.logger.info(f'[{server_id}] Gave {user_id} role {medal_role.name}')
+        written = await self.bot.db.execute('UPDATE seasons SET scoring_rule = ? WHERE id = ?', (rule, season))
+        if written.rowcount == 0:
+            await ctx.send(f'No season with id `{season}`.')
+            return
+        await self.bot.db.commit(wait=True)
 
-        await ctx.send('Done!')
+        await self.bot.get_cog('Interface').update_rankings(season)
+        await ctx.send(f'Season `{season}` is now scored with `{rule}`.')
+        self.logger.info(f'{ctx.author.id} set the scoring rule of season {season} to {rule}. ')
 
     @commands.command()
-    @commands.check(authorised)
-    async def clear_imgs(self, ctx, *, problem: shared.POTD):
-        cursor = self.bot.db.cursor()
-        cursor.execute('DELETE FROM images WHERE potd_id = ?', (problem.id,))
-        self.bot.db.commit()
+    @commands.is_owner()
+    async def move_images(self, ctx):
+        """Move images still stored in the database into the image store. """
+        moved = 0
+        while True:
+            rows = await self.bot.db.fetch('SELECT id, image from images WHERE hash is null and image is not null '
+                                           'limit 100')
+            if len(rows) == 0:
+                break
+
+            await self.bot.db.executemany('UPDATE images SET hash = ?, image = NULL WHERE id = ?',
+                                          [(await self.bot.images.put(image), id) for id, image in rows])
+            await self.bot.db.commit(wait=True)
+            moved += len(rows)
+
+        self.bot.problems.clear()
+        await ctx.send(f'Moved {moved} images. Run VACUUM on the database to give the space back. ')
+        self.logger.info(f'{ctx.author.id} moved {moved} images out of the database. ')
 
-        await ctx.send('Cleared images!')
+    @commands.command()
+    @commands.is_owner()
+    async def optimise_images(self, ctx):
+        """Optimise every stored image that hasn't been yet, keeping the originals. """
+        digests = [x[0] for x in await self.bot.db.fetch('SELECT DISTINCT hash from images WHERE hash is not null '
+                                                         'and original_hash is null')]
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(self.bot.config.get('image_processes', 2)) as pool:
+            results = await asyncio.gather(*[loop.run_in_executor(pool, images.optimise_stored, self.bot.images.directory,
+                                                                  digest, self.bot.images.max_width)
+                                             for digest in digests])
+
+        await self.bot.db.executemany('UPDATE images SET hash = ?, original_hash = ? WHERE hash = ? and '
+                                      'original_hash is null',
+                                      [(result[0], digest, digest) for digest, result in zip(digests, results)])
+        await self.bot.db.commit(wait=True)
+        self.bot.problems.clear()
+
+        # Bytes saved per problem
+        saved = {digest: result[1] - result[2] for digest, result in zip(digests, results)}
+        rows = await self.bot.db.fetch('SELECT potd_id, original_hash from images WHERE original_hash is not null')
+        per_problem = {}
+        for potd_id, original in rows:
+            if original in saved:
+                per_problem[potd_id] = per_problem.get(potd_id, 0) + saved[original]
+
+        report = '\n'.join(f'{potd_id}: {per_problem[potd_id]} bytes' for potd_id in sorted(per_problem))
+        await ctx.send(f'Optimised {len(digests)} images, saving {sum(saved.values())} bytes. ',
+                       file=discord.File(io.BytesIO(report.encode()), filename='saved.txt'))
+        self.logger.info(f'{ctx.author.id} optimised {len(digests)} images. ')
 
     @commands.command()
     @commands.check(authorised)
-    async def force_update(self, ctx, *, season: int):
-        try:
-            self.bot.get_cog('Interface').update_rankings(season)
-        except Exception as e:
-            await ctx.send(e)
+    async def force_update(self, ctx, *seasons: int):
+        """Rescore the given seasons, or every season if none are given. """
+        if not seasons:
+            seasons = [x[0] for x in await self.bot.db.fetch('SELECT id from seasons')]
+
+        interface = self.bot.get_cog('Interface')
+        results = await asyncio.gather(*[interface.update_rankings(season) for season in seasons],
+                                       return_exceptions=True)
+        for season, result in zip(seasons, results):
+            if isinstance(result, Exception):
+                await ctx.send(f'Season {season}: {result}')
 
         await ctx.send('Done!')
 
@@ -403,12 +677,11 @@ class Management(commands.Cog):
     @commands.check(authorised)
     async def change_answer(self, ctx, problem: shared.POTD, new_answer: int):
         # Get all attempts and current solves
-        cursor = self.bot.db.cursor()
+        db = self.bot.db
 
-        cursor.execute(
+        attempts = await db.fetch(
             'SELECT user_id, submission from attempts where potd_id = ? and official = ? order by submit_time',
             (problem.id, True))
-        attempts = cursor.fetchall()
 
         # Put attempts into a dictionary instead of a list
         attempts_dict = {}
@@ -418,9 +691,8 @@ class Management(commands.Cog):
             else:
                 attempts_dict[attempt[0]] = [attempt[1]]
 
-        cursor.execute('SELECT user, num_attempts from solves where problem_id = ? and official = ?',
-                       (problem.id, True))
-        solves = cursor.fetchall()
+        solves = await db.fetch('SELECT user, num_attempts from solves where problem_id = ? and official = ?',
+                                (problem.id, True))
         # Same with solves
         solves_dict = {}
         for solve in solves:
@@ -445,61 +717,53 @@ class Management(commands.Cog):
         submitted_old_only = old_solved_set - new_solved_set
 
         # DM people whom the change relates to
+        jobs = self.bot.jobs
         for user in submitted_new_only:
-            try:
-                await self.bot.get_user(user).send(f'The answer {new_answer} that you submitted on attempt '
-                                                   f'{new_solves[user]} is actually correct. ')
-                self.logger.info(
-                    f'[CHANGE ANS] [SUBMITTED NEW ONLY] User {user} solved after {new_solves[user]} attempts')
-            except Exception as e:
-                self.logger.warning(f'[CHANGE ANS] [SUBMITTED NEW ONLY] User {user} Exception when DMing {e}')
+            await jobs.enqueue('dm', user_id=user, content=f'The answer {new_answer} that you submitted on attempt '
+                                                           f'{new_solves[user]} is actually correct. ')
+            self.logger.info(f'[CHANGE ANS] [SUBMITTED NEW ONLY] User {user} solved after {new_solves[user]} attempts')
 
         for user in submitted_both_ans:
-            try:
-                await self.bot.get_user(user).send(
-                    f'The answer has changed; the answer {new_answer} that you submitted on attempt '
-                    f'{new_solves[user]} is actually correct. ')
-                self.logger.info(
-                    f'[CHANGE ANS] [SUBMITTED BOTH ANS] User {user} solved after {new_solves[user]} attempts')
-            except Exception as e:
-                self.logger.warning(f'[CHANGE ANS] [SUBMITTED BOTH ANS] User {user} Exception when DMing {e}')
+            await jobs.enqueue('dm', user_id=user, content=f'The answer has changed; the answer {new_answer} that '
+                                                           f'you submitted on attempt {new_solves[user]} is actually '
+                                                           f'correct. ')
+            self.logger.info(f'[CHANGE ANS] [SUBMITTED BOTH ANS] User {user} solved after {new_solves[user]} attempts')
 
         for user in submitted_old_only:
-            try:
-                await self.bot.get_user(user).send(
-                    f'The answer has changed; the previous answers you submitted are now incorrect. ')
-                self.logger.info(
-                    f'[CHANGE ANS] [SUBMITTED OLD ONLY] User {user} solved after {new_solves[user]} attempts')
-            except Exception as e:
-                self.logger.warning(f'[CHANGE ANS] [SUBMITTED OLD ONLY] User {user} Exception when DMing {e}')
+            await jobs.enqueue('dm', user_id=user, content='The answer has changed; the previous answers you '
+                                                           'submitted are now incorrect. ')
+            self.logger.info(f'[CHANGE ANS] [SUBMITTED OLD ONLY] User {user} no longer solved it')
 
         # Sort out roles - give to those in new_ans and take from those in old_ans
-        cursor.execute('SELECT server_id, solved_role_id from config where solved_role_id is not null')
-        servers = cursor.fetchall()
+        servers = [config for config in self.bot.guild_configs.all()
+                   if config.solved_role is not None or not self.bot.owns(config.server_id)
+                   and config.solved_role_id is not None]
 
-        for user in submitted_new_only:
-            await shared.assign_solved_role(servers, user, True, ctx)
-        for user in submitted_old_only:
-            await shared.assign_solved_role(servers, user, False, ctx)
+        for user in submitted_new_only | submitted_old_only:
+            for server in servers:
+                # For servers of other processes the process running the job checks they are a member
+                if not self.bot.owns(server.server_id) or server.guild.get_member(user) is not None:
+                    await jobs.enqueue('solved_role', shard=self.bot.shard_of(server.server_id),
+                                       server_id=server.server_id, user_id=user, give=user in submitted_new_only)
 
         # Update DB rankings
         # Remove all solves
-        cursor.execute('DELETE FROM solves where problem_id = ?', (problem.id,))
-        self.bot.db.commit()
+        await db.execute('DELETE FROM solves where problem_id = ?', (problem.id,))
 
         # Add the new rankings
-        cursor.executemany('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
-                           [
-                               (user, problem.id, new_solves[user], True)
-                               for user in new_solves])
-        self.bot.db.commit()
+        await db.executemany('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                             [
+                                 (user, problem.id, new_solves[user], True)
+                                 for user in new_solves])
 
         # Change the answer
-        cursor.execute('UPDATE problems SET answer = ? WHERE id = ?', (new_answer, problem.id))
-        self.bot.db.commit()
+        await db.execute('UPDATE problems SET answer = ? WHERE id = ?', (new_answer, problem.id))
+        await db.commit(wait=True)
+        await self.bot.answers.reload_problem(problem.id)
+        self.bot.problems.invalidate(problem.id)
 
         # Update rankings
-        self.bot.get_cog('Interface').update_rankings(problem.season)
+        await self.bot.get_cog('Interface').update_rankings(problem.season)
 
 
 async def setup(bot: openpotd.OpenPOTD):
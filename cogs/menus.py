@@ -16,7 +16,7 @@ class MenuManager(commands.Cog):
             await self.active_menus[menu_id].remove()
             del self.active_menus[menu_id]
 
-    async def new_menu(self, ctx: commands.Context, pages: list, cur_page: int = 0, timeout: int = 60):
+    async def new_menu(self, ctx: commands.Context, pages, cur_page: int = 0, timeout: int = 60):
         menu = Menu(ctx, pages, cur_page, timeout)
         await menu.open()
         self.active_menus[menu.message.id] = menu
@@ -52,8 +52,10 @@ class MenuManager(commands.Cog):
 
 
 class Menu:
+    """pages is either a list of embeds or something with a length and an async get(page) (such as
+    leaderboard.Pages) for pages that are rendered when they are first shown. """
 
-    def __init__(self, ctx: commands.Context, pages: list, cur_page: int = 0, timeout: int = 60):
+    def __init__(self, ctx: commands.Context, pages, cur_page: int = 0, timeout: int = 60):
         assert not len(pages) == 0
         self.ctx = ctx
         self.pages = pages
@@ -63,7 +65,7 @@ class Menu:
         self.owner = ctx.author.id
 
     async def open(self):
-        self.message = await self.ctx.send(embed=self.pages[self.cur_page])
+        self.message = await self.ctx.send(embed=await self.get_page(self.cur_page))
         await self.message.add_reaction('◀')
         await self.message.add_reaction('⏹')
         await self.message.add_reaction('▶')
@@ -71,12 +73,17 @@ class Menu:
     async def next_page(self, user_id):
         if self.cur_page < len(self.pages) - 1 and user_id == self.owner:
             self.cur_page += 1
-            await self.message.edit(embed=self.pages[self.cur_page])
+            await self.message.edit(embed=await self.get_page(self.cur_page))
 
     async def previous_page(self, user_id):
         if self.cur_page > 0 and user_id == self.owner:
             self.cur_page -= 1
-            await self.message.edit(embed=self.pages[self.cur_page])
+            await self.message.edit(embed=await self.get_page(self.cur_page))
+
+    async def get_page(self, page: int):
+        if isinstance(self.pages, list):
+            return self.pages[page]
+        return await self.pages.get(page)
 
     async def remove(self):
         try:
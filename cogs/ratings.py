@@ -1,50 +1,47 @@
 import discord
 from discord.ext import commands
-import sqlite3
 import logging
 import random
 
+import database
 import openpotd
 import shared
-import io
 import cogs.management as mgmt
 
 from dataclasses import dataclass
 from datetime import datetime
 
 
-def select_two_problems(conn: sqlite3.Connection, ctx, field):
-    cursor = conn.cursor()
+async def select_two_problems(db: database.Database, ctx, field):
     userid = ctx.author.id
 
     # Authorised members don't have to solve a problem to be able to rate it.
     if not mgmt.authorised(ctx):
-        cursor.execute('SELECT solves.problem_id FROM solves WHERE solves.id IN (SELECT id FROM solves WHERE'
-                       ' solves.user = ? ORDER BY RANDOM() LIMIT 1)', (userid,))
+        result = await db.fetch('SELECT solves.problem_id FROM solves WHERE solves.id IN (SELECT id FROM solves WHERE'
+                                ' solves.user = ? ORDER BY RANDOM() LIMIT 1)', (userid,))
     else:
-        cursor.execute('SELECT id from problems WHERE public = ? order by random() limit 1', (True,))
+        result = await db.fetch('SELECT id from problems WHERE public = ? order by random() limit 1', (True,))
 
-    first_problem_id = cursor.fetchall()[0][0]
-    first_problem = shared.POTD(first_problem_id, conn)
+    first_problem_id = result[0][0]
+    first_problem = await ctx.bot.problems.get(first_problem_id)
 
     # Same with the second problem
     if not mgmt.authorised(ctx):
-        cursor.execute('select problems.id from solves inner '
-                       'join problems on solves.problem_id = problems.id where solves.id in (select id from '
-                       f'solves where solves.user = ? and solves.problem_id != ?) order by abs(problems.{field} '
-                       '- ?) LIMIT 20;',
-                       (userid, first_problem_id,
-                        first_problem.difficulty_rating if field == 'difficulty_rating'
-                        else first_problem.coolness_rating))
+        result = await db.fetch('select problems.id from solves inner '
+                                'join problems on solves.problem_id = problems.id where solves.id in (select id from '
+                                f'solves where solves.user = ? and solves.problem_id != ?) order by abs(problems.{field} '
+                                '- ?) LIMIT 20;',
+                                (userid, first_problem_id,
+                                 first_problem.difficulty_rating if field == 'difficulty_rating'
+                                 else first_problem.coolness_rating))
     else:
-        cursor.execute(f'SELECT id from problems where public = ? order by abs(problems.{field} - ?) limit 20',
-                       (True,
-                        first_problem.difficulty_rating if field == 'difficulty_rating'
-                        else first_problem.coolness_rating))
+        result = await db.fetch(f'SELECT id from problems where public = ? order by abs(problems.{field} - ?) limit 20',
+                                (True,
+                                 first_problem.difficulty_rating if field == 'difficulty_rating'
+                                 else first_problem.coolness_rating))
 
-    result = cursor.fetchall()
     second_problem_id = random.choice(result)[0]
-    second_problem = shared.POTD(second_problem_id, conn)
+    second_problem = await ctx.bot.problems.get(second_problem_id)
 
     return first_problem, second_problem
 
@@ -76,23 +73,21 @@ class Ratings(commands.Cog):
             return
 
         choices: ChoiceInformation = self.waiting_for[ctx.author.id]
-        cursor = self.bot.db.cursor()
+        db = self.bot.db
 
         # Get number of ratings for each problem and calculate elo K value
-        cursor.execute('SELECT COUNT() FROM rating_choices WHERE problem_1_id = ? OR problem_2_id = ? AND type = ?',
-                       (choices.p1.id, choices.p1.id, choices.type))
-        number_1 = cursor.fetchall()[0][0]
+        number_1 = (await db.fetchone('SELECT COUNT() FROM rating_choices WHERE problem_1_id = ? OR problem_2_id = ? '
+                                      'AND type = ?', (choices.p1.id, choices.p1.id, choices.type)))[0]
         elo_k_1 = 10 + 100 * 10 ** (number_1 / -20)
-        cursor.execute('SELECT COUNT() FROM rating_choices WHERE problem_1_id = ? OR problem_2_id = ? AND type = ?',
-                       (choices.p2.id, choices.p2.id, choices.type))
-        number_2 = cursor.fetchall()[0][0]
+        number_2 = (await db.fetchone('SELECT COUNT() FROM rating_choices WHERE problem_1_id = ? OR problem_2_id = ? '
+                                      'AND type = ?', (choices.p2.id, choices.p2.id, choices.type)))[0]
         elo_k_2 = 10 + 100 * 10 ** (number_2 / -20)
 
         # Log rating
-        cursor.execute('INSERT INTO rating_choices (problem_1_id, problem_2_id, choice, type, rater) '
-                       'VALUES (?, ?, ?, ?, ?)',
-                       (choices.p1.id, choices.p2.id, rating, choices.type, ctx.author.id))
-        self.bot.db.commit()
+        await db.execute('INSERT INTO rating_choices (problem_1_id, problem_2_id, choice, type, rater) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (choices.p1.id, choices.p2.id, rating, choices.type, ctx.author.id))
+        await db.commit()
 
         # If it doesn't care, void
         if rating == 'd':
@@ -113,12 +108,14 @@ class Ratings(commands.Cog):
             new_2 = choices.p2.difficulty_rating + elo_k_2 * (s_value_2 - expected_2)
 
             # Update the database
-            cursor.executemany('UPDATE problems SET difficulty_rating = ? WHERE problems.id = ?',
-                               [
-                                   (new_1, choices.p1.id),
-                                   (new_2, choices.p2.id)
-                               ])
-            self.bot.db.commit()
+            await db.executemany('UPDATE problems SET difficulty_rating = ? WHERE problems.id = ?',
+                                 [
+                                     (new_1, choices.p1.id),
+                                     (new_2, choices.p2.id)
+                                 ])
+            await db.commit()
+            self.bot.problems.invalidate(choices.p1.id)
+            self.bot.problems.invalidate(choices.p2.id)
 
             old_1 = choices.p1.difficulty_rating
             old_2 = choices.p2.difficulty_rating
@@ -131,12 +128,14 @@ class Ratings(commands.Cog):
             new_2 = choices.p2.coolness_rating + elo_k_2 * (s_value_2 - expected_2)
 
             # Update the database
-            cursor.executemany('UPDATE problems SET coolness_rating = ? WHERE problems.id = ?',
-                               [
-                                   (new_1, choices.p1.id),
-                                   (new_2, choices.p2.id)
-                               ])
-            self.bot.db.commit()
+            await db.executemany('UPDATE problems SET coolness_rating = ? WHERE problems.id = ?',
+                                 [
+                                     (new_1, choices.p1.id),
+                                     (new_2, choices.p2.id)
+                                 ])
+            await db.commit()
+            self.bot.problems.invalidate(choices.p1.id)
+            self.bot.problems.invalidate(choices.p2.id)
 
             old_1 = choices.p1.coolness_rating
             old_2 = choices.p2.coolness_rating
@@ -160,28 +159,29 @@ class Ratings(commands.Cog):
             return
 
         try:
-            problem_1, problem_2 = select_two_problems(self.bot.db, ctx, 'difficulty_rating')
+            problem_1, problem_2 = await select_two_problems(self.bot.db, ctx, 'difficulty_rating')
         except IndexError as e:
             await ctx.send("You need to have solved at least two problems!")
             return
 
-        if len(problem_1.images) > 0:
-            await ctx.send('Which of the following two problems do you think is **harder**? \nProblem 1: ',
-                           file=discord.File(io.BytesIO(problem_1.images[0]), filename='image.png'))
+        images_1 = await problem_1.get_images()
+        if len(images_1) > 0:
+            await self.bot.images.send(ctx, images_1[0], 'image.png',
+                                       'Which of the following two problems do you think is **harder**? \nProblem 1: ')
         else:
             await ctx.send('Which of the following two problems do you think is **harder**? \nProblem 1: ')
 
-        for image in problem_1.images[1:]:
-            await ctx.send(file=discord.File(io.BytesIO(image), filename='image.png'))
+        for image in images_1[1:]:
+            await self.bot.images.send(ctx, image, 'image.png')
 
-        if len(problem_2.images) > 0:
-            await ctx.send('Problem 2: ',
-                           file=discord.File(io.BytesIO(problem_2.images[0]), filename='image.png'))
+        images_2 = await problem_2.get_images()
+        if len(images_2) > 0:
+            await self.bot.images.send(ctx, images_2[0], 'image.png', 'Problem 2: ')
         else:
             await ctx.send('Problem 2: ')
 
-        for image in problem_2.images[1:]:
-            await ctx.send(file=discord.File(io.BytesIO(image), filename='image.png'))
+        for image in images_2[1:]:
+            await self.bot.images.send(ctx, image, 'image.png')
 
         await ctx.send(f'Use `%rate OPTION` to submit your rating. Possible values for `OPTION` are: \n'
                        f'`1` if you thought the first problem was **harder**, \n'
@@ -198,28 +198,29 @@ class Ratings(commands.Cog):
             return
 
         try:
-            problem_1, problem_2 = select_two_problems(self.bot.db, ctx, 'coolness_rating')
+            problem_1, problem_2 = await select_two_problems(self.bot.db, ctx, 'coolness_rating')
         except IndexError as e:
             await ctx.send("You need to have solved at least two problems!")
             return
 
-        if len(problem_1.images) > 0:
-            await ctx.send('Which of the following two problems do you think is **cooler**? \nProblem 1: ',
-                           file=discord.File(io.BytesIO(problem_1.images[0]), filename='image.png'))
+        images_1 = await problem_1.get_images()
+        if len(images_1) > 0:
+            await self.bot.images.send(ctx, images_1[0], 'image.png',
+                                       'Which of the following two problems do you think is **cooler**? \nProblem 1: ')
         else:
             await ctx.send('Which of the following two problems do you think is **cooler**? \nProblem 1: ')
 
-        for image in problem_1.images[1:]:
-            await ctx.send(file=discord.File(io.BytesIO(image), filename='image.png'))
+        for image in images_1[1:]:
+            await self.bot.images.send(ctx, image, 'image.png')
 
-        if len(problem_2.images) > 0:
-            await ctx.send('Problem 2: ',
-                           file=discord.File(io.BytesIO(problem_2.images[0]), filename='image.png'))
+        images_2 = await problem_2.get_images()
+        if len(images_2) > 0:
+            await self.bot.images.send(ctx, images_2[0], 'image.png', 'Problem 2: ')
         else:
             await ctx.send('Problem 2: ')
 
-        for image in problem_2.images[1:]:
-            await ctx.send(file=discord.File(io.BytesIO(image), filename='image.png'))
+        for image in images_2[1:]:
+            await self.bot.images.send(ctx, image, 'image.png')
 
         await ctx.send(f'Use `%rate OPTION` to submit your rating. Possible values for `OPTION` are: \n'
                        f'`1` if you thought the first problem was **cooler**, \n'
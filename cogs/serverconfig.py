@@ -18,34 +18,26 @@ class ServerConfig(commands.Cog):
     @commands.check(in_guild)
     @commands.command(brief='Prints configuration for this server')
     async def config(self, ctx: commands.Context):
-        cursor = self.bot.db.cursor()
-        server_id = ctx.guild.id
+        result = self.bot.guild_configs.get(ctx.guild.id)
 
-        cursor.execute('SELECT * from config WHERE server_id = ?', (server_id,))
-        result = cursor.fetchall()
-
-        if len(result) == 0:
+        if result is None:
             await ctx.send('No config found! Use init to initialise your server\'s configuration. ')
         else:
             embed = discord.Embed()
-            result = result[0]
-            embed.description = f'`1. potd_channel:` {result[1]} [<#{result[1]}>]\n' \
-                                f'`2. ping_role_id:` {result[2]} [<@&{result[2]}>]\n' \
-                                f'`3. solved_role_id:` {result[3]} [<@&{result[3]}>]\n' \
-                                f'`4. otd_prefix:` {result[4]}\n' \
-                                f'`5. command_prefix:` {result[5]}\n' \
-                                f'`6. Bronze Role:` [<@&{result[6]}>]\n' \
-                                f'`7. Silver Role:` [<@&{result[7]}>]\n' \
-                                f'`8. Gold Role:` [<@&{result[8]}>]'
+            embed.description = f'`1. potd_channel:` {result.potd_channel} [<#{result.potd_channel}>]\n' \
+                                f'`2. ping_role_id:` {result.ping_role_id} [<@&{result.ping_role_id}>]\n' \
+                                f'`3. solved_role_id:` {result.solved_role_id} [<@&{result.solved_role_id}>]\n' \
+                                f'`4. otd_prefix:` {result.otd_prefix}\n' \
+                                f'`5. command_prefix:` {result.command_prefix}\n' \
+                                f'`6. Bronze Role:` [<@&{result.bronze_role_id}>]\n' \
+                                f'`7. Silver Role:` [<@&{result.silver_role_id}>]\n' \
+                                f'`8. Gold Role:` [<@&{result.gold_role_id}>]'
             await ctx.send(embed=embed)
 
     @commands.check(in_guild)
     @has_permissions(manage_guild=True)
     @commands.command(brief='Initialises the configuration (note this overwrites previous configuration)', name='init')
     async def init_cfg(self, ctx: commands.Context):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT exists (select * from config where server_id = ?)', (ctx.guild.id,))
-
         guild: discord.Guild = ctx.guild
         channels = guild.text_channels
 
@@ -76,18 +68,11 @@ class ServerConfig(commands.Cog):
         otd_prefix = self.bot.config['otd_prefix']
         command_prefix = self.bot.config['prefix']
 
-        if cursor.fetchall()[0][0]:
-            # Just overwrite the entry
-            cursor.execute('UPDATE config SET potd_channel = ?, ping_role_id = ?, solved_role_id = ?, otd_prefix = ?'
-                           ', command_prefix = ? WHERE server_id = ?',
-                           (qotd_channel_id, ping_role_id, solved_role_id, otd_prefix, command_prefix, guild.id))
-        else:
-            # Make a new entry
-            cursor.execute('INSERT INTO config (potd_channel, ping_role_id, solved_role_id, otd_prefix, '
-                           'command_prefix, server_id) VALUES (?, ?, ?, ?, ?, ?)',
-                           (qotd_channel_id, ping_role_id, solved_role_id, otd_prefix, command_prefix, guild.id))
-
-        self.bot.db.commit()
+        # Overwrites the entry if there is one
+        await self.bot.guild_configs.init(guild.id, potd_channel=qotd_channel_id, ping_role_id=ping_role_id,
+                                          solved_role_id=solved_role_id, otd_prefix=otd_prefix,
+                                          command_prefix=command_prefix)
+        await self.bot.db.commit()
 
     @commands.check(in_guild)
     @has_permissions(manage_guild=True)
@@ -95,61 +80,99 @@ class ServerConfig(commands.Cog):
     async def potd_channel(self, ctx, new: discord.TextChannel):
         if not new.guild.id == ctx.guild.id:
             await ctx.send("Please select a channel in **this** server! ")
-        cursor = self.bot.db.cursor()
-        cursor.execute('UPDATE config SET potd_channel = ? WHERE server_id = ?', (new.id, ctx.guild.id))
-        self.bot.db.commit()
+        await self.bot.guild_configs.set(ctx.guild.id, potd_channel=new.id)
+        await self.bot.db.commit()
         await ctx.send('Set successfully!')
 
     @commands.check(in_guild)
     @has_permissions(manage_guild=True)
     @commands.command(brief='Sets the role to ping')
     async def ping_role(self, ctx, new: discord.Role):
-        cursor = self.bot.db.cursor()
-        cursor.execute('UPDATE config SET ping_role_id = ? WHERE server_id = ?', (new.id, ctx.guild.id))
-        self.bot.db.commit()
+        await self.bot.guild_configs.set(ctx.guild.id, ping_role_id=new.id)
+        await self.bot.db.commit()
         await ctx.send('Set successfully!')
 
     @commands.check(in_guild)
     @has_permissions(manage_guild=True)
     @commands.command(brief='Sets the role contestants get after solving the POTD')
     async def solved_role(self, ctx, new: discord.Role):
-        cursor = self.bot.db.cursor()
-        cursor.execute('UPDATE config SET solved_role_id = ? WHERE server_id = ?', (new.id, ctx.guild.id))
-        self.bot.db.commit()
+        await self.bot.guild_configs.set(ctx.guild.id, solved_role_id=new.id)
+        await self.bot.db.commit()
+        await self.bot.guild_configs.chunk(ctx.guild.id)
         await ctx.send('Set successfully!')
 
     @commands.check(in_guild)
     @has_permissions(manage_guild=True)
     @commands.command(brief='Sets the OTD prefix (some people like calling it a "QOTD" rather than a "POTD")')
     async def otd_prefix(self, ctx, new):
-        cursor = self.bot.db.cursor()
-        cursor.execute('UPDATE config SET otd_prefix = ? WHERE server_id = ?', (new, ctx.guild.id))
-        self.bot.db.commit()
+        await self.bot.guild_configs.set(ctx.guild.id, otd_prefix=new)
+        await self.bot.db.commit()
         await ctx.send('Set successfully!')
 
     @commands.check(in_guild)
     @has_permissions(manage_guild=True)
     @commands.command(brief='Sets the server command prefix')
     async def command_prefix(self, ctx, new):
-        cursor = self.bot.db.cursor()
-        openpotd.prefixes[ctx.guild.id] = new
-        cursor.execute('UPDATE config SET command_prefix = ? WHERE server_id = ?', (new, ctx.guild.id))
-        self.bot.db.commit()
+        await self.bot.guild_configs.set(ctx.guild.id, command_prefix=new)
+        await self.bot.db.commit()
         await ctx.send('Set successfully!')
 
     @commands.check(in_guild)
     @has_permissions(manage_guild=True)
     @commands.command(brief='Sets the prize roles. ')
     async def medal_roles(self, ctx, bronze: discord.Role, silver: discord.Role, gold: discord.Role):
-        cursor = self.bot.db.cursor()
         if not (bronze.guild == ctx.guild and silver.guild == ctx.guild and gold.guild == ctx.guild):
             await ctx.send('Invalid roles!')
             return
-        cursor.execute('UPDATE config SET bronze_role_id = ?, silver_role_id = ?, gold_role_id = ? WHERE server_id = ?',
-                       (bronze.id, silver.id, gold.id, ctx.guild.id))
-        self.bot.db.commit()
+        await self.bot.guild_configs.set(ctx.guild.id, bronze_role_id=bronze.id, silver_role_id=silver.id,
+                                         gold_role_id=gold.id)
+        await self.bot.db.commit()
+        await self.bot.guild_configs.chunk(ctx.guild.id)
         await ctx.send('Set successfully!')
 
+    # Keep the channels and roles in the config cache up to date
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild: discord.Guild):
+        self.bot.guild_configs.resolve(guild.id)
+        await self.bot.guild_configs.chunk(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        self.bot.guild_configs.resolve(guild.id)
+        await self.bot.guild_configs.chunk(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.bot.guild_configs.resolve(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_unavailable(self, guild: discord.Guild):
+        self.bot.guild_configs.resolve(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role):
+        self.bot.guild_configs.resolve(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        self.bot.guild_configs.resolve(role.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        self.bot.guild_configs.resolve(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
+        self.bot.guild_configs.resolve(channel.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self.bot.guild_configs.resolve(channel.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        self.bot.guild_configs.resolve(after.guild.id)
+
 
 async def setup(bot: openpotd.OpenPOTD):
     await bot.add_cog(ServerConfig(bot))
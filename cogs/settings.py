@@ -1,16 +1,16 @@
 import discord
 from discord.ext import commands
 
+import database
 import openpotd
 
 
-def get_settings_embed(userid, cursor):
+async def get_settings_embed(userid, db: database.Database):
     embed = discord.Embed()
 
     # Retrieve nickname information
-    cursor.execute('SELECT nickname, anonymous, receiving_medal_roles from users where discord_id = ?',
-                   (userid,))
-    result = cursor.fetchall()
+    result = await db.fetch('SELECT nickname, anonymous, receiving_medal_roles from users where discord_id = ?',
+                            (userid,))
     if len(result) > 0:
         embed.add_field(name='Nickname', value=result[0][0])
         embed.add_field(name='Anonymous', value=result[0][1])
@@ -31,45 +31,43 @@ class Settings(commands.Cog):
             await ctx.send('Nickname is too long!')
             return
 
-        cursor = self.bot.db.cursor()
-        cursor.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
-                       (ctx.author.id, ctx.author.display_name, True))
-        cursor.execute('UPDATE users SET nickname = ? WHERE discord_id = ?', (new_nick, ctx.author.id))
-        self.bot.db.commit()
+        await self.bot.db.execute('''INSERT OR IGNORE INTO users (discord_id, nickname, anonymous) VALUES (?, ?, ?)''',
+                                  (ctx.author.id, ctx.author.display_name, True))
+        await self.bot.db.execute('UPDATE users SET nickname = ? WHERE discord_id = ?', (new_nick, ctx.author.id))
+        await self.bot.db.commit()
 
     @commands.command(name='self')
     async def userinfo(self, ctx):
-        await ctx.send(embed=get_settings_embed(ctx.author.id, self.bot.db.cursor()))
+        await ctx.send(embed=await get_settings_embed(ctx.author.id, self.bot.db))
 
     @commands.command()
     async def toggle_anon(self, ctx):
-        cursor = self.bot.db.cursor()
-        cursor.execute('SELECT anonymous from users where discord_id = ?', (ctx.author.id,))
-        result = cursor.fetchall()
+        result = await self.bot.db.fetch('SELECT anonymous from users where discord_id = ?', (ctx.author.id,))
 
         if len(result) == 0:
             await ctx.send('You are not registered.')
         else:
-            cursor.execute('UPDATE users SET anonymous = ? WHERE discord_id = ?', (not result[0][0], ctx.author.id))
-            self.bot.db.commit()
+            await self.bot.db.execute('UPDATE users SET anonymous = ? WHERE discord_id = ?',
+                                      (not result[0][0], ctx.author.id))
+            await self.bot.db.commit(wait=True)
 
         await ctx.send('Thank you! Your settings have been updated. Here are your new settings:',
-                       embed=get_settings_embed(ctx.author.id, cursor))
+                       embed=await get_settings_embed(ctx.author.id, self.bot.db))
 
     @commands.command()
     async def receive_medals(self, ctx, new_setting: bool):
-        cursor = self.bot.db.cursor()
-        cursor.execute('UPDATE users SET receiving_medal_roles = ? WHERE discord_id = ?', (new_setting, ctx.author.id))
-        self.bot.db.commit()
+        written = await self.bot.db.execute('UPDATE users SET receiving_medal_roles = ? WHERE discord_id = ?',
+                                            (new_setting, ctx.author.id))
+        await self.bot.db.commit(wait=True)
 
-        if cursor.rowcount == 1:
+        if written.rowcount == 1:
             await ctx.send('Changed successfully!')
         else:
             await ctx.send(f'No changes, either you are not registered or receive_medals '
                            f'was already set to {new_setting}. ')
 
         await ctx.send('Thank you! Your settings have been updated. Here are your new settings:',
-                       embed=get_settings_embed(ctx.author.id, cursor))
+                       embed=await get_settings_embed(ctx.author.id, self.bot.db))
 
 
 async def setup(bot: openpotd.OpenPOTD):
@@ -0,0 +1,247 @@
+"""Asynchronous access to the SQLite database. """
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+_STOP = object()
+
+
+class Written(typing.NamedTuple):
+    rowcount: int
+    lastrowid: int
+
+
+class _Job:
+    """A write waiting for the writer thread. fn is None for someone waiting for a commit. """
+    __slots__ = ('fn', 'future', 'loop', 'started', 'cancelled')
+
+    def __init__(self, fn, future: asyncio.Future, loop: asyncio.AbstractEventLoop):
+        self.fn = fn
+        self.future = future
+        self.loop = loop
+        self.started = False
+        self.cancelled = False
+
+
+class Database:
+    """All database access of the bot goes through here so that SQLite never blocks the event loop.
+
+    Writes run in order on a single writer thread and are committed in groups: a group takes in the writes
+    queued while it runs, for at most `commit_window` seconds or `commit_max_events` writes, and is committed
+    as soon as nothing else is waiting. A write only returns once its group is committed, and raises if the
+    commit fails. A write that times out before the writer gets to it is dropped, so a timeout means it never
+    happened. In strict mode commits are synced to disk before they return; otherwise a power cut (but not a
+    crash of the bot) can lose the last few. Reads run on a pool of reader connections and only see
+    committed data. """
+
+    def __init__(self, path: str, readers: int = 4, timeout: float = 10, commit_window: float = 0.05,
+                 commit_max_events: int = 100, strict: bool = False):
+        self.path = path
+        self.timeout = timeout
+        self.commit_window = commit_window
+        self.commit_max_events = commit_max_events
+        self.strict = strict
+        self.logger = logging.getLogger('database')
+
+        self.jobs = queue.Queue()
+        self.claim = threading.Lock()  # held while the writer takes a job or a caller gives up on one
+        self.writer = threading.Thread(target=self._run_writer, name='database writer', daemon=True)
+        self.readers = ThreadPoolExecutor(readers, thread_name_prefix='database reader')
+        self.local = threading.local()
+
+        # Metrics
+        self.reads_waiting = 0
+        self.max_queue_depth = 0
+        self.timeouts = 0
+        self.commits = 0
+        self.events_committed = 0
+
+    def start(self):
+        self.writer.start()
+
+    async def close(self):
+        """Commit everything still waiting and stop the writer. """
+        self.jobs.put(_STOP)
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.join)
+        self.readers.shutdown(wait=False)
+
+    @property
+    def queue_depth(self):
+        return self.jobs.qsize()
+
+    # Reads
+    async def fetch(self, sql: str, params: typing.Iterable = ()) -> list:
+        return await self._read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params: typing.Iterable = ()):
+        return await self._read(lambda conn: conn.execute(sql, params).fetchone())
+
+    # Writes
+    async def execute(self, sql: str, params: typing.Iterable = ()) -> Written:
+        def run(conn: sqlite3.Connection):
+            cursor = conn.execute(sql, params)
+            return Written(cursor.rowcount, cursor.lastrowid)
+
+        return await self._write(run)
+
+    async def executemany(self, sql: str, seq_of_params: typing.Iterable) -> Written:
+        def run(conn: sqlite3.Connection):
+            cursor = conn.executemany(sql, seq_of_params)
+            return Written(cursor.rowcount, cursor.lastrowid)
+
+        return await self._write(run)
+
+    async def transaction(self, fn: typing.Callable[[sqlite3.Connection], typing.Any]):
+        """Run fn(connection) on the writer thread and return what it returns. Everything fn writes is
+        applied atomically; if it raises, none of it is. """
+        return await self._write(fn)
+
+    async def commit(self, wait: bool = None):
+        """Wait for the writes made so far to be committed if wait is set. Writes that were awaited already
+        are. """
+        if wait:
+            await self._write(None)
+
+    async def _read(self, fn):
+        loop = asyncio.get_running_loop()
+        self.reads_waiting += 1
+        try:
+            return await self._wait(loop.run_in_executor(self.readers, self._run_reader, fn))
+        finally:
+            self.reads_waiting -= 1
+
+    async def _write(self, fn):
+        loop = asyncio.get_running_loop()
+        job = _Job(fn, loop.create_future(), loop)
+        self.jobs.put(job)
+        self.max_queue_depth = max(self.max_queue_depth, self.jobs.qsize())
+
+        done, _ = await asyncio.wait({job.future}, timeout=self.timeout)
+        if not done:
+            with self.claim:
+                job.cancelled = not job.started
+            if job.cancelled:
+                self._timed_out()
+                raise asyncio.TimeoutError
+            # The writer is already on it, so it will land
+        return await job.future
+
+    async def _wait(self, future):
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._timed_out()
+            raise
+
+    def _timed_out(self):
+        self.timeouts += 1
+        self.logger.warning(f'Query took longer than {self.timeout} seconds '
+                            f'[queue depth {self.queue_depth}, reads waiting {self.reads_waiting}]')
+
+    def _connect(self, **kwargs):
+        return sqlite3.connect(self.path, timeout=self.timeout, **kwargs)
+
+    def _run_reader(self, fn):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return fn(conn)
+
+    def _run_writer(self):
+        conn = self._connect(isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={"FULL" if self.strict else "NORMAL"}')
+
+        group, deadline = [], None  # (job, result) of the writes and commit waiters in the open transaction
+        while True:
+            if deadline is not None and self.jobs.empty():
+                # Nothing else to commit with
+                job = None
+            else:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    job = self.jobs.get(timeout=timeout)
+                except queue.Empty:
+                    job = None
+
+            if job is None or job is _STOP:
+                self._commit(conn, group)
+                group, deadline = [], None
+                if job is _STOP:
+                    conn.close()
+                    return
+                continue
+
+            with self.claim:
+                if job.cancelled:
+                    # The caller gave up before we got to it
+                    continue
+                job.started = True
+
+            if job.fn is None:
+                # Someone wants to know when the writes so far are committed
+                if conn.in_transaction:
+                    group.append((job, None))
+                else:
+                    self._resolve(job, None, None)
+                continue
+
+            try:
+                if not conn.in_transaction:
+                    conn.execute('BEGIN')
+                    deadline = time.monotonic() + self.commit_window
+                conn.execute('SAVEPOINT job')
+                try:
+                    result = job.fn(conn)
+                except BaseException:
+                    conn.execute('ROLLBACK TO job')
+                    raise
+                finally:
+                    conn.execute('RELEASE job')
+            except Exception as e:
+                # Nothing of it was written, so there is no need to wait for the commit
+                self._resolve(job, None, e)
+            else:
+                group.append((job, result))
+
+            if len(group) >= self.commit_max_events:
+                self._commit(conn, group)
+                group, deadline = [], None
+
+    def _commit(self, conn: sqlite3.Connection, group: list):
+        error = None
+        if conn.in_transaction:
+            try:
+                conn.execute('COMMIT')
+            except Exception as e:
+                self.logger.error(f'Failed to commit {len(group)} writes: {e}')
+                conn.execute('ROLLBACK')
+                error = e
+            else:
+                self.commits += 1
+                self.events_committed += len(group)
+
+        # Every write of a group that failed to commit is lost
+        for job, result in group:
+            self._resolve(job, result, error)
+
+    @staticmethod
+    def _resolve(job: _Job, result, exception):
+        def resolve():
+            if job.future.done():
+                return
+            if exception is not None:
+                job.future.set_exception(exception)
+            else:
+                job.future.set_result(result)
+
+        try:
+            job.loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            # The event loop has been closed
+            pass
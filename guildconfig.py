@@ -0,0 +1,130 @@
+"""In-memory copy of the config table. """
+import typing
+
+import discord
+
+import database
+
+COLUMNS = ('server_id', 'potd_channel', 'ping_role_id', 'solved_role_id', 'otd_prefix', 'command_prefix',
+           'bronze_role_id', 'silver_role_id', 'gold_role_id')
+
+
+class GuildConfig:
+    """The configuration of one server, together with the guild, channel and roles it refers to. Those are
+    None until resolved, and stay None if they don't exist. """
+
+    def __init__(self, row: tuple):
+        self.server_id: int = row[0]
+        self.potd_channel: typing.Optional[int] = row[1]
+        self.ping_role_id: typing.Optional[int] = row[2]
+        self.solved_role_id: typing.Optional[int] = row[3]
+        self.otd_prefix: typing.Optional[str] = row[4]
+        self.command_prefix: typing.Optional[str] = row[5]
+        self.bronze_role_id: typing.Optional[int] = row[6]
+        self.silver_role_id: typing.Optional[int] = row[7]
+        self.gold_role_id: typing.Optional[int] = row[8]
+
+        self.guild: typing.Optional[discord.Guild] = None
+        self.channel: typing.Optional[discord.abc.GuildChannel] = None
+        self.ping_role: typing.Optional[discord.Role] = None
+        self.solved_role: typing.Optional[discord.Role] = None
+        self.medal_roles: typing.List[typing.Optional[discord.Role]] = [None, None, None]  # bronze, silver, gold
+
+    @property
+    def medal_role_ids(self):
+        return [self.bronze_role_id, self.silver_role_id, self.gold_role_id]
+
+    @property
+    def needs_members(self):
+        """Whether the bot manages roles in this server, so has to know its members. """
+        return self.solved_role_id is not None or any(role_id is not None for role_id in self.medal_role_ids)
+
+    def resolve(self, guild: typing.Optional[discord.Guild]):
+        def get_role(role_id):
+            return guild.get_role(role_id) if guild is not None and role_id is not None else None
+
+        self.guild = guild
+        self.channel = guild.get_channel(self.potd_channel) \
+            if guild is not None and self.potd_channel is not None else None
+        self.ping_role = get_role(self.ping_role_id)
+        self.solved_role = get_role(self.solved_role_id)
+        self.medal_roles = [get_role(role_id) for role_id in self.medal_role_ids]
+
+
+class GuildConfigCache:
+    """Every row of the config table, loaded once at startup. All changes to the table must go through init or
+    set so that the cache stays right. Call resolve whenever a guild's channels or roles change. """
+
+    def __init__(self, db: database.Database, client: discord.Client):
+        self.db = db
+        self.client = client
+        self.configs = {}  # server id -> GuildConfig
+
+    async def load(self):
+        rows = await self.db.fetch(f'SELECT {", ".join(COLUMNS)} from config')
+        self.configs = {row[0]: GuildConfig(row) for row in rows}
+        self.resolve()
+
+    def get(self, server_id: int) -> typing.Optional[GuildConfig]:
+        return self.configs.get(server_id)
+
+    def all(self) -> typing.List[GuildConfig]:
+        return list(self.configs.values())
+
+    async def init(self, server_id: int, **values):
+        """Create a server's config with the given columns, or change them if it exists. Not committed. """
+        if server_id in self.configs:
+            await self.set(server_id, **values)
+            return
+        self._check(values)
+
+        columns = ['server_id', *values]
+        await self.db.execute(f'INSERT INTO config ({", ".join(columns)}) VALUES '
+                              f'({", ".join("?" * len(columns))})', (server_id, *values.values()))
+        self.created(server_id, **values)
+
+    async def set(self, server_id: int, **values):
+        """Change some columns of a server's config. Like the UPDATE it runs, does nothing if the server has no
+        config yet, since only init fills in everything a config needs. Not committed. """
+        self._check(values)
+        if server_id not in self.configs:
+            return
+
+        await self.db.execute(f'UPDATE config SET {", ".join(f"{column} = ?" for column in values)} '
+                              f'WHERE server_id = ?', (*values.values(), server_id))
+        self.apply(server_id, **values)
+
+    def created(self, server_id: int, **values):
+        """Cache the config of a server, after it was created in the database. """
+        self.configs.setdefault(server_id, GuildConfig((server_id,) + (None,) * (len(COLUMNS) - 1)))
+        self.apply(server_id, **values)
+
+    def apply(self, server_id: int, **values):
+        """Change the cached config of a server, after it was changed in the database. """
+        config = self.configs.get(server_id)
+        if config is None:
+            return
+
+        for column, value in values.items():
+            setattr(config, column, value)
+        config.resolve(self.client.get_guild(server_id))
+
+    @staticmethod
+    def _check(values: dict):
+        for column in values:
+            if column not in COLUMNS[1:]:
+                raise KeyError(column)
+
+    async def chunk(self, server_id: int = None):
+        """Fetch the members of servers that need them and haven't got them yet, for one server or all. """
+        configs = self.configs.values() if server_id is None else filter(None, [self.configs.get(server_id)])
+        for config in list(configs):
+            guild = self.client.get_guild(config.server_id)
+            if config.needs_members and guild is not None and not guild.chunked:
+                await guild.chunk()
+
+    def resolve(self, server_id: int = None):
+        """Look up the guild, channel and role objects again, for one server or all of them. """
+        configs = self.configs.values() if server_id is None else filter(None, [self.configs.get(server_id)])
+        for config in configs:
+            config.resolve(self.client.get_guild(config.server_id))
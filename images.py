@@ -0,0 +1,175 @@
+"""Problem images, stored on disk under the hash of their contents. """
+import asyncio
+import hashlib
+import io
+import os
+import time
+import typing
+import urllib.parse
+
+import discord
+
+
+class Image(typing.NamedTuple):
+    """An image of a problem. Images that haven't been moved out of the database yet have data and no hash. """
+    hash: typing.Optional[str]
+    data: typing.Optional[bytes]
+
+
+def optimise(data: bytes, max_width: int = None):
+    """Recompress an image as small as it goes without losing anything and scale it down to max_width if it is
+    wider. Returns the original data if it isn't an image Pillow can read.
+
+    PNGs are always re-encoded, so they lose their metadata even in the rare case that this makes them a few
+    bytes bigger; so are images of other formats that are scaled down. Other images, like JPEGs that are
+    narrow enough, are kept byte for byte with their metadata, since re-encoding them would lose quality. """
+    try:
+        return _recompress(data, max_width)
+    except OSError:
+        # Pillow raises UnidentifiedImageError (an OSError) for files that aren't images, and OSError for
+        # broken ones. linkimg takes any file, so those are stored as they are.
+        return data
+
+
+def _recompress(data: bytes, max_width: int = None):
+    # Pillow is only needed when images are linked or optimised
+    from PIL import Image as PILImage
+
+    with PILImage.open(io.BytesIO(data)) as image:
+        image_format = image.format
+        resized = max_width is not None and image.width > max_width
+        if image_format != 'PNG' and not resized:
+            # Anything else can't be recompressed without losing quality
+            return data
+
+        image.load()
+        if resized:
+            if image.mode in ('1', 'P'):
+                # These can only be scaled by picking pixels
+                image = image.convert('RGBA')
+            image = image.resize((max_width, round(image.height * max_width / image.width)), PILImage.LANCZOS)
+
+        # Keep only what is needed to draw the image the same way
+        image.info = {key: image.info[key] for key in ('transparency',) if key in image.info}
+
+        out = io.BytesIO()
+        if image_format == 'PNG':
+            image.save(out, 'PNG', optimize=True)
+        else:
+            image.save(out, image_format, quality=90)
+
+    return out.getvalue()
+
+
+def optimise_stored(directory: str, digest: str, max_width: int = None):
+    """Optimise an image in the store, for running in a worker process. Returns (new hash, size before, size
+    after). """
+    store = ImageStore(directory)
+    with open(store.path(digest), 'rb') as f:
+        data = f.read()
+    optimised = optimise(data, max_width)
+    if optimised is data:
+        return digest, len(data), len(data)
+    return store._put(optimised), len(data), len(optimised)
+
+
+def url_expiry(url: str, uploaded: float, max_age: float):
+    """When an attachment url stops working. Discord puts the expiry time of its signed urls in `ex`. """
+    expiry = uploaded + max_age
+    ex = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('ex')
+    if ex:
+        try:
+            expiry = min(expiry, int(ex[0], 16))
+        except ValueError:
+            pass
+    return expiry
+
+
+class ImageStore:
+    """Keeps every image once, however many problems use it; the images table only holds the hashes.
+
+    Images are also only uploaded to Discord once: the first send uploads the file and every later send
+    shows the uploaded attachment in an embed, until its url is about to expire. """
+
+    def __init__(self, directory: str, url_max_age: float = 12 * 60 * 60, max_width: int = None):
+        self.directory = directory
+        self.max_width = max_width
+        self.url_max_age = url_max_age
+        self.urls = {}  # hash -> (attachment url, expiry time)
+        self.upload_locks = {}  # hash -> lock held while the image is being uploaded
+
+        # Metrics
+        self.uploads = 0
+        self.reuses = 0
+
+    def path(self, digest: str):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    async def put(self, data: bytes) -> str:
+        """Store an image and return its hash. """
+        return await asyncio.get_running_loop().run_in_executor(None, self._put, data)
+
+    async def ingest(self, data: bytes):
+        """Optimise and store a new image, keeping the original as well. Returns (hash, original hash). """
+        optimised = await asyncio.get_running_loop().run_in_executor(None, optimise, data, self.max_width)
+        return await self.put(optimised), await self.put(data)
+
+    async def remove(self, digest: str):
+        def remove():
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+
+        await asyncio.get_running_loop().run_in_executor(None, remove)
+
+    async def send(self, destination: discord.abc.Messageable, image: Image, filename: str, content: str = None):
+        """Send an image, reusing an earlier upload of it if there is one that still works. """
+        if image.hash is None:
+            self.uploads += 1
+            return await destination.send(content, file=self.file(image, filename))
+
+        # If the image is being uploaded somewhere else right now, wait for that rather than uploading it twice
+        async with self.upload_locks.setdefault(image.hash, asyncio.Lock()):
+            url = self.url(image)
+            if url is None:
+                self.uploads += 1
+                message = await destination.send(content, file=self.file(image, filename))
+                if message.attachments:
+                    url = message.attachments[0].url
+                    self.urls[image.hash] = (url, url_expiry(url, time.time(), self.url_max_age))
+                return message
+
+        self.reuses += 1
+        embed = discord.Embed()
+        embed.set_image(url=url)
+        return await destination.send(content, embed=embed)
+
+    def url(self, image: Image):
+        """The url of an earlier upload of the image, or None if there isn't one that will still work for a
+        while. """
+        if image.hash not in self.urls:
+            return None
+        url, expiry = self.urls[image.hash]
+        if expiry - time.time() < 10 * 60:
+            del self.urls[image.hash]
+            return None
+        return url
+
+    def file(self, image: Image, filename: str) -> discord.File:
+        """A file to send; stored images are read straight from disk while uploading. """
+        if image.hash is not None:
+            return discord.File(self.path(image.hash), filename=filename)
+        return discord.File(io.BytesIO(image.data), filename=filename)
+
+    def _put(self, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write somewhere else first so that nobody ever reads half an image
+            temp = f'{path}.{os.getpid()}.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+        return digest
@@ -0,0 +1,139 @@
+"""Calls between the processes of a cluster over a Unix socket. """
+import asyncio
+import itertools
+import logging
+import os
+import pickle
+import struct
+
+logger = logging.getLogger('ipc')
+
+HEADER = struct.Struct('!I')
+
+
+class Peer:
+    """One end of a connection. Messages are pickled, so both ends must be processes of the same bot that
+    trust each other. `handlers` maps method names to coroutine functions, called with this peer followed
+    by the arguments of the call. """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handlers: dict):
+        self.reader = reader
+        self.writer = writer
+        self.handlers = handlers
+        self.ids = itertools.count()
+        self.pending = {}  # call id -> future of its result
+        self.lock = asyncio.Lock()
+        self.closed = asyncio.get_running_loop().create_future()
+        self.name = None  # set by whoever accepts the connection
+        self.tasks = set()  # the listener and running handlers
+
+    async def call(self, method: str, *args, **kwargs):
+        """Run a handler on the other end and return its result, or raise what it raised. """
+        call_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[call_id] = future
+        try:
+            await self._send(('call', call_id, method, args, kwargs))
+            return await future
+        finally:
+            self.pending.pop(call_id, None)
+
+    async def notify(self, method: str, *args, **kwargs):
+        """Run a handler on the other end without waiting for it. """
+        await self._send(('notify', None, method, args, kwargs))
+
+    async def _send(self, message: tuple):
+        if self.closed.done():
+            raise ConnectionError(f'Connection to {self.name} is closed')
+        data = pickle.dumps(message)
+        async with self.lock:
+            self.writer.write(HEADER.pack(len(data)) + data)
+            await self.writer.drain()
+
+    async def listen(self):
+        """Handle messages until the connection closes. """
+        try:
+            while True:
+                size, = HEADER.unpack(await self.reader.readexactly(HEADER.size))
+                kind, call_id, *rest = pickle.loads(await self.reader.readexactly(size))
+                if kind == 'result':
+                    future = self.pending.get(call_id)
+                    ok, value = rest
+                    if future is None or future.done():
+                        # The caller gave up
+                        continue
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+                else:
+                    self._start(self._handle(kind, call_id, *rest))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.close()
+
+    def _start(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _handle(self, kind: str, call_id: int, method: str, args: tuple, kwargs: dict):
+        try:
+            result, ok = await self.handlers[method](self, *args, **kwargs), True
+        except Exception as e:
+            if kind == 'notify':
+                logger.warning(f'{method} from {self.name} failed: {e}')
+                return
+            result, ok = e, False
+        if kind == 'notify':
+            return
+
+        try:
+            pickle.dumps(result)
+        except Exception:
+            # Not everything survives the trip, e.g. exceptions holding a response
+            result, ok = RuntimeError(f'{type(result).__name__}: {result}'), False
+        try:
+            await self._send(('result', call_id, ok, result))
+        except ConnectionError:
+            pass
+
+    def close(self):
+        if not self.closed.done():
+            self.closed.set_result(None)
+            self.writer.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f'Connection to {self.name} closed'))
+
+
+async def serve(path: str, handlers: dict):
+    """Accept connections on the socket at `path`, handling their calls with `handlers`. """
+    if os.path.exists(path):
+        os.unlink(path)
+
+    async def accept(reader, writer):
+        await Peer(reader, writer, handlers).listen()
+
+    server = await asyncio.start_unix_server(accept, path)
+    os.chmod(path, 0o600)
+    return server
+
+
+async def connect(path: str, handlers: dict, retry: float = 0.5, timeout: float = 60):
+    """Connect to the socket at `path`, waiting up to `timeout` seconds for it to appear. """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            if loop.time() > deadline:
+                raise
+            await asyncio.sleep(retry)
+
+    peer = Peer(reader, writer, handlers)
+    peer._start(peer.listen())
+    return peer
@@ -0,0 +1,155 @@
+"""Durable queue of Discord side effects that nobody should have to wait for. """
+import asyncio
+import json
+import logging
+import time
+
+import database
+
+
+class JobQueue:
+    """Jobs are rows of the jobs table, so whatever isn't done yet is picked up again after a restart. Each kind
+    of job has a handler, called with the job's payload as keyword arguments by one of `workers` workers. A
+    handler that raises is retried after backoff ** attempts seconds, up to max_attempts times. Jobs with a
+    key are dropped while another job with the same key is waiting to run.
+
+    In cluster mode every process has a queue on the same table. Jobs enqueued for a shard only run in the
+    process with that shard (`shards`), and the others only in the leader. """
+
+    def __init__(self, db: database.Database, workers: int = 4, max_attempts: int = 5, backoff: float = 2,
+                 shards: list = None, leader: bool = True):
+        self.db = db
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.logger = logging.getLogger('jobs')
+
+        if shards is None:
+            self.mine = ''
+        else:
+            self.mine = f' AND (shard IN ({", ".join(map(str, shards))}){" OR shard IS NULL" if leader else ""})'
+
+        self.handlers = {}  # kind -> coroutine function
+        self.running = set()  # ids of jobs given to a worker
+        self.queue = None
+        self.wakeup = None
+        self.tasks = []
+        self.pending = set()  # wakeups waiting for a commit
+
+        # Metrics
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.total_latency = 0.0  # seconds from being enqueued to being done, over all completed jobs
+        self.max_latency = 0.0
+
+    def register(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    def start(self):
+        if self.tasks:
+            return
+        self.queue = asyncio.Queue(self.workers)
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.dispatch())] + \
+                     [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    def stop(self):
+        # Unfinished jobs stay in the table
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def enqueue(self, kind: str, key: str = None, delay: float = 0, shard: int = None, **payload):
+        """Add a job that runs at least `delay` seconds from now, once it has been committed, in the process
+        with `shard` if given. Returns False if it was dropped because a job with the same key is waiting. """
+        now = time.time()
+        written = await self.db.execute('INSERT OR IGNORE INTO jobs (kind, key, payload, created, run_at, shard) '
+                                        'VALUES (?, ?, ?, ?, ?, ?)',
+                                        (kind, key, json.dumps(payload), now, now + delay, shard))
+        if written.rowcount == 0:
+            self.deduplicated += 1
+            return False
+        task = asyncio.get_running_loop().create_task(self._wake_on_commit())
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return True
+
+    async def depth(self):
+        return (await self.db.fetchone(f'SELECT count() from jobs WHERE TRUE{self.mine}'))[0]
+
+    async def _wake_on_commit(self):
+        await self.db.commit(wait=True)
+        self.wake()
+
+    def wake(self):
+        """Look for due jobs now. """
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def dispatch(self):
+        while True:
+            try:
+                await self._dispatch_due()
+            except Exception as e:
+                # Most likely the database is busy; try again shortly instead of stopping every job
+                self.logger.error(f'Dispatching jobs: {e}')
+                await asyncio.sleep(1)
+
+    async def _dispatch_due(self):
+        self.wakeup.clear()
+        now = time.time()
+        due = [row for row in await self.db.fetch('SELECT id, kind, payload, attempts, created from jobs '
+                                                  f'WHERE run_at <= ?{self.mine} order by run_at limit ?',
+                                                  (now, len(self.running) + self.workers))
+               if row[0] not in self.running]
+
+        for row in due:
+            # From now on another job with the same key can wait behind this one
+            await self.db.execute('UPDATE jobs SET key = NULL WHERE id = ?', (row[0],))
+            self.running.add(row[0])
+            await self.queue.put(row)
+
+        if not due:
+            # Sleep until the next job is due or something changes
+            result = await self.db.fetchone(f'SELECT min(run_at) from jobs WHERE run_at > ?{self.mine}', (now,))
+            timeout = 60 if result[0] is None else min(result[0] - now, 60)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def work(self):
+        while True:
+            job_id, kind, payload, attempts, created = await self.queue.get()
+            try:
+                await self._run(job_id, kind, payload, attempts, created)
+            except Exception as e:
+                # The job stays in the table, so it is run again
+                self.logger.error(f'Job {job_id} ({kind}): {e}')
+            finally:
+                self.running.discard(job_id)
+                self.wakeup.set()
+
+    async def _run(self, job_id: int, kind: str, payload: str, attempts: int, created: float):
+        try:
+            await self.handlers[kind](**json.loads(payload))
+        except Exception as e:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                self.failed += 1
+                self.logger.warning(f'Job {job_id} ({kind} {payload}) failed for good: {e}')
+                await self.db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            else:
+                self.logger.info(f'Job {job_id} ({kind}) failed, retrying: {e}')
+                await self.db.execute('UPDATE jobs SET attempts = ?, run_at = ? WHERE id = ?',
+                                      (attempts, time.time() + self.backoff ** attempts, job_id))
+        else:
+            latency = time.time() - created
+            self.completed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            await self.db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+        # The dispatcher only sees committed rows, so it could hand out the job again before this
+        await self.db.commit(wait=True)
@@ -0,0 +1,97 @@
+"""Cached, lazily rendered leaderboard pages. """
+import asyncio
+
+import discord
+
+import database
+
+PAGE_SIZE = 20
+
+
+def render(title: str, rankings: list, highlight: int = None):
+    embed = discord.Embed(title=title)
+    embed.description = '\n'.join([f'**`{rank}`. {score:.2f} [<@!{user_id}>]**' if user_id == highlight
+                                   else f'`{rank}`. {score:.2f} [<@!{user_id}>]' for (rank, score, user_id) in rankings])
+    return embed
+
+
+class Leaderboard:
+    """Leaderboard pages of every season, cached until the scores of the season change. Call invalidate
+    whenever rankings of a season are written. Pages are fetched by rank rather than offset, so each one
+    is a short walk of the (season_id, rank) index. """
+
+    def __init__(self, db: database.Database):
+        self.db = db
+        self.versions = {}  # season id -> scoring version
+        self.cache = {}  # season id -> (version, number of ranked people, {page number: embed})
+        self.pending = set()  # bumps waiting for a commit, kept so they aren't garbage collected
+
+    def invalidate(self, season: int):
+        self._bump(season)
+        # Readers only see committed scores, so pages rendered before the commit would be stale as well
+        task = asyncio.get_running_loop().create_task(self._bump_on_commit(season))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def size(self, season: int):
+        """Number of people ranked in the season. """
+        return (await self._entry(season))[1]
+
+    async def page(self, season: int, season_name: str, page: int):
+        version, size, pages = await self._entry(season)
+        if page not in pages:
+            rankings = await self.fetch(season, page * PAGE_SIZE)
+            embed = render(f'{season_name} rankings - Page {page + 1}' if size > PAGE_SIZE
+                           else f'{season_name} rankings', rankings)
+            if self.versions.get(season, 0) != version:
+                # Scores changed while we were reading
+                return embed
+            pages[page] = embed
+        return pages[page]
+
+    async def around(self, season: int, season_name: str, user_id: int):
+        """A page centred on the rank of user_id, or None if they aren't ranked. """
+        result = await self.db.fetchone('SELECT rank from rankings where season_id = ? and user_id = ?',
+                                        (season, user_id))
+        if result is None or result[0] is None:
+            return None
+        rankings = await self.fetch(season, max(result[0] - PAGE_SIZE // 2, 0))
+        return render(f'{season_name} rankings around you', rankings, user_id)
+
+    async def fetch(self, season: int, after: int):
+        """The PAGE_SIZE rankings after rank `after`. """
+        return await self.db.fetch('SELECT rank, score, user_id from rankings where season_id = ? and rank > ? '
+                                   'order by rank limit ?', (season, after, PAGE_SIZE))
+
+    def _bump(self, season: int):
+        self.versions[season] = self.versions.get(season, 0) + 1
+        self.cache.pop(season, None)
+
+    async def _bump_on_commit(self, season: int):
+        await self.db.commit(wait=True)
+        self._bump(season)
+
+    async def _entry(self, season: int):
+        version = self.versions.get(season, 0)
+        if season not in self.cache or self.cache[season][0] != version:
+            size = (await self.db.fetchone('SELECT count() from rankings where season_id = ?', (season,)))[0]
+            if self.versions.get(season, 0) != version:
+                return version, size, {}
+            self.cache[season] = (version, size, {})
+        return self.cache[season]
+
+
+class Pages:
+    """The pages of one season's leaderboard, for a menu. """
+
+    def __init__(self, leaderboard: Leaderboard, season: int, season_name: str, size: int):
+        self.leaderboard = leaderboard
+        self.season = season
+        self.season_name = season_name
+        self.size = size
+
+    def __len__(self):
+        return max((self.size + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+
+    async def get(self, page: int):
+        return await self.leaderboard.page(self.season, self.season_name, page)
@@ -0,0 +1,109 @@
+"""Versioned changes to the database schema, applied at startup. """
+import logging
+import sqlite3
+
+import database
+
+logger = logging.getLogger('migrations')
+
+# Migration n brings the database from user_version n - 1 to n. Only ever append to this list.
+MIGRATIONS = [
+    ('Add indexes for hot queries', [
+        'CREATE INDEX IF NOT EXISTS solves_problem_user ON solves (problem_id, user)',
+        'CREATE INDEX IF NOT EXISTS solves_problem_official ON solves (problem_id, official)',
+        'CREATE INDEX IF NOT EXISTS attempts_potd_user_official ON attempts (potd_id, user_id, official)',
+        'CREATE INDEX IF NOT EXISTS rankings_season_rank ON rankings (season_id, rank)',
+        'CREATE INDEX IF NOT EXISTS images_potd ON images (potd_id)',
+        'CREATE INDEX IF NOT EXISTS stats_messages_potd ON stats_messages (potd_id)',
+        'CREATE INDEX IF NOT EXISTS problems_date ON problems (date)',
+        'CREATE INDEX IF NOT EXISTS problems_season_date ON problems (season, date)',
+        'CREATE INDEX IF NOT EXISTS rating_choices_problem_1 ON rating_choices (problem_1_id)',
+        'CREATE INDEX IF NOT EXISTS rating_choices_problem_2 ON rating_choices (problem_2_id)',
+    ]),
+    # Seasons used to be scored by hard-coded season number: 11 was flat, later ones used weighted_score_new
+    ('Give every season a scoring rule', [
+        'ALTER TABLE seasons ADD COLUMN scoring_rule TEXT',
+        "UPDATE seasons SET scoring_rule = CASE WHEN id < 11 THEN 'weighted' WHEN id = 11 THEN 'flat' "
+        "ELSE 'weighted_new' END",
+    ]),
+    # New images only have a hash; the move_images command moves the old ones out of the database
+    ('Store images on disk', [
+        'ALTER TABLE images ADD COLUMN hash TEXT',
+        'CREATE INDEX IF NOT EXISTS images_hash ON images (hash)',
+    ]),
+    # hash is what gets sent, original_hash what was uploaded
+    ('Keep the original of optimised images', [
+        'ALTER TABLE images ADD COLUMN original_hash TEXT',
+        'CREATE INDEX IF NOT EXISTS images_original_hash ON images (original_hash)',
+    ]),
+    # People who still have to lose the solved role, see roles.RoleReset
+    ('Keep track of solved role resets', [
+        'CREATE TABLE IF NOT EXISTS role_resets (server_id INTEGER NOT NULL, role_id INTEGER NOT NULL, '
+        'user_id INTEGER NOT NULL, PRIMARY KEY (role_id, user_id))',
+    ]),
+    # See jobs.JobQueue
+    ('Add the job queue', [
+        'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, key TEXT UNIQUE, '
+        'payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, run_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS jobs_run_at ON jobs (run_at)',
+    ]),
+    # See scheduler.Scheduler
+    ('Remember when scheduled jobs last ran', [
+        'CREATE TABLE IF NOT EXISTS schedule_runs (name TEXT PRIMARY KEY, last_run REAL NOT NULL)',
+    ]),
+    # In cluster mode jobs about a server run in the process that has its shard, see cluster.py
+    ('Route jobs to shards', [
+        'ALTER TABLE jobs ADD COLUMN shard INTEGER',
+    ]),
+]
+
+# Queries run on every submission, post or leaderboard view, with example parameters. %query_plans shows how
+# SQLite runs each of them, so add new hot queries here.
+HOT_QUERIES = [
+    ('Previous attempts', 'SELECT count() from attempts where user_id = ? and potd_id = ?', (0, 0)),
+    ('Official attempts', 'SELECT COUNT(1) from attempts WHERE user_id = ? and potd_id = ? and official = ?',
+     (0, 0, True)),
+    ('Solved before', 'SELECT exists (select 1 from solves where problem_id = ? and solves.user = ?)', (0, 0)),
+    ('Solve counts', 'SELECT count(1) from solves where problem_id = ? and official = ?', (0, True)),
+    ('Season solves', 'select solves.user, solves.problem_id, solves.num_attempts from problems left join solves '
+                      'where problems.season = ? and problems.id = solves.problem_id and official = ? '
+                      'order by solves.problem_id, solves.id', (0, True)),
+    ('Leaderboard page', 'SELECT rank, score, user_id from rankings where season_id = ? and rank > ? '
+                         'order by rank limit ?', (0, 0, 20)),
+    ('Rank', 'SELECT rank, score from rankings where season_id = ? and user_id = ?', (0, 0)),
+    ('Images', 'SELECT hash, image from images WHERE potd_id = ? order by id', (0,)),
+    ('Stats messages', 'SELECT server_id, channel_id, message_id from stats_messages WHERE potd_id = ?', (0,)),
+    ('Due jobs', 'SELECT id, kind, payload, attempts, created from jobs WHERE run_at <= ? order by run_at limit ?',
+     (0, 4)),
+    ('Problem by date', 'SELECT id from problems where date = ?', ('2000-01-01',)),
+    ('Season order', 'SELECT COUNT() from problems WHERE problems.season = ? AND problems.date < ?',
+     (0, '2000-01-01')),
+    ('Rating count', 'SELECT COUNT() FROM rating_choices WHERE problem_1_id = ? OR problem_2_id = ? AND type = ?',
+     (0, 0, 'DIFF')),
+]
+
+
+async def migrate(db: database.Database):
+    """Apply every migration the database hasn't had yet. Each one is applied atomically together with the
+    new user_version, so a failed migration leaves the database as it was. """
+    for version, (description, statements) in enumerate(MIGRATIONS, start=1):
+        def apply(conn: sqlite3.Connection):
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                return False
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+            return True
+
+        if await db.transaction(apply):
+            await db.commit(wait=True)
+            logger.info(f'Applied migration {version}: {description}')
+
+
+async def query_plans(db: database.Database):
+    """Returns (name, [plan lines]) for every hot query. """
+    plans = []
+    for name, sql, params in HOT_QUERIES:
+        result = await db.fetch(f'EXPLAIN QUERY PLAN {sql}', params)
+        plans.append((name, [x[3] for x in result]))
+    return plans
@@ -1,39 +1,97 @@
+import asyncio
 import logging
+import os
 import re
-import threading
 import time
 import traceback
 
 import discord
-import schedule
 from discord.ext import commands
 from ruamel import yaml
 
-import sqlite3
+import answers
+import database
+import guildconfig
+import images
+import jobs
+import migrations
+import problems
+import roles
+import scheduler
+import scoring
 
 cfgfile = open("config/config.yml")
 config = yaml.safe_load(cfgfile)
 
-prefixes = {}
-
 
 def get_prefix(bot, message: discord.Message):
-    if message.guild is None or message.guild.id not in prefixes:
+    guild_config = bot.guild_configs.get(message.guild.id) if message.guild is not None else None
+    if guild_config is None or guild_config.command_prefix is None:
         return config['prefix']
     else:
-        return prefixes[message.guild.id]
+        return guild_config.command_prefix
+
+
+def gateway_intents(profile: str):
+    """What to ask Discord for. The lean profile only gets what the bot uses: commands and answers, reactions
+    for menus, and guild members, which are only cached for servers with solved or medal roles. """
+    if profile == 'full':
+        return discord.Intents.all()
+    if profile != 'lean':
+        raise ValueError(f'Unknown gateway profile {profile}')
+
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.members = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    intents.guild_reactions = True
+    intents.dm_reactions = True
+    return intents
+
+
+def resident_memory():
+    """Resident memory of the bot in MiB, or None if it can't be read. """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def read_token():
+    with open(f'config/{config["token"]}') as tokfile:
+        return tokfile.readline().rstrip('\n')
 
 
 class OpenPOTD(commands.Bot):
-    def __init__(self):
-        intents = discord.Intents.all()
+    def __init__(self, cluster=None):
+        """Pass a cluster.ShardLink to run as one process of a cluster (as a cluster.ShardedBot). """
+        self.cluster = cluster
+        self.started = time.monotonic()
+        self.startup_time = None
+        self.gateway_profile = config.get('gateway_profile', 'lean')
 
         allowed_mentions = discord.AllowedMentions.all()
         allowed_mentions.everyone = False
 
-        super().__init__(get_prefix, intents=intents, allowed_mentions=allowed_mentions)
+        shards = {} if cluster is None else {'shard_ids': cluster.shard_ids, 'shard_count': cluster.shard_count}
+        super().__init__(get_prefix, intents=gateway_intents(self.gateway_profile), allowed_mentions=allowed_mentions,
+                         chunk_guilds_at_startup=self.gateway_profile == 'full', **shards)
         self.config = config
-        self.db = sqlite3.connect('data/data.db')
+        if cluster is None:
+            self.db = database.Database('data/data.db', config.get('database_readers', 4),
+                                        config.get('database_timeout', 10), config.get('commit_window', 0.05),
+                                        config.get('commit_max_events', 100),
+                                        config.get('commit_durability', 'relaxed') == 'strict')
+            self.scores = scoring.ScoreKeeper(self.db, config['base_points'],
+                                              config.get('scoring_rule', 'weighted_new'))
+        else:
+            # The coordinator has the database writer and the scores
+            self.db = cluster.database('data/data.db', config.get('database_readers', 4),
+                                       config.get('database_timeout', 10))
+            self.scores = cluster.scores
         logging.basicConfig(level=logging.INFO, format='[%(name)s %(levelname)s] %(message)s')
         self.logger = logging.getLogger('bot')
         try:
@@ -44,23 +102,72 @@ class OpenPOTD(commands.Bot):
         except IOError:
             self.blacklist = []
 
-        # Populate prefixes
-        cursor = self.db.cursor()
-        cursor.execute('SELECT server_id, command_prefix FROM config WHERE command_prefix IS NOT NULL')
-        global prefixes
-        prefixes = {x[0]: x[1] for x in cursor.fetchall()}
+        self.answers = answers.AnswerIndex(self.db)
+        self.guild_configs = guildconfig.GuildConfigCache(self.db, self)
+        self.problems = problems.ProblemCache(self.db, config.get('problem_cache_size', 64))
+        self.images = images.ImageStore(config.get('image_directory', 'data/images'),
+                                        config.get('image_url_max_age', 12 * 60 * 60), config.get('image_max_width'))
+        self.role_resets = roles.RoleReset(self.db, self.http, self.guild_configs, config.get('role_reset_rate', 5),
+                                           config.get('role_reset_concurrency', 10),
+                                           config.get('role_recreate_threshold'), self.owns)
+
+        # Side effects that can happen in the background
+        self.jobs = jobs.JobQueue(self.db, config.get('job_workers', 4), config.get('job_max_attempts', 5),
+                                  config.get('job_backoff', 2), None if cluster is None else cluster.shard_ids,
+                                  cluster is None or cluster.leader)
+        self.jobs.register('solved_role', self.role_resets.solved_role)
+        self.jobs.register('dm', self.send_dm)
+        self.jobs.register('message', self.send_message)
+
+        # Daily posting and other jobs at set times. In a cluster the coordinator runs them.
+        self.scheduler = scheduler.Scheduler(self.db)
 
         # Set refreshing status
         self.posting_problem = False
 
-    async def on_ready(self):
-        self.logger.info('Connected to Discord')
-        self.logger.info('Guilds  : {}'.format(len(self.guilds)))
-        self.logger.info('Users   : {}'.format(len(set(self.get_all_members()))))
-        self.logger.info('Channels: {}'.format(len(list(self.get_all_channels()))))
-        await self.set_presence(self.config['presence'])
+        # Set once the guilds are known. Anything that needs channels or roles, like the daily post, waits for it.
+        self.gateway_ready = asyncio.Event()
+        self.startup_phases = {}  # name -> seconds
+        self.background = set()  # tasks nobody awaits
+
+    async def timed(self, name: str, coro):
+        start = time.monotonic()
+        await coro
+        self.startup_phases[name] = time.monotonic() - start
+
+    async def setup_hook(self):
+        """Everything that doesn't need the gateway, done once before connecting to it. """
+        start = time.monotonic()
+        if self.cluster is None:
+            self.db.start()
+            await self.timed('database', migrations.migrate(self.db))
+        else:
+            await self.timed('coordinator', self.cluster.connect(self))
+
+        # Fill the caches while the cogs load. None of them need each other.
+        await asyncio.gather(
+            self.timed('guild configs', self.guild_configs.load()),
+            self.timed('answers', self.answers.load()),
+            self.timed('season scores', self.scores.warm()),
+            # Finish taking away solved roles if we were stopped halfway
+            self.timed('role resets', self.role_resets.resume()),
+            self.timed('cogs', self.load_cogs()),
+        )
+
+        # Every handler and scheduled job is registered once the cogs are loaded
+        self.jobs.start()
+        if self.cluster is None:
+            await self.timed('schedule', self.scheduler.start())
+        else:
+            await self.timed('schedule', self.cluster.ready())
+        self.logger.info(f'Schedule: {", ".join(f"{job.name} at {job.at}" for job in self.scheduler.jobs.values())}')
+        self.logger.info(f'Set up in {time.monotonic() - start:.3f}s: '
+                         f'{", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.startup_phases.items())}')
 
+    async def load_cogs(self):
         for cog in self.config['cogs']:
+            if cog in self.extensions:
+                continue
             try:
                 await self.load_extension(cog)
             except Exception:
@@ -68,13 +175,70 @@ class OpenPOTD(commands.Bot):
             else:
                 self.logger.info('Loaded cog {}.'.format(cog))
 
-        self.logger.info(f'Schedule: {schedule.jobs}')
+    async def on_ready(self):
+        """Called again whenever the bot reconnects with a new session, so only cheap things go here. """
+        start = time.monotonic()
+        self.guild_configs.resolve()
+        self.gateway_ready.set()
+        self.logger.info(f'Connected to Discord: {len(self.guilds)} guilds, '
+                         f'{sum(guild.member_count or 0 for guild in self.guilds)} members, server configs resolved in '
+                         f'{time.monotonic() - start:.3f}s')
+        if self.startup_time is None:
+            self.startup_time = time.monotonic() - self.started
+            memory = resident_memory()
+            self.logger.info(f'Gateway profile {self.gateway_profile}: ready after {self.startup_time:.1f}s using '
+                             f'{"?" if memory is None else f"{memory:.0f}"} MiB')
+        task = asyncio.create_task(self.guild_configs.chunk())
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        await self.set_presence(self.config['presence'])
+
+    async def close(self):
+        self.jobs.stop()
+        self.scheduler.stop()
+        await super().close()
+        # Make sure nothing waiting for a group commit is lost
+        await self.db.close()
+        if self.cluster is not None and self.cluster.peer is not None:
+            self.cluster.peer.close()
+
+    def owns(self, server_id: int):
+        """Whether this process has the server's shard. """
+        return self.cluster is None or self.shard_of(server_id) in self.cluster.shard_ids
+
+    def shard_of(self, server_id: int):
+        """The shard of a server if running as a cluster, for jobs that have to run in the process that has it. """
+        return None if self.cluster is None else (server_id >> 22) % self.cluster.shard_count
+
+    async def fan_out(self, cog: str, method: str, *args):
+        """Call a method of a cog in every process of the cluster, or just this one, and return what each of
+        them returned. """
+        if self.cluster is None:
+            return [await getattr(self.get_cog(cog), method)(*args)]
+        return await self.cluster.peer.call('fan_out', cog, method, *args)
 
     async def on_message(self, message):
         if message.author.bot: return
         if message.author.id in self.blacklist: return
         await self.process_commands(message)
 
+    async def send_dm(self, user_id: int, content: str):
+        """The dm job. """
+        user = self.get_user(user_id) or await self.fetch_user(user_id)
+        try:
+            await user.send(content)
+        except discord.Forbidden:
+            self.logger.warning(f'Can\'t DM user {user_id}')
+
+    async def send_message(self, channel_id: int, content: str):
+        """The message job. """
+        # Jobs start before the channels are known, so send without looking the channel up if need be
+        channel = self.get_channel(channel_id) or self.get_partial_messageable(channel_id)
+        try:
+            await channel.send(content)
+        except discord.NotFound:
+            self.logger.warning(f'No channel {channel_id} to send a message to')
+
     async def set_presence(self, text):
         game = discord.Game(name=text)
         await self.change_presence(activity=game)
@@ -146,18 +310,8 @@ class OpenPOTD(commands.Bot):
     async def finished_posting(self):
         await self.set_presence(self.config['presence'])
         self.posting_problem = False
-
-
-def executor():
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+        self.dispatch('posting_finished')
 
 
 if __name__ == '__main__':
-    with open(f'config/{config["token"]}') as tokfile:
-        token = tokfile.readline().rstrip('\n')
-
-    x = threading.Thread(target=executor, args=(), daemon=True)
-    x.start()
-    OpenPOTD().run(token)
+    OpenPOTD().run(read_token())
@@ -0,0 +1,97 @@
+"""Bounded cache of problems. """
+import asyncio
+import collections
+import datetime
+import typing
+
+import database
+import shared
+
+
+class ProblemCache:
+    """The most recently used problems, so that converters and the stats embeds don't go to the database
+    for every command. Anything that changes a problem must call invalidate (or clear, if it could change
+    other problems' season_order), and forget_dates if it adds a problem or changes the date of one. """
+
+    def __init__(self, db: database.Database, size: int):
+        self.db = db
+        self.size = size
+        self.problems = collections.OrderedDict()  # problem id -> POTD, least recently used first
+        self.dates = collections.OrderedDict()  # date -> id of the problem of that day, least recently used first
+        self.generation = 0
+        self.dates_generation = 0
+        self.pending = set()  # drops waiting for a commit; the loop only keeps weak references to tasks
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, problem_id: int) -> shared.POTD:
+        """Raises LookupError if there is no such problem. """
+        if problem_id in self.problems:
+            self.hits += 1
+            self.problems.move_to_end(problem_id)
+            return self.problems[problem_id]
+
+        self.misses += 1
+        generation = self.generation
+        problem = await shared.POTD.from_id(problem_id, self.db)
+        if generation == self.generation:
+            # Only keep it if nothing was invalidated while we were reading
+            self.problems[problem_id] = problem
+            while len(self.problems) > self.size:
+                self.problems.popitem(last=False)
+        return problem
+
+    async def id_on(self, day: datetime.date) -> typing.Optional[int]:
+        """The id of the problem of `day`, if there is one. """
+        if day in self.dates:
+            self.dates.move_to_end(day)
+            return self.dates[day]
+
+        generation = self.dates_generation
+        result = await self.db.fetchone('SELECT id from problems where date = ?', (str(day),))
+        potd_id = None if result is None else result[0]
+        # Days without a problem aren't kept, so any number of them can be looked up
+        if potd_id is not None and generation == self.dates_generation:
+            self.dates[day] = potd_id
+            while len(self.dates) > self.size:
+                self.dates.popitem(last=False)
+        return potd_id
+
+    def invalidate(self, problem_id: int):
+        self._drop(problem_id)
+        # Readers only see committed data, so a problem read before the change is committed is stale as well
+        self._later(self._drop_on_commit(problem_id))
+
+    def clear(self):
+        self._drop(None)
+        self._later(self._drop_on_commit(None))
+
+    def forget_dates(self):
+        self._drop_dates()
+        self._later(self._drop_dates_on_commit())
+
+    def _later(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    def _drop(self, problem_id):
+        self.generation += 1
+        if problem_id is None:
+            self.problems.clear()
+        else:
+            self.problems.pop(problem_id, None)
+
+    async def _drop_on_commit(self, problem_id):
+        await self.db.commit(wait=True)
+        self._drop(problem_id)
+
+    def _drop_dates(self):
+        self.dates_generation += 1
+        self.dates.clear()
+
+    async def _drop_dates_on_commit(self):
+        await self.db.commit(wait=True)
+        self._drop_dates()
@@ -0,0 +1,203 @@
+"""Changing the roles of many members at once: solved role resets and medal roles. """
+import asyncio
+import logging
+import time
+import typing
+
+import discord
+
+import database
+import guildconfig
+
+
+class RateLimiter:
+    """Lets calls through at most `rate` times a second, spread evenly. """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        start = max(self.next, now)
+        self.next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class RoleChange(typing.NamedTuple):
+    server_id: int
+    user_id: int
+    role_id: int
+    add: bool
+
+
+def diff_roles(guild: discord.Guild, desired: dict):
+    """The changes that make the holders of each role in `desired` (role id -> set of user ids) exactly
+    the members listed, leaving everyone who already matches alone. """
+    changes = []
+    for role_id, user_ids in desired.items():
+        role = guild.get_role(role_id)
+        if role is None:
+            continue
+        holders = {member.id for member in role.members}
+        wanted = {user_id for user_id in user_ids if guild.get_member(user_id) is not None}
+        changes.extend(RoleChange(guild.id, user_id, role_id, True) for user_id in wanted - holders)
+        changes.extend(RoleChange(guild.id, user_id, role_id, False) for user_id in holders - wanted)
+    return changes
+
+
+async def apply_changes(http, changes: list, rate: float = 5, concurrency: int = 10):
+    """Make role changes concurrently, at most `rate` a second in each server and `concurrency` in flight.
+    Returns the changes that failed. """
+    limiters = {}  # server id -> rate limiter
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+
+    async def apply(change: RoleChange):
+        await limiters.setdefault(change.server_id, RateLimiter(rate)).wait()
+        async with semaphore:
+            try:
+                if change.add:
+                    await http.add_role(change.server_id, change.user_id, change.role_id)
+                else:
+                    await http.remove_role(change.server_id, change.user_id, change.role_id)
+            except discord.HTTPException as e:
+                failed.append(change)
+                logging.getLogger('roles').warning(f'[{change.server_id}] {change}: {e}')
+
+    await asyncio.gather(*[apply(change) for change in changes])
+    return failed
+
+
+class RoleReset:
+    """Removes a role from everyone who had it when a snapshot was taken. Snapshots are kept in the role_resets
+    table and each row is deleted once the role is gone, so a reset carries on where it left off after a
+    restart. Roles held by at least `recreate_threshold` people are deleted and recreated instead, which takes
+    a handful of requests however many people have them. In cluster mode each process only resets the roles
+    of servers it `owns`. """
+
+    def __init__(self, db: database.Database, http, guild_configs: guildconfig.GuildConfigCache, rate: float = 5,
+                 concurrency: int = 10, recreate_threshold: int = None,
+                 owns: typing.Callable[[int], bool] = lambda server_id: True):
+        self.db = db
+        self.http = http
+        self.guild_configs = guild_configs
+        self.owns = owns
+        self.rate = rate  # removals per second in each server
+        self.concurrency = concurrency  # removals in flight across all servers
+        self.recreate_threshold = recreate_threshold
+        self.logger = logging.getLogger('role reset')
+
+        self.semaphore = None
+        self.kept = set()  # (role id, user id) of people given the role back while it was being reset
+        self.tasks = {}  # role id -> task working through its snapshot
+
+        # Counters
+        self.processed = 0
+        self.seconds = 0.0
+
+    async def snapshot(self, guild: discord.Guild, role: discord.Role, exclude: set):
+        """Record who has the role, or recreate it if that's a lot of people. Nobody in `exclude` loses the
+        role. The snapshot is written but not committed. Returns the id of the solved role from now on. """
+        self.kept = {x for x in self.kept if x[0] != role.id}
+        if not guild.chunked:
+            await guild.chunk()
+        holders = [member.id for member in role.members if member.id not in exclude]
+        if self.recreate_threshold is not None and len(holders) >= self.recreate_threshold:
+            return await self.recreate(guild, role, [member for member in role.members if member.id in exclude])
+
+        await self.db.executemany('INSERT OR IGNORE INTO role_resets (server_id, role_id, user_id) VALUES (?, ?, ?)',
+                                  [(guild.id, role.id, user_id) for user_id in holders])
+        return role.id
+
+    async def recreate(self, guild: discord.Guild, role: discord.Role, keep: list):
+        start = time.monotonic()
+        new_role = await guild.create_role(name=role.name, permissions=role.permissions, colour=role.colour,
+                                           hoist=role.hoist, mentionable=role.mentionable, reason='New problem')
+        await new_role.edit(position=role.position)
+
+        # Point the config at the new role before the old one goes, so a crash in between loses nothing
+        await self.guild_configs.set(guild.id, solved_role_id=new_role.id)
+        await self.db.commit(wait=True)
+        await role.delete(reason='New problem')
+        for member in keep:
+            await member.add_roles(new_role)
+
+        elapsed = time.monotonic() - start
+        self.logger.info(f'[{guild.id}] Recreated role {role.id} as {new_role.id} for {len(role.members)} members '
+                         f'in {elapsed:.1f}s')
+        return new_role.id
+
+    async def solved_role(self, server_id: int, user_id: int, give: bool):
+        """Give or take someone's solved role in a server (the solved_role job). """
+        config = self.guild_configs.get(server_id)
+        if config is None or config.solved_role_id is None:
+            return
+        if give and config.guild is not None and config.guild.chunked and config.guild.get_member(user_id) is None:
+            # Not in the server
+            return
+        try:
+            if give:
+                await self.keep(config.solved_role_id, user_id)
+                await self.http.add_role(server_id, user_id, config.solved_role_id, reason='Solved POTD')
+            else:
+                await self.http.remove_role(server_id, user_id, config.solved_role_id, reason='Did not solve POTD')
+        except (discord.NotFound, discord.Forbidden) as e:
+            # Retrying won't help
+            self.logger.warning(f'[{server_id}] Setting solved role of {user_id}: {e}')
+
+    async def keep(self, role_id: int, user_id: int):
+        """Call before giving someone the role again, so a reset still in progress doesn't take it away. """
+        self.kept.add((role_id, user_id))
+        await self.db.execute('DELETE FROM role_resets WHERE role_id = ? and user_id = ?', (role_id, user_id))
+
+    async def resume(self):
+        """Start working through every stored snapshot that isn't being worked on yet. """
+        await self.db.commit(wait=True)
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        for server_id, role_id in await self.db.fetch('SELECT DISTINCT server_id, role_id from role_resets'):
+            if role_id not in self.tasks and self.owns(server_id):
+                self.tasks[role_id] = asyncio.create_task(self.run(server_id, role_id))
+
+    async def run(self, server_id: int, role_id: int):
+        try:
+            user_ids = [x[0] for x in await self.db.fetch('SELECT user_id from role_resets WHERE role_id = ?',
+                                                          (role_id,))]
+            limiter = RateLimiter(self.rate)
+            start = time.monotonic()
+            await asyncio.gather(*[self.remove(server_id, role_id, user_id, limiter) for user_id in user_ids])
+            elapsed = time.monotonic() - start
+
+            self.processed += len(user_ids)
+            self.seconds += elapsed
+            self.logger.info(f'[{server_id}] Removed role {role_id} from {len(user_ids)} members in {elapsed:.1f}s '
+                             f'({len(user_ids) / max(elapsed, 0.001):.1f} members/s)')
+        except Exception as e:
+            self.logger.warning(f'[{server_id}] Resetting role {role_id}: {e}')
+        finally:
+            del self.tasks[role_id]
+
+    async def remove(self, server_id: int, role_id: int, user_id: int, limiter: RateLimiter):
+        await limiter.wait()
+        async with self.semaphore:
+            if (role_id, user_id) not in self.kept:
+                try:
+                    await self.http.remove_role(server_id, user_id, role_id, reason='New problem')
+                except (discord.NotFound, discord.Forbidden):
+                    # They left, the role is gone or we can't manage it: retrying won't help
+                    pass
+                except discord.HTTPException as e:
+                    # Left in the table for the next resume
+                    self.logger.warning(f'[{server_id}] Removing role {role_id} from {user_id}: {e}')
+                    return
+
+                if (role_id, user_id) in self.kept:
+                    # They solved it while the role was being removed, and Discord may have taken their new role
+                    # away after giving it
+                    try:
+                        await self.http.add_role(server_id, user_id, role_id, reason='Solved POTD')
+                    except discord.HTTPException as e:
+                        self.logger.warning(f'[{server_id}] Giving role {role_id} back to {user_id}: {e}')
+        await self.db.execute('DELETE FROM role_resets WHERE role_id = ? and user_id = ?', (role_id, user_id))
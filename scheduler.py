@@ -0,0 +1,136 @@
+"""Running jobs at set times of day from inside the event loop. """
+import asyncio
+import datetime as dt
+import heapq
+import logging
+import time
+import typing
+import zoneinfo
+from datetime import datetime, timedelta
+
+import database
+
+
+class DailyJob(typing.NamedTuple):
+    name: str
+    at: dt.time
+    tz: typing.Optional[zoneinfo.ZoneInfo]
+    job: typing.Callable[[datetime], typing.Awaitable]
+    catch_up: typing.Optional[float]  # seconds late a missed run may still happen, None to skip missed runs
+
+    def run_time(self, day: dt.date):
+        if self.tz is None:
+            # Local time
+            return datetime.combine(day, self.at).astimezone()
+        return datetime.combine(day, self.at, tzinfo=self.tz)
+
+    def next_after(self, moment: datetime):
+        day = moment.astimezone(self.tz).date()
+        while self.run_time(day) <= moment:
+            day += timedelta(days=1)
+        return self.run_time(day)
+
+    def last_before(self, moment: datetime):
+        day = moment.astimezone(self.tz).date()
+        while self.run_time(day) > moment:
+            day -= timedelta(days=1)
+        return self.run_time(day)
+
+
+class Scheduler:
+    """Fires jobs at their time of day from a heap of timers. Each job is called with the time it was due.
+    The last successful run of every job is stored in the schedule_runs table. A run that was missed, failed
+    or was cut short by a restart happens when the bot starts if it is at most `catch_up` seconds late, also
+    for a job that has never run; a job can therefore run twice for the same time, but never loses one. """
+
+    def __init__(self, db: database.Database):
+        self.db = db
+        self.logger = logging.getLogger('scheduler')
+        self.jobs = {}  # name -> DailyJob
+        self.timers = []  # heap of (timestamp, name)
+        self.next_runs = {}  # name -> timestamp of its live timer, older timers of the job are ignored
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.firing = set()  # running jobs
+
+    def every_day(self, name: str, at: str, job: typing.Callable[[datetime], typing.Awaitable], tz: str = None,
+                  catch_up: float = None):
+        """Run job every day at `at` (HH:MM or HH:MM:SS) in the time zone `tz`, or local time. Replaces any job
+        with the same name. """
+        self.jobs[name] = DailyJob(name, datetime.strptime(at, '%H:%M:%S' if at.count(':') == 2 else '%H:%M').time(),
+                                   zoneinfo.ZoneInfo(tz) if tz else None, job, catch_up)
+        if self.task is not None:
+            self._push(name, self.jobs[name].next_after(datetime.now().astimezone()))
+            self.wakeup.set()
+
+    async def start(self):
+        """Catch up on missed runs and start the timers. """
+        if self.task is not None:
+            return
+        now = datetime.now().astimezone()
+        last_runs = dict(await self.db.fetch('SELECT name, last_run from schedule_runs'))
+        for name, job in self.jobs.items():
+            missed = job.last_before(now)
+            if job.catch_up is not None and last_runs.get(name, 0) < missed.timestamp() \
+                    and (now - missed).total_seconds() <= job.catch_up:
+                self.logger.info(f'Catching up on {name} due at {missed}')
+                self._push(name, missed)
+            else:
+                self._push(name, job.next_after(now))
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def _push(self, name: str, when: datetime):
+        self.next_runs[name] = when.timestamp()
+        heapq.heappush(self.timers, (when.timestamp(), name))
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.timers:
+                await self.wakeup.wait()
+                continue
+
+            timestamp, name = self.timers[0]
+            delay = timestamp - time.time()
+            if delay > 0:
+                # Wake up again if a job is added in the meantime
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.timers)
+            job = self.jobs.get(name)
+            if job is None or self.next_runs.get(name) != timestamp:
+                # Replaced since
+                continue
+            when = datetime.fromtimestamp(timestamp).astimezone(job.tz)
+            self._push(name, job.next_after(when))
+            task = asyncio.create_task(self._fire(job, when))
+            self.firing.add(task)
+            task.add_done_callback(self.firing.discard)
+
+    async def _fire(self, job: DailyJob, when: datetime):
+        result = await self.db.fetchone('SELECT last_run from schedule_runs WHERE name = ?', (job.name,))
+        if result is not None and result[0] >= when.timestamp():
+            self.logger.warning(f'{job.name} already ran for {when}')
+            return
+
+        self.logger.info(f'Running {job.name} due at {when} ({time.time() - when.timestamp():.3f}s late)')
+        try:
+            await job.job(when)
+        except Exception:
+            # Not recorded, so it is caught up on at the next start
+            self.logger.exception(f'{job.name} due at {when} failed')
+            return
+
+        await self.db.execute('INSERT INTO schedule_runs (name, last_run) VALUES (?, ?) ON CONFLICT (name) '
+                              'DO UPDATE SET last_run = excluded.last_run WHERE last_run < excluded.last_run',
+                              (job.name, when.timestamp()))
+        await self.db.commit(wait=True)
@@ -0,0 +1,360 @@
+"""Incremental scoring for seasons. """
+import asyncio
+import bisect
+import logging
+import sqlite3
+import typing
+
+import database
+
+
+# Change this if you want a different algorithm
+def weighted_score(attempts: int):
+    return 0.9 ** (attempts - 1)
+
+
+weighted_score_dict = [1, 0.9, 0.65, 0.45, 0.25, 0.1]
+
+
+def weighted_score_new(attempts: int):
+    return weighted_score_dict[min(attempts, len(weighted_score_dict)) - 1]
+
+
+def flat_score(attempts: int):
+    return 8 - attempts
+
+
+class ScoringRule(typing.NamedTuple):
+    """Solving a problem on attempt n is worth weight(n) times the problem's points. A problem is worth
+    base_points / (weighted solves + solves_offset), where its weighted solves are the sum of weight(n) over
+    its solves. If solves_offset is None every solve is just worth weight(n). """
+    weight: typing.Callable[[int], float]
+    solves_offset: typing.Optional[float]
+
+
+# Every season has one of these in seasons.scoring_rule. Add new rules here rather than special-casing seasons.
+SCORING_RULES = {
+    'weighted': ScoringRule(weighted_score, 0),
+    'flat': ScoringRule(flat_score, None),
+    'weighted_new': ScoringRule(weighted_score_new, 3),
+}
+
+
+class SeasonScores:
+    """Scoring state of one season, kept in memory so that a new solve only touches the solved problem and
+    the people who solved it. Scores are those of score_season and rescore_season up to floating point
+    rounding, so rankings are the same unless two scores are that close. """
+
+    def __init__(self, season: int, base_points: float, rule: str):
+        self.season = season
+        self.base_points = base_points
+        self.rule = SCORING_RULES[rule]
+        self.flat = self.rule.solves_offset is None
+        self.weight = self.rule.weight
+
+        self.solvers = {}  # problem id -> {user id: num_attempts}
+        self.weighted_solves = {}  # problem id -> weighted solves
+        self.problem_points = {}  # problem id -> points for solving on the first attempt
+        self.contributions = {}  # user id -> {problem id: points}
+        self.totals = {}  # user id -> score
+        self.order = []  # sorted list of (-score, user id); the rank of a user is their index + 1
+
+        # What is currently in the database, so that we only write rows that changed
+        self.written_rankings = {}  # user id -> (rank, score)
+        self.written_problems = {}  # problem id -> (weighted_solves, base_points)
+
+        # Things that changed since the last flush
+        self.dirty_problems = set()
+        self.dirty_low = None
+        self.dirty_high = None
+        self.dirty_to_end = False
+
+    async def load(self, db: database.Database):
+        # Solves are ordered the same way as in score_season
+        solves = await db.fetch('select solves.user, solves.problem_id, solves.num_attempts from problems left join '
+                                'solves where problems.season = ? and problems.id = solves.problem_id and official = ? '
+                                'order by solves.problem_id, solves.id', (self.season, True))
+        for user, problem, num_attempts in solves:
+            self.solvers.setdefault(problem, {})[user] = num_attempts
+            if not self.flat:
+                self.weighted_solves[problem] = self.weighted_solves.get(problem, 0) + self.weight(num_attempts)
+
+        rankings = await db.fetch('select user_id, rank, score from rankings where season_id = ? order by user_id',
+                                  (self.season,))
+        for user, rank, score in rankings:
+            self.contributions[user] = {}
+            self.written_rankings[user] = (rank, score)
+
+        problems = await db.fetch('select id, weighted_solves, base_points from problems where season = ?',
+                                  (self.season,))
+        self.written_problems = {x[0]: (x[1], x[2]) for x in problems}
+
+        for problem in self.solvers:
+            self._score_problem(problem)
+
+        for user in self.contributions:
+            self.totals[user] = self._total(user)
+        self.order = sorted((-self.totals[user], user) for user in self.totals)
+
+        # Everything may differ from what is in the database
+        self.dirty_problems = set(self.weighted_solves)
+        self.dirty_to_end = True
+        if self.order:
+            self.dirty_low = self.order[0]
+
+    def add_user(self, user: int):
+        """Put a newly ranked user into the season, with any solves they had before they were ranked. """
+        if user in self.totals:
+            return
+        self.contributions[user] = {problem: self._contribution(problem, solvers[user])
+                                    for problem, solvers in self.solvers.items() if user in solvers}
+        self.totals[user] = self._total(user)
+        key = (-self.totals[user], user)
+        bisect.insort(self.order, key)
+        self._mark(key)
+        self.dirty_to_end = True
+
+    def add_solve(self, user: int, problem: int, num_attempts: int):
+        """Record an official solve, rescoring only the problem and its solvers. """
+        self.add_user(user)
+        if user in self.solvers.get(problem, {}):
+            # Already loaded from the database
+            return
+        self.solvers.setdefault(problem, {})[user] = num_attempts
+
+        if self.flat:
+            self.contributions[user][problem] = self.weight(num_attempts)
+            self._rescore(user)
+        else:
+            self.weighted_solves[problem] = self.weighted_solves.get(problem, 0) + self.weight(num_attempts)
+            self._score_problem(problem)
+            self.dirty_problems.add(problem)
+            for solver in self.solvers[problem]:
+                if solver in self.totals:
+                    self._rescore(solver)
+
+    def flush(self):
+        """Returns the (rankings, problems) rows that need to be written to the database. """
+        rankings = []
+        if self.dirty_low is not None:
+            low = bisect.bisect_left(self.order, self.dirty_low)
+            if self.dirty_to_end:
+                high = len(self.order)
+            else:
+                high = bisect.bisect_right(self.order, self.dirty_high)
+
+            for i in range(low, high):
+                user = self.order[i][1]
+                entry = (i + 1, self.totals[user])
+                if self.written_rankings.get(user) != entry:
+                    self.written_rankings[user] = entry
+                    rankings.append((i + 1, self.totals[user], user, self.season))
+
+        problems = []
+        for problem in self.dirty_problems:
+            entry = (self.weighted_solves[problem], self.problem_points[problem])
+            if self.written_problems.get(problem) != entry:
+                self.written_problems[problem] = entry
+                problems.append((entry[0], entry[1], problem))
+
+        self.dirty_problems = set()
+        self.dirty_low = self.dirty_high = None
+        self.dirty_to_end = False
+        return rankings, problems
+
+    def _score_problem(self, problem: int):
+        if not self.flat:
+            self.problem_points[problem] = self.base_points / (self.weighted_solves[problem] + self.rule.solves_offset)
+
+        # Solves of people who aren't ranked count towards the weighted solves, but they get no score
+        solvers = self.solvers[problem]
+        for user in solvers:
+            if user in self.contributions:
+                self.contributions[user][problem] = self._contribution(problem, solvers[user])
+
+    def _contribution(self, problem: int, num_attempts: int):
+        if self.flat:
+            return self.weight(num_attempts)
+        return self.problem_points[problem] * self.weight(num_attempts)
+
+    def _total(self, user: int):
+        # Summed in problem order, same as score_season
+        contributions = self.contributions[user]
+        total = 0
+        for problem in sorted(contributions):
+            total += contributions[problem]
+        return total
+
+    def _rescore(self, user: int):
+        old_key = (-self.totals[user], user)
+        self.totals[user] = self._total(user)
+        new_key = (-self.totals[user], user)
+        if new_key == old_key:
+            return
+
+        del self.order[bisect.bisect_left(self.order, old_key)]
+        bisect.insort(self.order, new_key)
+        self._mark(old_key)
+        self._mark(new_key)
+
+    def _mark(self, key: tuple):
+        # Only people whose key lies between the old and new key of someone who moved can change rank
+        if self.dirty_low is None or key < self.dirty_low:
+            self.dirty_low = key
+        if self.dirty_high is None or key > self.dirty_high:
+            self.dirty_high = key
+
+
+async def season_rule(db: database.Database, season: int, default: str) -> str:
+    result = await db.fetchone('SELECT scoring_rule from seasons where id = ?', (season,))
+    if result is None or result[0] is None:
+        return default
+    return result[0]
+
+
+class ScoreKeeper:
+    """The SeasonScores of every season that had a solve since it was last rescored. In cluster mode this
+    lives in the coordinator, so that every solve goes through the same copy. """
+
+    def __init__(self, db: database.Database, base_points: float, default_rule: str):
+        self.db = db
+        self.base_points = base_points
+        self.default_rule = default_rule
+        self.seasons = {}  # season id -> SeasonScores
+        self.lock = asyncio.Lock()
+        self.logger = logging.getLogger('scoring')
+
+    async def get(self, season: int) -> SeasonScores:
+        async with self.lock:
+            if season not in self.seasons:
+                scores = SeasonScores(season, self.base_points,
+                                      await season_rule(self.db, season, self.default_rule))
+                await scores.load(self.db)
+                self.seasons[season] = scores
+            return self.seasons[season]
+
+    async def add(self, season: int, user: int, problem: int = None, num_attempts: int = None):
+        """Rank a user, and record their solve if given. Writes (but doesn't commit) only the rankings and
+        problem stats that changed, and returns the ids of the problems that changed and whether any
+        rankings did. """
+        scores = await self.get(season)
+        if problem is None:
+            scores.add_user(user)
+        else:
+            scores.add_solve(user, problem, num_attempts)
+
+        rankings, problems = scores.flush()
+        if problems:
+            await self.db.executemany('UPDATE problems SET weighted_solves = ?, base_points = ? '
+                                      'WHERE problems.id = ?', problems)
+        if rankings:
+            await self.db.executemany('update rankings SET rank = ?, score = ? WHERE user_id = ? and season_id = ?',
+                                      rankings)
+        self.logger.info(f'Updated {len(rankings)} rankings and {len(problems)} problems in season {season}')
+        return [problem[2] for problem in problems], bool(rankings)
+
+    async def drop(self, season: int):
+        """Forget a season after it has been rescored some other way. """
+        self.seasons.pop(season, None)
+
+    async def warm(self):
+        """Load every running season, so the first solve doesn't have to. """
+        for season, in await self.db.fetch('SELECT id from seasons WHERE running = ?', (True,)):
+            await self.get(season)
+
+
+def rescore_season(conn: sqlite3.Connection, season: int, rule: str, base_points: float):
+    """Score a season inside SQLite, as a database transaction. """
+    max_attempts = conn.execute('SELECT max(num_attempts) from solves inner join problems on '
+                                'solves.problem_id = problems.id where problems.season = ? and '
+                                'official = ?', (season, True)).fetchone()[0]
+    for sql, params in rescore_statements(season, rule, base_points, max_attempts or 1):
+        conn.execute(sql, params)
+
+
+def score_season(season: int, rule: str, base_points: float, solves: list, users: list):
+    """Score a whole season at once, for rescoring off the event loop in a worker process.
+
+    solves are (user, problem id, num_attempts) rows ordered by solves.problem_id, solves.id and users are
+    the ranked users in ascending order. Returns (rankings, problems) rows in the same form as
+    SeasonScores.flush. Scores can differ from those of SeasonScores and rescore_season by floating point
+    rounding, since they are added up in a different order. """
+    # Only the worker processes need numpy
+    import numpy as np
+
+    rule = SCORING_RULES[rule]
+    users = np.asarray(users, dtype=np.int64)
+    if solves:
+        solve_users, solve_problems, attempts = (np.asarray(x, dtype=np.int64) for x in zip(*solves))
+    else:
+        solve_users = solve_problems = attempts = np.zeros(0, dtype=np.int64)
+
+    # Solves by people who aren't ranked don't count
+    user_index = np.searchsorted(users, solve_users)
+    ranked = user_index < len(users)
+    ranked[ranked] = users[user_index[ranked]] == solve_users[ranked]
+    problem_ids, problem_index = np.unique(solve_problems, return_inverse=True)
+
+    # Look the weights up rather than computing them with numpy so they are exactly the Python ones
+    weights = np.array([rule.weight(n) for n in range(1, int(attempts.max(initial=1)) + 1)],
+                       dtype=np.float64)[attempts - 1]
+
+    problems = []
+    if rule.solves_offset is None:
+        contributions = weights
+    else:
+        # bincount adds up in the order of the solves
+        weighted_solves = np.bincount(problem_index, weights=weights, minlength=len(problem_ids))
+        points = base_points / (weighted_solves + rule.solves_offset)
+        contributions = points[problem_index] * weights
+        problems = list(zip(weighted_solves.tolist(), points.tolist(), problem_ids.tolist()))
+
+    totals = np.bincount(user_index[ranked], weights=contributions[ranked], minlength=len(users))
+
+    # Highest score first, ties broken by user id
+    order = np.lexsort((users, -totals))
+    rankings = list(zip(range(1, len(users) + 1), totals[order].tolist(), users[order].tolist(),
+                        [season] * len(users)))
+    return rankings, problems
+
+
+def rescore_statements(season: int, rule: str, base_points: float, max_attempts: int):
+    """Compiles a scoring rule into the statements that rescore a whole season inside SQLite: one that
+    updates problems.weighted_solves and base_points, and one that updates rankings.rank and score.
+    Returns a list of (sql, params). """
+    rule = SCORING_RULES[rule]
+
+    # The weights are passed in rather than written in SQL so they are exactly the Python ones
+    weights = ', '.join(f'({n}, :weight_{n})' for n in range(1, max_attempts + 1))
+    params = {f'weight_{n}': float(rule.weight(n)) for n in range(1, max_attempts + 1)}
+    params.update(season=season, official=True, base_points=float(base_points), solves_offset=rule.solves_offset)
+    with_weights = f'WITH weights (num_attempts, weight) AS (VALUES {weights}), '
+
+    statements = []
+    if rule.solves_offset is not None:
+        statements.append((with_weights +
+                           'solved AS (SELECT solves.problem_id AS id, sum(weights.weight) AS weighted_solves '
+                           'FROM problems INNER JOIN solves ON solves.problem_id = problems.id '
+                           'INNER JOIN weights ON weights.num_attempts = solves.num_attempts '
+                           'WHERE problems.season = :season AND solves.official = :official '
+                           'GROUP BY solves.problem_id) '
+                           'UPDATE problems SET weighted_solves = solved.weighted_solves, '
+                           'base_points = :base_points / (solved.weighted_solves + :solves_offset) '
+                           'FROM solved WHERE problems.id = solved.id', params))
+        contribution = 'problems.base_points * weights.weight'
+    else:
+        contribution = 'weights.weight'
+
+    # Ties are broken by user id, so every rank is distinct
+    statements.append((with_weights +
+                       f'scores AS (SELECT rankings.user_id, total({contribution}) AS score FROM rankings '
+                       'LEFT JOIN (solves INNER JOIN problems ON problems.id = solves.problem_id '
+                       'INNER JOIN weights ON weights.num_attempts = solves.num_attempts) '
+                       'ON solves.user = rankings.user_id AND problems.season = :season '
+                       'AND solves.official = :official '
+                       'WHERE rankings.season_id = :season GROUP BY rankings.user_id), '
+                       'ranked AS (SELECT user_id, score, RANK() OVER (ORDER BY score DESC, user_id) AS rank '
+                       'FROM scores) '
+                       'UPDATE rankings SET rank = ranked.rank, score = ranked.score FROM ranked '
+                       'WHERE rankings.season_id = :season AND rankings.user_id = ranked.user_id', params))
+    return statements
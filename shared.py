@@ -1,108 +1,144 @@
 """A bunch of helper functions. """
 import re
-import sqlite3
-from datetime import date
+import typing
+from datetime import date, timedelta
 
-import dateparser
 import discord
 from discord.ext import commands
 import logging
-import io
-import openpotd
+
+import database
+import images
+
+if typing.TYPE_CHECKING:
+    # openpotd imports this module through problems
+    import openpotd
 
 date_regex = re.compile('\d\d\d\d-\d\d-\d\d')
 
+# Dates people usually give, parsed without dateparser
+iso_date_regex = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+named_days = {'today': 0, 'yesterday': -1, 'tomorrow': 1}
+offset_regex = re.compile(r'(?:([+-]\d+)|(\d+) (day|week)s? ago|in (\d+) (day|week)s?)')
 
-def get_current_problem(conn: sqlite3.Connection):
-    cursor = conn.cursor()
-    cursor.execute('SELECT problems.id from seasons left join problems '
-                   'on seasons.running = ? where problems.id = seasons.latest_potd and problems.id is not null',
-                   (True,))
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return None
-    else:
-        return POTD(result[0][0], conn)
 
+def resolve_date(argument: str) -> typing.Optional[date]:
+    """The date meant by `argument`, or None. ISO dates, today/yesterday/tomorrow and offsets like -3, 3 days
+    ago or in 2 weeks are handled here; anything else is left to dateparser. """
+    text = argument.strip().lower()
+
+    match = iso_date_regex.fullmatch(text)
+    if match is not None:
+        try:
+            return date(*map(int, match.groups()))
+        except ValueError:
+            return None
+
+    if text in named_days:
+        return date.today() + timedelta(days=named_days[text])
+
+    match = offset_regex.fullmatch(text)
+    if match is not None:
+        offset, ago, ago_unit, ahead, ahead_unit = match.groups()
+        if offset is not None:
+            days = int(offset)
+        elif ago is not None:
+            days = -int(ago) * (7 if ago_unit == 'week' else 1)
+        else:
+            days = int(ahead) * (7 if ahead_unit == 'week' else 1)
+        try:
+            return date.today() + timedelta(days=days)
+        except OverflowError:
+            # Further away than datetime goes
+            return None
+
+    # dateparser takes a while to import and to parse, so only for the odd input
+    import dateparser
+    as_datetime = dateparser.parse(argument)
+    return None if as_datetime is None else as_datetime.date()
 
-async def assign_solved_role(servers: list, user_id: int, give: bool, context: commands.Context):
-    for server in servers:
-        guild: discord.Guild = context.bot.get_guild(server[0])
-        if guild is None:
-            continue
 
-        member: discord.Member = guild.get_member(user_id)
-        if member is None:
-            continue
+async def get_current_problem(db: database.Database):
+    result = await db.fetch('SELECT problems.id from seasons left join problems '
+                            'on seasons.running = ? where problems.id = seasons.latest_potd and problems.id is not null',
+                            (True,))
+    if len(result) == 0:
+        return None
+    else:
+        return await POTD.from_id(result[0][0], db)
 
-        solved_role: discord.Role = guild.get_role(server[1])
-        if solved_role is None:
-            continue
 
-        try:
-            if give:
-                await member.add_roles(solved_role, reason=f'Solved POTD')
-            else:
-                await member.remove_roles(solved_role, reason=f'Did not solve POTD')
-        except Exception as e:
-            logging.warning(f'[ASSIGNING SOLVED ROLE] Guild {server[0]} failed. ')
+class PreparedPost(typing.NamedTuple):
+    """Everything posted for a problem apart from the ping, which differs between servers. """
+    header: str
+    images: list
+    embed: discord.Embed
 
 
 class POTD:
-    """Representation of a problem of the day. """
-
-    def __init__(self, id: int, db: sqlite3.Connection):
-        cursor = db.cursor()
-        cursor.execute('SELECT * from problems WHERE id = ?', (id,))
-        result = cursor.fetchall()
-        if len(result) == 0:
-            raise Exception('No such problem! ')
-        else:
-            self.id = id
-            self.date = result[0][1]
-            self.season = result[0][2]
-            self.statement = result[0][3]
-            self.difficulty = result[0][4]
-            self.weighted_solves = result[0][5]
-            self.base_points = result[0][6]
-            self.answer = result[0][7]
-            self.public = result[0][8]
-            self.source = result[0][9]
-            self.stats_message_id = result[0][10]
-            self.difficulty_rating = result[0][11]
-            self.coolness_rating = result[0][12]
-            cursor.execute('SELECT image from images WHERE potd_id = ?', (id,))
-            self.images = [x[0] for x in cursor.fetchall()]
-            cursor.execute('SELECT name from seasons WHERE id = ?', (self.season,))
-            self.season_name = cursor.fetchall()[0][0]
-            cursor.execute('SELECT COUNT() from problems WHERE problems.season = ? AND problems.date < ?',
-                           (self.season, self.date))
-            self.season_order = cursor.fetchall()[0][0]
-            self.logger = logging.getLogger(f'POTD {self.id}')
-            self.db = db
+    """Representation of a problem of the day. Images, the season name and season_order are only loaded
+    when they are first asked for. """
+
+    def __init__(self, row: tuple, db: database.Database):
+        self.id = row[0]
+        self.date = row[1]
+        self.season = row[2]
+        self.statement = row[3]
+        self.difficulty = row[4]
+        self.weighted_solves = row[5]
+        self.base_points = row[6]
+        self.answer = row[7]
+        self.public = row[8]
+        self.source = row[9]
+        self.stats_message_id = row[10]
+        self.difficulty_rating = row[11]
+        self.coolness_rating = row[12]
+        self.images = None
+        self.season_name = None
+        self.season_order = None
+        self.logger = logging.getLogger(f'POTD {self.id}')
+        self.db = db
+
+    @classmethod
+    async def from_id(cls, id: int, db: database.Database):
+        row = await db.fetchone('SELECT * from problems WHERE id = ?', (id,))
+        if row is None:
+            raise LookupError('No such problem! ')
+        return cls(row, db)
+
+    async def get_images(self):
+        if self.images is None:
+            self.images = [images.Image(*x) for x in await self.db.fetch('SELECT hash, image from images '
+                                                                           'WHERE potd_id = ? order by id', (self.id,))]
+        return self.images
+
+    async def get_season_name(self):
+        if self.season_name is None:
+            self.season_name = (await self.db.fetchone('SELECT name from seasons WHERE id = ?', (self.season,)))[0]
+        return self.season_name
+
+    async def get_season_order(self):
+        if self.season_order is None:
+            self.season_order = (await self.db.fetchone('SELECT COUNT() from problems WHERE problems.season = ? AND '
+                                                        'problems.date < ?', (self.season, self.date)))[0]
+        return self.season_order
 
     @classmethod
     async def convert(cls, ctx: commands.Context, argument: str):
         """Method tries to infer a user's input and parse it as a problem."""
-        db: sqlite3.Connection = ctx.bot.db
-        cursor = db.cursor()
-
         # Check if it's an ID
         if argument.isnumeric():
-            cursor.execute('SELECT EXISTS (SELECT 1 from problems where id = ?)', (int(argument),))
-            if not cursor.fetchall()[0][0]:
+            try:
+                return await ctx.bot.problems.get(int(argument))
+            except LookupError:
                 raise discord.ext.commands.UserInputError(f'No potd with such an ID (`{argument}`)')
-            else:
-                return cls(int(argument), db)
 
         # Check if it's an date
-        as_datetime = dateparser.parse(argument)
-        if as_datetime is not None:
-            as_date = as_datetime.date()
-            cursor.execute('SELECT id from problems where date = ?', (as_date,))
-            result = cursor.fetchall()
-            if len(result) > 0:
-                return cls(result[0][0], db)
+        as_date = resolve_date(argument)
+        if as_date is not None:
+            potd_id = await ctx.bot.problems.id_on(as_date)
+            if potd_id is not None:
+                return await ctx.bot.problems.get(potd_id)
             else:
                 raise discord.ext.commands.UserInputError(f'No potd with that date! (`{str(as_date)}`)')
 
@@ -129,54 +165,56 @@ class POTD:
             ('source', self.source)
         ]
 
-    async def post(self, bot: openpotd.OpenPOTD, channel: int, potd_role_id: int):
+    async def prepare_post(self, bot: 'openpotd.OpenPOTD'):
+        identification_name = f'**{await self.get_season_name()} - #{await self.get_season_order() + 1}**'
+        images = await self.get_images()
+        if len(images) == 0:
+            header = f'{identification_name} of {self.date} has no picture attached. '
+        else:
+            header = f'{identification_name} [{self.date}]'
+
+        # Construct embed
+        embed = discord.Embed(title=f'{bot.config["otd_prefix"]}oTD {self.id} Stats')
+        embed.add_field(name='Difficulty', value=self.difficulty)
+        embed.add_field(name='Weighted Solves', value='0')
+        embed.add_field(name='Base Points', value='0')
+        embed.add_field(name='Solves (official)', value='0')
+        embed.add_field(name='Solves (unofficial)', value='0')
+        return PreparedPost(header, images, embed)
+
+    async def post(self, bot: 'openpotd.OpenPOTD', channel: int, potd_role_id: int, prepared: PreparedPost = None):
         channel = bot.get_channel(channel)
         if channel is None:
             raise Exception('No such channel!')
+
+        if prepared is None:
+            prepared = await self.prepare_post(bot)
+        images = prepared.images
+        if len(images) == 0:
+            await channel.send(prepared.header)
         else:
-            try:
-                identification_name = f'**{self.season_name} - #{self.season_order + 1}**'
-                if len(self.images) == 0:
-                    await channel.send(
-                        f'{identification_name} of {str(date.today())} has no picture attached. ')
-                else:
-                    await channel.send(f'{identification_name} [{str(date.today())}]',
-                                       file=discord.File(io.BytesIO(self.images[0]),
-                                                         filename=f'POTD-{self.id}-0.png'))
-                    for i in range(1, len(self.images)):
-                        await channel.send(
-                            file=discord.File(io.BytesIO(self.images[i]), filename=f'POTD-{self.id}-{i}.png'))
-
-                if potd_role_id is not None:
-                    await channel.send(f'DM your answers to me! <@&{potd_role_id}>')
-                else:
-                    await channel.send(f'DM your answers to me!')
-                    logging.warning(f'Config variable ping_role_id is not set! [Server {channel.guild.id}]')
-
-                # Construct embed and send
-                embed = discord.Embed(title=f'{bot.config["otd_prefix"]}oTD {self.id} Stats')
-                embed.add_field(name='Difficulty', value=self.difficulty)
-                embed.add_field(name='Weighted Solves', value='0')
-                embed.add_field(name='Base Points', value='0')
-                embed.add_field(name='Solves (official)', value='0')
-                embed.add_field(name='Solves (unofficial)', value='0')
-                stats_message: discord.Message = await channel.send(embed=embed)
-                self.add_stats_message(stats_message.id, channel.guild.id, stats_message.channel.id)
-            except Exception as e:
-                self.logger.warning(e)
-
-    def add_stats_message(self, message_id: int, server_id: int, channel_id: int):
-        cursor = self.db.cursor()
-        cursor.execute('INSERT INTO stats_messages (potd_id, message_id, server_id, channel_id) VALUES (?, ?, ?, ?)',
-                       (self.id, message_id, server_id, channel_id))
-        self.db.commit()
-
-    def build_embed(self, db: sqlite3.Connection, full_stats: bool, prefix: str = 'P'):
-        cursor = db.cursor()
-        cursor.execute('SELECT count(1) from solves where problem_id = ? and official = ?', (self.id, True))
-        official_solves = cursor.fetchall()[0][0]
-        cursor.execute('SELECT count(1) from solves where problem_id = ? and official = ?', (self.id, False))
-        unofficial_solves = cursor.fetchall()[0][0]
+            await bot.images.send(channel, images[0], f'POTD-{self.id}-0.png', prepared.header)
+            for i in range(1, len(images)):
+                await bot.images.send(channel, images[i], f'POTD-{self.id}-{i}.png')
+
+        if potd_role_id is not None:
+            await channel.send(f'DM your answers to me! <@&{potd_role_id}>')
+        else:
+            await channel.send(f'DM your answers to me!')
+            logging.warning(f'Config variable ping_role_id is not set! [Server {channel.guild.id}]')
+
+        stats_message: discord.Message = await channel.send(embed=prepared.embed)
+        await self.add_stats_message(stats_message.id, channel.guild.id, stats_message.channel.id)
+
+    async def add_stats_message(self, message_id: int, server_id: int, channel_id: int):
+        await self.db.execute('INSERT INTO stats_messages (potd_id, message_id, server_id, channel_id) '
+                              'VALUES (?, ?, ?, ?)', (self.id, message_id, server_id, channel_id))
+
+    async def build_embed(self, db: database.Database, full_stats: bool, prefix: str = 'P'):
+        official_solves = (await db.fetchone('SELECT count(1) from solves where problem_id = ? and official = ?',
+                                             (self.id, True)))[0]
+        unofficial_solves = (await db.fetchone('SELECT count(1) from solves where problem_id = ? and official = ?',
+                                               (self.id, False)))[0]
 
         embed = discord.Embed(title=f'{prefix.upper()}oTD {self.id} Stats')
 
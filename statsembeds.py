@@ -0,0 +1,92 @@
+"""Coalesced updates of the stats embeds posted under each problem. """
+import collections
+import logging
+import time
+
+import discord
+
+
+class ProblemEmbeds:
+    """What the updater knows about the stats messages of one problem. """
+
+    def __init__(self):
+        self.last_run = 0  # time of the last update
+        self.rendered = {}  # message id -> the embed currently shown, as a dict
+        self.missing = set()  # message ids that no longer exist
+
+
+class StatsEmbedUpdater:
+    """Keeps the stats embeds of problems up to date without editing any message more than once every
+    `interval` seconds. Updates are stats_embed jobs keyed by problem, so marking a problem dirty while an
+    update is already waiting is free, and messages whose embed would not change are not edited. Only the
+    `size` most recently updated problems are remembered; older ones just get edited again. """
+
+    def __init__(self, bot, interval: float = 10, size: int = 16):
+        self.bot = bot
+        self.interval = interval
+        self.size = size
+        self.logger = logging.getLogger('stats embeds')
+
+        self.problems = collections.OrderedDict()  # problem id -> ProblemEmbeds, least recently updated first
+
+        # Counters
+        self.edits = 0
+        self.coalesced = 0
+        self.unchanged = 0
+
+    async def mark_dirty(self, potd_id: int):
+        last_run = self.problems[potd_id].last_run if potd_id in self.problems else 0
+        wait = max(last_run + self.interval - time.monotonic(), 0)
+        if not await self.bot.jobs.enqueue('stats_embed', f'stats_embed {potd_id}', wait, potd_id=potd_id):
+            self.coalesced += 1
+
+    async def run(self, potd_id: int):
+        """The stats_embed job. It is committed together with the solves that made the problem dirty, so
+        those are visible here. """
+        self._state(potd_id).last_run = time.monotonic()
+        await self.update(potd_id)
+
+    def _state(self, potd_id: int) -> ProblemEmbeds:
+        if potd_id not in self.problems:
+            self.problems[potd_id] = ProblemEmbeds()
+            while len(self.problems) > self.size:
+                self.problems.popitem(last=False)
+        self.problems.move_to_end(potd_id)
+        return self.problems[potd_id]
+
+    async def update(self, potd_id: int):
+        messages = await self.bot.db.fetch('SELECT server_id, channel_id, message_id from stats_messages '
+                                           'WHERE potd_id = ?', (potd_id,))
+
+        problem = await self.bot.problems.get(potd_id)
+        state = self._state(potd_id)
+        embeds = {}  # otd prefix -> embed
+
+        for server_id, channel_id, message_id in messages:
+            guild_config = self.bot.guild_configs.get(server_id)
+            if message_id in state.missing or guild_config is None:
+                continue
+            otd_prefix = guild_config.otd_prefix
+            if channel_id is None:
+                channel_id = guild_config.potd_channel
+
+            if otd_prefix not in embeds:
+                embeds[otd_prefix] = await problem.build_embed(self.bot.db, False, otd_prefix)
+            embed = embeds[otd_prefix]
+            rendered = embed.to_dict()
+            if state.rendered.get(message_id) == rendered:
+                self.unchanged += 1
+                continue
+
+            # Edit without fetching the message first
+            stats_message = self.bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+            try:
+                await stats_message.edit(embed=embed)
+            except discord.NotFound:
+                state.missing.add(message_id)
+                self.logger.warning(f'[UPDATE_EMBED] Server {server_id} no message id {message_id}')
+            except discord.HTTPException as e:
+                self.logger.warning(f'[UPDATE_EMBED] Server {server_id} message {message_id}: {e}')
+            else:
+                state.rendered[message_id] = rendered
+                self.edits += 1
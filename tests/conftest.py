@@ -0,0 +1,31 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# The bot's modules are at the top of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def bot_dir(tmp_path, monkeypatch):
+    """A working directory with a config and an empty database, like the ones init.sh makes. openpotd reads
+    the config from the working directory when it is first imported. """
+    (tmp_path / 'config').mkdir()
+    (tmp_path / 'data').mkdir()
+    with open(os.path.join(ROOT, 'default_config.yml')) as default:
+        config = default.read().replace('\nposting_time:\n', '\nposting_time: "12:00"\n')
+    # A new database has never posted, so without this the post would be caught up on in the afternoon
+    config = config.replace('\nposting_catch_up: 21600\n', '\nposting_catch_up: 0\n')
+    config = config.replace('\nprepare_minutes: 10\n', '\nprepare_minutes: 0\n')
+    (tmp_path / 'config/config.yml').write_text(config + '\ncooldown: false\n')
+
+    conn = sqlite3.connect(tmp_path / 'data/data.db')
+    with open(os.path.join(ROOT, 'schema.sql')) as schema:
+        conn.executescript(schema.read())
+    conn.close()
+
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,101 @@
+"""Runs a cluster without connecting to Discord: the coordinator in its own process and the bot of process 0
+in this one, and sends it a submission. """
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+import types
+from datetime import datetime
+
+import pytest
+
+from conftest import ROOT
+
+
+class Channel:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content, file=None):
+        self.sent.append(content if file is None else (content, file.fp.read().decode()))
+
+
+@pytest.fixture
+def cluster_dir(bot_dir):
+    conn = sqlite3.connect(bot_dir / 'data/data.db')
+    conn.execute('INSERT INTO seasons (id, running, latest_potd, name) VALUES (1, 1, 1, ?)', ('Test',))
+    conn.execute('INSERT INTO problems (id, date, season, statement, answer, public) VALUES (1, ?, 1, ?, 42, 1)',
+                 (str(datetime.utcnow().date()), 'What is 6 times 7?'))
+    conn.commit()
+    conn.close()
+
+    # Read the config of this test
+    for module in ('openpotd', 'cluster'):
+        sys.modules.pop(module, None)
+    coordinator = subprocess.Popen([sys.executable, '-c', 'import cluster; cluster.run_coordinator("data/cluster.sock")'],
+                                   env={**os.environ, 'PYTHONPATH': ROOT})
+    yield bot_dir
+    coordinator.terminate()
+    coordinator.wait()
+
+
+async def eventually(check, timeout: float = 10):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not await check():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.05)
+
+
+def test_submission_is_relayed(cluster_dir):
+    import cluster
+    import ipc
+    import roles
+
+    async def run():
+        # Stands in for process 1, which is told about everything process 0 changes
+        relayed = []
+
+        async def mirror(peer, name, remote, args, kwargs):
+            relayed.append((name, remote, args))
+
+        # and has one server, where the solver has no medal role yet
+        async def run_cog(peer, cog, method, *args):
+            assert (cog, method) == ('Management', 'medal_role_changes')
+            return [roles.RoleChange(5, user_id, 77, True) for user_id in args[0][2]], 1
+
+        other = await ipc.connect('data/cluster.sock', {'mirror': mirror, 'run': run_cog})
+        await other.call('hello', 1)
+
+        bot = cluster.ShardedBot(cluster.ShardLink(0, [0], 2, 'data/cluster.sock'))
+        async with bot:
+            await bot.setup_hook()
+            await bot.on_ready()
+
+            # DMs go to process 0
+            channel = Channel()
+            message = types.SimpleNamespace(author=types.SimpleNamespace(id=1234, display_name='solver'),
+                                            channel=channel, guild=None, content='42')
+            await bot.get_cog('Interface').check_submission(message, 42, datetime.utcnow())
+            assert 'after 1 attempts' in channel.sent[-1] or 'Attempts: `1`' in channel.sent[-1]
+
+            # The coordinator scored it (season 1 is weighted, so the only solver gets all 1000 points) and
+            # committed it, so every process can read it
+            async def ranked():
+                return await bot.db.fetch('SELECT user_id, rank, score FROM rankings') == [(1234, 1, 1000)]
+            await eventually(ranked)
+
+            # and the other process drops the problem and the leaderboard from its caches
+            async def invalidated():
+                return ('problems', 'invalidate', (1,)) in relayed and ('leaderboard', 'invalidate', (1,)) in relayed
+            await eventually(invalidated)
+
+            # Medal roles are worked out in every process, including for the servers of process 1
+            await bot.db.execute('UPDATE seasons SET bronze_cutoff = 100, silver_cutoff = 500, gold_cutoff = 900')
+            management = bot.get_cog('Management')
+            await management.assign_roles.callback(management, channel, 1, True)
+            assert channel.sent[-1] == ('1 roles to add and 0 to remove in 1 servers. ',
+                                        '+ server 5 user 1234 role 77')
+        other.close()
+
+    asyncio.run(run())
@@ -0,0 +1,84 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+import database
+
+
+class CheckedDatabase(database.Database):
+    """A database whose connections check foreign keys, so a write can make the commit of its group fail. """
+
+    def _connect(self, **kwargs):
+        conn = super()._connect(**kwargs)
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+
+def make_db(tmp_path, cls=database.Database, **kwargs):
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.executescript('''CREATE TABLE parents (id INTEGER PRIMARY KEY);
+                          CREATE TABLE children (id INTEGER PRIMARY KEY, parent INTEGER
+                              REFERENCES parents (id) DEFERRABLE INITIALLY DEFERRED);''')
+    conn.close()
+    db = cls(path, **kwargs)
+    db.start()
+    return db
+
+
+def blocker(started: threading.Event, release: threading.Event, conn: sqlite3.Connection):
+    started.set()
+    release.wait()
+    conn.execute('INSERT INTO parents (id) VALUES (1)')
+
+
+async def block_writer(db: database.Database):
+    """Keep the writer busy until the returned event is set. """
+    started, release = threading.Event(), threading.Event()
+    task = asyncio.create_task(db.transaction(lambda conn: blocker(started, release, conn)))
+    await asyncio.get_running_loop().run_in_executor(None, started.wait)
+    return task, release
+
+
+def test_timed_out_write_is_dropped(tmp_path):
+    async def run():
+        db = make_db(tmp_path, timeout=0.2)
+        blocked, release = await block_writer(db)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await db.execute('INSERT INTO parents (id) VALUES (2)')
+        assert db.timeouts == 1
+
+        # The first write had started, so it still lands
+        release.set()
+        await blocked
+        assert await db.fetch('SELECT id FROM parents') == [(1,)]
+        await db.close()
+
+    asyncio.run(run())
+
+
+def test_failed_commit_fails_the_group(tmp_path):
+    async def run():
+        db = make_db(tmp_path, CheckedDatabase)
+        blocked, release = await block_writer(db)
+
+        # Both go in the same group as the blocker; the orphan breaks its commit
+        good = asyncio.create_task(db.execute('INSERT INTO parents (id) VALUES (2)'))
+        orphan = asyncio.create_task(db.execute('INSERT INTO children (id, parent) VALUES (1, 99)'))
+        await asyncio.sleep(0.05)
+        release.set()
+
+        for write in (blocked, good, orphan):
+            with pytest.raises(sqlite3.IntegrityError):
+                await write
+        assert await db.fetch('SELECT id FROM parents') == []
+
+        # The writer carries on
+        await db.execute('INSERT INTO parents (id) VALUES (3)')
+        assert await db.fetch('SELECT id FROM parents') == [(3,)]
+        await db.close()
+
+    asyncio.run(run())
@@ -0,0 +1,111 @@
+"""ImageStore against a stubbed Discord HTTP layer: a client whose requests never leave the process. """
+import asyncio
+import io
+import itertools
+import time
+
+import discord
+
+import images
+
+
+class StubHTTP:
+    """Stands in for discord.http.HTTPClient.request, answering every message sent with the message Discord
+    would create. """
+
+    def __init__(self, expiry: int):
+        self.expiry = expiry  # what Discord puts in the ex parameter of attachment urls
+        self.requests = []  # (files, payload)
+        self.ids = itertools.count(1)
+
+    async def request(self, route, *, files=None, form=None, json=None, **kwargs):
+        message_id = str(next(self.ids))
+        payload = json if json is not None else discord.utils._from_json(form[0]['value'])
+        self.requests.append(([f.filename for f in files or []], payload))
+        await asyncio.sleep(0.01)
+        return {
+            'id': message_id, 'channel_id': str(route.channel_id), 'type': 0, 'content': payload.get('content') or '',
+            'author': {'id': '1', 'username': 'bot', 'discriminator': '0', 'avatar': None},
+            'attachments': [{'id': f'{message_id}{i}', 'filename': f.filename, 'size': 1,
+                             'url': f'https://cdn.example/{f.filename}?ex={self.expiry:x}',
+                             'proxy_url': f'https://media.example/{f.filename}'} for i, f in enumerate(files or [])],
+            'embeds': payload.get('embeds') or [], 'mentions': [], 'mention_roles': [], 'pinned': False,
+            'mention_everyone': False, 'tts': False, 'timestamp': '2023-01-01T00:00:00+00:00',
+            'edited_timestamp': None,
+        }
+
+
+def channels(expiry: int, count: int):
+    """The stub and `count` channels whose messages go to it. """
+    http = StubHTTP(expiry)
+    client = discord.Client(intents=discord.Intents.none())
+    client.http.request = http.request
+    return http, [client.get_partial_messageable(100 + i) for i in range(count)]
+
+
+def test_uploads_once(tmp_path):
+    async def run():
+        store = images.ImageStore(str(tmp_path))
+        image = images.Image(await store.put(b'not really a png'), None)
+        http, destinations = channels(int(time.time()) + 24 * 60 * 60, 5)
+
+        await asyncio.gather(*[store.send(destination, image, 'POTD-1-0.png', 'header')
+                               for destination in destinations])
+        uploads = [payload for files, payload in http.requests if files]
+        reuses = [payload for files, payload in http.requests if not files]
+        assert len(uploads) == 1 and len(reuses) == 4
+        assert all(payload['embeds'][0]['image']['url'].startswith('https://cdn.example/POTD-1-0.png')
+                   for payload in reuses)
+        assert (store.uploads, store.reuses) == (1, 4)
+
+    asyncio.run(run())
+
+
+def test_expired_url_is_uploaded_again(tmp_path):
+    async def run():
+        store = images.ImageStore(str(tmp_path))
+        image = images.Image(await store.put(b'not really a png'), None)
+        # Urls that expire five minutes after they are made are too short-lived to reuse
+        http, destinations = channels(int(time.time()) + 5 * 60, 2)
+
+        for destination in destinations:
+            await store.send(destination, image, 'POTD-1-0.png')
+        assert [bool(files) for files, payload in http.requests] == [True, True]
+        assert (store.uploads, store.reuses) == (2, 0)
+
+    asyncio.run(run())
+
+
+def test_images_without_hash_are_uploaded(tmp_path):
+    async def run():
+        store = images.ImageStore(str(tmp_path))
+        http, destinations = channels(int(time.time()) + 24 * 60 * 60, 2)
+        for destination in destinations:
+            await store.send(destination, images.Image(None, b'from the database'), 'POTD-1-0.png')
+        assert store.uploads == 2
+
+    asyncio.run(run())
+
+
+def png(size=(200, 100), **text):
+    from PIL import Image, PngImagePlugin
+
+    info = PngImagePlugin.PngInfo()
+    for key, value in text.items():
+        info.add_text(key, value)
+    out = io.BytesIO()
+    Image.new('RGB', size, 'red').save(out, 'PNG', pnginfo=info)
+    return out.getvalue()
+
+
+def test_optimise_drops_metadata():
+    from PIL import Image
+
+    for data in (png(Author='someone', Comment='x' * 1000), png(Author='someone')):
+        assert Image.open(io.BytesIO(images.optimise(data))).text == {}
+    assert Image.open(io.BytesIO(images.optimise(png(Author='someone'), 50))).size == (50, 25)
+
+
+def test_optimise_keeps_what_isnt_an_image():
+    for data in (b'%PDF-1.4 not an image', png()[:100]):
+        assert images.optimise(data, 50) is data
@@ -0,0 +1,46 @@
+import asyncio
+import types
+
+import database
+import migrations
+import roles
+
+
+class StubHTTP:
+    """Role requests that take until `release` is set. Keeps the order Discord applied them in. """
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+        self.applied = []  # (add, user id, role id)
+
+    async def add_role(self, server_id, user_id, role_id, reason=None):
+        self.applied.append((True, user_id, role_id))
+
+    async def remove_role(self, server_id, user_id, role_id, reason=None):
+        self.started.set()
+        await self.release.wait()
+        self.applied.append((False, user_id, role_id))
+
+
+def test_grant_during_removal_wins(bot_dir):
+    async def run():
+        db = database.Database('data/data.db')
+        db.start()
+        await migrations.migrate(db)
+        config = types.SimpleNamespace(solved_role_id=7, guild=None)
+        http = StubHTTP()
+        reset = roles.RoleReset(db, http, types.SimpleNamespace(get=lambda server_id: config))
+        await db.execute('INSERT INTO role_resets (server_id, role_id, user_id) VALUES (?, ?, ?)', (1, 7, 42))
+        await reset.resume()
+
+        # They solve the new problem while their old role is being removed
+        await http.started.wait()
+        await reset.solved_role(1, 42, True)
+        http.release.set()
+        await asyncio.gather(*reset.tasks.values())
+
+        assert http.applied[-1] == (True, 42, 7)
+        await db.close()
+
+    asyncio.run(run())
@@ -0,0 +1,36 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import database
+import migrations
+import scheduler
+
+
+def test_missed_and_failed_runs_are_caught_up(bot_dir):
+    async def run():
+        db = database.Database('data/data.db')
+        db.start()
+        await migrations.migrate(db)
+        at = (datetime.now() - timedelta(minutes=1)).strftime('%H:%M:%S')
+        runs = []
+
+        async def job(when):
+            runs.append(when)
+            if len(runs) == 1:
+                raise RuntimeError('Discord is down')
+
+        # A job that has never run is due, and so is one whose run failed, but not once it succeeded
+        for expected in (1, 2, 2):
+            schedule = scheduler.Scheduler(db)
+            schedule.every_day('post', at, job, catch_up=3600)
+            await schedule.start()
+            await asyncio.sleep(0.1)
+            while schedule.firing:
+                await asyncio.sleep(0.01)
+            schedule.stop()
+            assert len(runs) == expected
+
+        assert runs[0] == runs[1]
+        await db.close()
+
+    asyncio.run(run())
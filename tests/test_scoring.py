@@ -0,0 +1,153 @@
+"""The ways of scoring a season: incrementally as solves come in (SeasonScores), and whole seasons at once in
+numpy or in SQLite through update_rankings. They add things up in different orders, so scores only agree
+up to rounding. """
+import asyncio
+import random
+import types
+
+import pytest
+
+import database
+import migrations
+import problems
+import scoring
+
+BASE_POINTS = 1000
+RULES = ('weighted', 'flat', 'weighted_new')
+
+
+async def start(backend: str = 'sql'):
+    """The database and an Interface cog with just enough of a bot to rescore seasons. """
+    # Imports openpotd, which needs the config in the working directory
+    import cogs.interface
+
+    db = database.Database('data/data.db')
+    db.start()
+    await migrations.migrate(db)
+    bot = types.SimpleNamespace(db=db, config={'base_points': BASE_POINTS, 'scoring_backend': backend,
+                                               'rescore_processes': 1},
+                                scores=scoring.ScoreKeeper(db, BASE_POINTS, 'weighted_new'),
+                                problems=problems.ProblemCache(db, 64),
+                                jobs=types.SimpleNamespace(register=lambda *args: None))
+    return db, cogs.interface.Interface(bot)
+
+
+async def add_season(db: database.Database, season: int, rule: str, num_problems: int = 8):
+    await db.execute('INSERT INTO seasons (id, running, name, scoring_rule) VALUES (?, ?, ?, ?)',
+                     (season, True, rule, rule))
+    await db.executemany('INSERT INTO problems (id, date, season, statement, answer) VALUES (?, ?, ?, ?, ?)',
+                         [(season * 100 + i, f'2023-01-{i + 1:02}', season, 'statement', i)
+                          for i in range(num_problems)])
+    return [season * 100 + i for i in range(num_problems)]
+
+
+def random_solves(rng: random.Random, problem_ids: list, users: range):
+    """(user, problem id, num_attempts) of people solving some of the problems in a random order. """
+    solves = [(user, problem, rng.randint(1, 7)) for user in users for problem in problem_ids
+              if rng.random() < 0.4]
+    rng.shuffle(solves)
+    return solves
+
+
+async def rankings(db: database.Database, season: int):
+    return {user: (rank, score) for user, rank, score in
+            await db.fetch('SELECT user_id, rank, score FROM rankings WHERE season_id = ?', (season,))}
+
+
+async def problem_stats(db: database.Database, season: int):
+    return {problem: (weighted_solves, base_points) for problem, weighted_solves, base_points in
+            await db.fetch('SELECT id, weighted_solves, base_points FROM problems WHERE season = ? AND id IN '
+                           '(SELECT problem_id FROM solves)', (season,))}
+
+
+def assert_same(expected: dict, actual: dict):
+    assert expected.keys() == actual.keys()
+    for key in expected:
+        # Ranks (and weighted solves) are exact, scores and points up to rounding
+        assert actual[key][0] == pytest.approx(expected[key][0], rel=0, abs=1e-9), key
+        assert actual[key][1] == pytest.approx(expected[key][1], rel=1e-12), key
+
+
+@pytest.mark.parametrize('rule', RULES)
+def test_backends_agree(bot_dir, rule):
+    async def run():
+        db, interface = await start()
+        rng = random.Random(rule)
+        problem_ids = await add_season(db, 1, rule)
+        solves = random_solves(rng, problem_ids, range(1, 41))
+        await db.executemany('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                             [(*solve, True) for solve in solves])
+        await db.executemany('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                             [(user, problem_ids[0], 1, False) for user in range(1, 11)])
+        # People who are ranked without solving anything, and people who solved things but aren't ranked
+        await db.executemany('INSERT INTO rankings (season_id, user_id) VALUES (?, ?)',
+                             [(1, user) for user in range(5, 46)])
+        await db.commit(wait=True)
+
+        season_scores = scoring.SeasonScores(1, BASE_POINTS, rule)
+        await season_scores.load(db)
+        ranking_rows, problem_rows = season_scores.flush()
+        incremental = {user: (rank, score) for rank, score, user, _ in ranking_rows}
+
+        interface.bot.config['scoring_backend'] = 'numpy'
+        await interface.update_rankings(1)
+        await db.commit(wait=True)
+        numpy_rankings, numpy_problems = await rankings(db, 1), await problem_stats(db, 1)
+
+        interface.bot.config['scoring_backend'] = 'sql'
+        await db.execute('UPDATE rankings SET rank = NULL, score = NULL')
+        await db.execute('UPDATE problems SET weighted_solves = 0, base_points = 0')
+        await interface.update_rankings(1)
+        await db.commit(wait=True)
+        sql_rankings, sql_problems = await rankings(db, 1), await problem_stats(db, 1)
+
+        assert_same(incremental, numpy_rankings)
+        assert_same(incremental, sql_rankings)
+        if rule != 'flat':
+            stats = {problem: (weighted_solves, base_points) for weighted_solves, base_points, problem in problem_rows}
+            assert_same(stats, numpy_problems)
+            assert_same(stats, sql_problems)
+
+        interface.cog_unload()
+        await db.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('rule', RULES)
+def test_incremental_matches_update_rankings(bot_dir, rule):
+    async def run():
+        db, interface = await start()
+        rng = random.Random(rule)
+        problem_ids = await add_season(db, 1, rule)
+
+        # Solves of people who weren't ranked when the season was loaded
+        unranked = random_solves(rng, problem_ids, range(100, 110))
+        await db.executemany('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                             [(*solve, True) for solve in unranked])
+        await db.commit(wait=True)
+
+        # Solves, and people being ranked for a wrong answer, as they would come in. Some of the people with
+        # solves from before get ranked later.
+        events = random_solves(rng, problem_ids, range(1, 31))
+        events += [(user, None, None) for user in [*range(31, 36), 100, 101, 102]]
+        rng.shuffle(events)
+        for user, problem, num_attempts in events:
+            await db.execute('INSERT OR IGNORE INTO rankings (season_id, user_id) VALUES (?, ?)', (1, user))
+            if problem is not None:
+                await db.execute('INSERT INTO solves (user, problem_id, num_attempts, official) VALUES (?, ?, ?, ?)',
+                                 (user, problem, num_attempts, True))
+            await interface.bot.scores.add(1, user, problem, num_attempts)
+        await db.commit(wait=True)
+        incremental_rankings, incremental_problems = await rankings(db, 1), await problem_stats(db, 1)
+
+        await interface.update_rankings(1)
+        await db.commit(wait=True)
+        assert_same(await rankings(db, 1), incremental_rankings)
+        if rule != 'flat':
+            assert_same(await problem_stats(db, 1), incremental_problems)
+
+        interface.cog_unload()
+        await db.close()
+
+    asyncio.run(run())
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+from datetime import date, timedelta
+
+import shared
+from conftest import ROOT
+
+# Seconds to import the bot and every cog. They take well under half of that without dateparser.
+IMPORT_BUDGET = 2.0
+
+# Only imported when they are used
+LAZY_MODULES = ('dateparser', 'numpy', 'PIL')
+
+
+def test_resolve_date():
+    today = date.today()
+    assert shared.resolve_date('2023-04-05') == date(2023, 4, 5)
+    assert shared.resolve_date(' Today ') == today
+    assert shared.resolve_date('yesterday') == today - timedelta(days=1)
+    assert shared.resolve_date('-3') == today - timedelta(days=3)
+    assert shared.resolve_date('2 weeks ago') == today - timedelta(weeks=2)
+    assert shared.resolve_date('in 1 day') == today + timedelta(days=1)
+    assert shared.resolve_date('2023-02-30') is None
+
+
+def test_resolve_date_out_of_range():
+    assert shared.resolve_date('in 99999999 days') is None
+    assert shared.resolve_date('-99999999999999999999') is None
+    assert shared.resolve_date('99999999 weeks ago') is None
+
+
+def test_import_time(bot_dir):
+    cogs = [name[:-3] for name in os.listdir(os.path.join(ROOT, 'cogs')) if name.endswith('.py')]
+    imports = ', '.join(['openpotd', *(f'cogs.{cog}' for cog in cogs)])
+
+    # Once to compile everything, then timed
+    for _ in range(2):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {imports}'], cwd=bot_dir,
+                                env={**os.environ, 'PYTHONPATH': ROOT}, capture_output=True, text=True, check=True)
+
+    total = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        imported.add(name.strip().split('.')[0])
+        if not name.startswith('  '):
+            # Top level imports include everything they import
+            total += int(cumulative) / 1e6
+
+    assert imported.isdisjoint(LAZY_MODULES)
+    assert total < IMPORT_BUDGET